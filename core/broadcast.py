@@ -0,0 +1,191 @@
+# coding=utf-8
+"""
+Рассылка патчей координатором всем участникам сессии
+"""
+from collections import deque
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.protocols.amp import COMMAND
+from zope.interface import implementer
+
+from outbound import OutboundBatch
+
+__author__ = 'snowy'
+
+
+class BroadcastGroup(object):
+    def __init__(self):
+        """
+        Участники сессии координатора (AMP протоколы). Подключение и отключение стоят O(1)
+        """
+        self._members = {}
+
+    def join(self, proto):
+        assert hasattr(proto, 'callRemote'), 'участник должен иметь метод callRemote ' \
+                                             'для того, чтобы можно было отправлять AMP пакеты'
+        self._members[id(proto)] = proto
+
+    def leave(self, proto):
+        self._members.pop(id(proto), None)
+
+    def clear(self):
+        self._members.clear()
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, proto):
+        return id(proto) in self._members
+
+    def __iter__(self):
+        return self._members.itervalues()
+
+    def others(self, proto):
+        """
+        :return: генератор участников, кроме proto
+        """
+        return (member for member in self._members.itervalues() if member is not proto)
+
+
+def serialize_command(command, proto, **arguments):
+    """
+    Сериализовать команду, не требующую ответа. Одни и те же байты можно отправить любому числу участников,
+    т.к. в пакете нет номера запроса (_ask)
+    :param command: класс AMP команды
+    :param proto: AMP протокол любого из получателей (нужен некоторым типам аргументов)
+    :return: str
+    """
+    box = command.makeArguments(arguments, proto)
+    box[COMMAND] = command.commandName
+    return box.serialize()
+
+
+@implementer(IPushProducer)
+class PeerQueue(object):
+    max_size = 1024 * 1024
+    """Объем неотправленных патчей (символов), после которого пир сбрасывается и должен загрузить текст заново"""
+
+    def __init__(self, algorithm, send, on_drop):
+        """
+        Очередь патчей координатора для одного пира. Пока транспорт пира не принимает данные (pauseProducing),
+        идущие подряд патчи сворачиваются в один
+        :param algorithm: CoordinatorDiffMatchPatchAlgorithm документ, патчи которого получает пир
+        :param send: callable (patch_objects, timestamp, revision, cache) -> defer.Deferred или None, отправить патч
+        пиру; Deferred - отправка закончится позже
+        :param on_drop: callable () пир отстал больше чем на max_size
+        """
+        self.algorithm = algorithm
+        self.send = send
+        self.on_drop = on_drop
+        self.batches = deque()
+        ":type batches: deque [OutboundBatch]"
+        self.size = 0
+        self.paused = False
+        self.sending = False
+        # пир сброшен: патчи ему не нужны, пока он не начнет загружать текст
+        self.dropped = False
+        self._drained = []
+
+    def __len__(self):
+        return sum(len(batch) for batch in self.batches)
+
+    def push(self, operation, timestamp, before_model, cache=None):
+        """
+        Отправить патч или поставить его в очередь
+        :param operation: oplog.Operation патч координатора
+        :param before_model: модель текста координатора до патча (не изменяется)
+        :param cache: dict кэш сериализованного патча, общий для всех пиров
+        """
+        if self.dropped:
+            return
+        if not self.batches and not self.paused and not self.sending:
+            self._send(operation.patch, timestamp, operation.revision, cache)
+            return
+        if not self.batches or self.batches[-1].sealed:
+            self.batches.append(OutboundBatch(before_model.copy(), None))
+        batch = self.batches[-1]
+        size = batch.size
+        batch.add(operation, timestamp)
+        self.size += batch.size - size
+        if self.size > self.max_size:
+            self.drop()
+
+    def seal(self):
+        """
+        Закрыть последнюю пачку перед изменением текста патчем, который пиру не отправляется (патч самого пира)
+        """
+        if self.batches and not self.batches[-1].sealed:
+            self.batches[-1].seal(self.algorithm.text_model, self.algorithm.dmp)
+
+    def drain(self):
+        """
+        Отправить накопленные пачки, пока транспорт принимает данные
+        """
+        while self.batches and not self.paused and not self.sending:
+            batch = self.batches.popleft()
+            self.size -= batch.size
+            if not batch.sealed:
+                batch.seal(self.algorithm.text_model, self.algorithm.dmp)
+            if batch.patches:
+                self._send(batch.patches, batch.timestamp, batch.operations[-1].revision, None)
+        if not self.batches and not self.sending:
+            self._fire_drained()
+
+    def when_drained(self):
+        """
+        :return: defer.Deferred, срабатывает, когда отправлены все патчи, поставленные в очередь до этого вызова
+        """
+        if not self.batches and not self.sending:
+            return defer.succeed(None)
+        result = defer.Deferred()
+        self._drained.append(result)
+        return result
+
+    def restart(self):
+        """
+        Пир загружает текст координатора: патчи из очереди в нем уже есть
+        :return: defer.Deferred, срабатывает, когда закончится текущая отправка
+        """
+        self.dropped = False
+        self._clear()
+        return self.when_drained()
+
+    def drop(self):
+        """
+        Забыть неотправленные патчи. Пир должен загрузить текст заново
+        """
+        self._clear()
+        self.dropped = True
+        self.on_drop()
+
+    def _clear(self):
+        self.batches.clear()
+        self.size = 0
+        self._fire_drained()
+
+    def _send(self, patch_objects, timestamp, revision, cache):
+        sent = self.send(patch_objects, timestamp, revision, cache)
+        if sent is not None:
+            self.sending = True
+
+            def _sent(ignore):
+                self.sending = False
+                self.drain()
+
+            sent.addBoth(_sent)
+
+    def _fire_drained(self):
+        drained, self._drained = self._drained, []
+        for result in drained:
+            result.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.drain()
+
+    def stopProducing(self):
+        self._clear()
@@ -0,0 +1,102 @@
+# coding=utf-8
+"""
+Бинарный формат патчей для передачи по AMP.
+В отличие от patch_toText, текст диффов не экранируется (%xx), а передается как есть в UTF-8 с префиксом длины,
+а числа кодируются varint'ами. Разбор не требует регулярных выражений.
+
+Формат: версия (1 байт), число патчей, затем для каждого патча
+start1, start2, length1, length2, число диффов и для каждого диффа операция (1 байт), длина в байтах, UTF-8 данные.
+"""
+from libs.dmp.diff_match_patch import diff_match_patch, patch_obj
+
+__author__ = 'snowy'
+
+VERSION = 1
+
+_OP_TO_BYTE = {
+    diff_match_patch.DIFF_EQUAL: 0,
+    diff_match_patch.DIFF_INSERT: 1,
+    diff_match_patch.DIFF_DELETE: 2,
+}
+_BYTE_TO_OP = dict((byte, op) for op, byte in _OP_TO_BYTE.items())
+
+
+class PatchDecodeError(ValueError):
+    pass
+
+
+def _write_varint(out, value):
+    if value < 0:
+        raise ValueError('varint must be non-negative, got {0}'.format(value))
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise PatchDecodeError('unexpected end of data while reading varint')
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_patches(patches):
+    """
+    :param patches: list [libs.dmp.diff_match_patch.patch_obj]
+    :return: str
+    """
+    out = [chr(VERSION)]
+    _write_varint(out, len(patches))
+    for patch in patches:
+        for value in (patch.start1, patch.start2, patch.length1, patch.length2, len(patch.diffs)):
+            _write_varint(out, value)
+        for op, data in patch.diffs:
+            encoded = data.encode('utf-8')
+            out.append(chr(_OP_TO_BYTE[op]))
+            _write_varint(out, len(encoded))
+            out.append(encoded)
+    return ''.join(out)
+
+
+def decode_patches(data):
+    """
+    :param data: str результат encode_patches
+    :return: list [libs.dmp.diff_match_patch.patch_obj]
+    :raise PatchDecodeError: данные повреждены или записаны неизвестной версией формата
+    """
+    if not data:
+        raise PatchDecodeError('empty patch data')
+    if ord(data[0]) != VERSION:
+        raise PatchDecodeError('unsupported patch format version {0}'.format(ord(data[0])))
+    count, pos = _read_varint(data, 1)
+    patches = []
+    for _ in xrange(count):
+        patch = patch_obj()
+        patch.start1, pos = _read_varint(data, pos)
+        patch.start2, pos = _read_varint(data, pos)
+        patch.length1, pos = _read_varint(data, pos)
+        patch.length2, pos = _read_varint(data, pos)
+        diffs_count, pos = _read_varint(data, pos)
+        for _ in xrange(diffs_count):
+            if pos >= len(data):
+                raise PatchDecodeError('unexpected end of data while reading diff')
+            op = _BYTE_TO_OP.get(ord(data[pos]))
+            if op is None:
+                raise PatchDecodeError('unknown diff operation {0}'.format(ord(data[pos])))
+            size, pos = _read_varint(data, pos + 1)
+            if pos + size > len(data):
+                raise PatchDecodeError('unexpected end of data while reading diff text')
+            patch.diffs.append((op, data[pos:pos + size].decode('utf-8')))
+            pos += size
+        patches.append(patch)
+    if pos != len(data):
+        raise PatchDecodeError('trailing data after {0} patches'.format(count))
+    return patches
@@ -1,22 +1,96 @@
 # coding=utf-8
 from twisted.internet import defer
-from twisted.protocols.amp import Command, Unicode, Float, Boolean
-from exceptions import NoTextAvailableException, PatchIsNotApplicableException
+from twisted.protocols.amp import Command, Argument, Unicode, Float, Boolean, String, ListOf, Integer
+from exceptions import NoTextAvailableException, PatchIsNotApplicableException, TransferExpiredException, \
+    WrongDocumentException
+from codec import encode_patches, decode_patches
 
 __author__ = 'snowy'
 
 
 class GetTextCommand(Command):
-    response = [('text', Unicode())]
-    errors = {NoTextAvailableException: 'Невозможно получить текст'}
+    """
+    Получить текст документа. document - идентификатор документа на координаторе, обслуживающем несколько
+    документов (None - документ по умолчанию)
+    """
+    arguments = [('document', Unicode(optional=True))]
+    response = [('text', Unicode()), ('revision', Integer(optional=True))]
+    errors = {
+        NoTextAvailableException: 'Невозможно получить текст',
+        WrongDocumentException: 'Соединение уже открыто для другого документа'
+    }
+
+
+class GetTextChunkCommand(Command):
+    """
+    Получить кусок текста документа, начиная с offset. Первый запрос (без transfer_id) фиксирует текст документа
+    на момент начала передачи, последующие читают этот же снимок
+    """
+    arguments = [('transfer_id', String(optional=True)), ('offset', Integer()), ('document', Unicode(optional=True))]
+    response = [('transfer_id', String()), ('chunk', Unicode()), ('length', Integer()),
+                ('revision', Integer(optional=True))]
+    errors = {
+        NoTextAvailableException: 'Невозможно получить текст',
+        TransferExpiredException: 'Передача устарела, начните заново',
+        WrongDocumentException: 'Соединение уже открыто для другого документа'
+    }
+
+
+class PatchChunkCommand(Command):
+    """
+    Кусок сериализованного патча, который не помещается в одно значение AMP
+    """
+    arguments = [('transfer_id', String()), ('offset', Integer()), ('chunk', String()), ('length', Integer()),
+                 ('document', Unicode(optional=True))]
+    response = [('offset', Integer())]
+    errors = {WrongDocumentException: 'Соединение уже открыто для другого документа'}
+
+
+class ResyncCommand(Command):
+    """
+    Координатор перестал отправлять патчи пиру, который не успевал их принимать. Пир должен загрузить текст заново
+    """
+    response = []
 
 
 class Patch(Unicode):
     pass
 
 
+class BinaryPatch(Argument):
+    """
+    Список patch_obj в бинарном формате core.codec
+    """
+
+    def toString(self, inObject):
+        if isinstance(inObject, str):
+            # уже сериализован (например, один раз для всех получателей)
+            return inObject
+        return encode_patches(inObject)
+
+    def fromString(self, inString):
+        return decode_patches(inString)
+
+
+PATCH_FORMAT_TEXT = 'text'
+PATCH_FORMAT_BINARY = 'binary-v1'
+SUPPORTED_PATCH_FORMATS = [PATCH_FORMAT_BINARY, PATCH_FORMAT_TEXT]
+"""Форматы патчей в порядке предпочтения"""
+
+
+class NegotiatePatchFormatCommand(Command):
+    """
+    Выбрать формат патчей для соединения. Пир, который не знает этой команды, работает только с PATCH_FORMAT_TEXT
+    """
+    arguments = [('formats', ListOf(String()))]
+    response = [('format', String())]
+
+
 class ApplyPatchCommand(Command):
-    arguments = [('patch', Patch()), ('timestamp', Float())]
+    """
+    Патч от координатора. revision - номер ревизии документа, которую получает координатор после этого патча
+    """
+    arguments = [('patch', Patch()), ('timestamp', Float()), ('revision', Integer(optional=True))]
     response = [('succeed', Boolean())]
     default_succeed_response = defer.succeed({'succeed': True})
     no_work_is_done_response = defer.succeed({'succeed': None, 'no_work_is_done': True})  # todo: review no work is done
@@ -27,3 +101,15 @@ class ApplyPatchCommand(Command):
     requiresAnswer = True
 
 
+class ApplyBinaryPatchCommand(ApplyPatchCommand):
+    arguments = [('patch', BinaryPatch()), ('timestamp', Float()), ('revision', Integer(optional=True))]
+
+
+class ApplyChunkedPatchCommand(ApplyPatchCommand):
+    """
+    Применить патч, переданный заранее кусками PatchChunkCommand
+    """
+    arguments = [('transfer_id', String()), ('patch_format', String()), ('timestamp', Float()),
+                 ('revision', Integer(optional=True))]
+    errors = dict(ApplyPatchCommand.errors)
+    errors[TransferExpiredException] = 'Передача патча не завершена'
@@ -5,9 +5,12 @@
 """
 __author__ = 'snowy'
 import logging
+import os
+import uuid
+from collections import deque
 
-from twisted.protocols.amp import CommandLocator, AMP, UnknownRemoteError
-from twisted.internet import defer
+from twisted.protocols.amp import CommandLocator, AMP, UnknownRemoteError, UnhandledCommand, COMMAND
+from twisted.internet import defer, task
 from twisted.internet.endpoints import serverFromString, clientFromString
 from twisted.internet.protocol import Factory, ClientFactory, ServerFactory
 
@@ -17,6 +20,15 @@ import history
 from command import *
 from exceptions import *
 from other import *
+from text import RopeText
+from codec import encode_patches, decode_patches
+import transfer
+import oplog
+from outbound import OutboundBatch
+from broadcast import serialize_command, PeerQueue
+from documents import DocumentRegistry, DocumentStore, DEFAULT_DOCUMENT
+import workers
+from inverse import InversePatch
 from libs.dmp import diff_match_patch
 
 
@@ -28,6 +40,17 @@ class CannotConnectToNTPServerException(Exception):
 
 
 class DiffMatchPatchAlgorithm(CommandLocator):
+    text_model_factory = RopeText
+    """Класс модели текста (core.text.RopeText, core.text.FlatText)"""
+    max_in_flight = 2
+    """Сколько пачек локальных патчей может одновременно ждать ответа координатора"""
+    flush_size = 4096
+    """Объем пачки (символов в патчах), после которого она отправляется, не дожидаясь flush_delay"""
+    flush_delay = 0.2
+    """Сколько секунд пачка копит патчи, пока координатор отвечает на предыдущие"""
+    diff_timeout = 0.05
+    """Сколько секунд может считаться дифф локальных изменений, после этого остаток берется заменой целиком"""
+
     def __init__(self, history_line, initialText='', clientProtocol=None, name=''):
         """
         Основной локатор-алгоритм, действующий только с моделью текста
@@ -38,12 +61,48 @@ class DiffMatchPatchAlgorithm(CommandLocator):
         """
         self.name = name
         self.clientProtocol = clientProtocol
-        self.currentText = initialText
+        # формат патчей, о котором договорились с координатором (см. negotiate_patch_format)
+        self.patch_format = PATCH_FORMAT_TEXT
+        self.text_model = self.text_model_factory(initialText)
+        # ревизия координатора, до которой включительно текст известен (None - координатор не ведет ревизии)
+        self.revision = None
+        # идентификатор документа на координаторе (None - документ по умолчанию)
+        self.document = None
+        # локальные патчи, ответ на которые еще не пришел, включая неотправленные (oplog.Operation)
+        self.pending_operations = deque()
+        # пачки неотправленных локальных патчей (outbound.OutboundBatch), пополняется только последняя
+        self.outbound = deque()
+        self.in_flight = 0
+        # IReactorTime для отложенной отправки пачек (задает Application); None - пачки ждут только ответов
+        self.clock = None
+        self._flush_call = None
+        # workers.Executor для больших диффов и патчей (задает Application); None - все считается в потоке реактора
+        self.executor = None
+        # загрузка текста координатора после неудачного RECOVERY (см. resync) и патчи, пришедшие во время нее
+        self.resync_transfer = None
+        self.postponed_patches = []
+        # снимки текста, которые отдаются по частям (GetTextChunkCommand)
+        self.outgoing_transfers = transfer.Transfers()
+        # патчи, которые принимаются по частям (PatchChunkCommand)
+        self.incoming_transfers = transfer.Transfers()
+        # diff_timeout ограничивает только дифф локальных изменений (make_patches): дифф неточных совпадений
+        # patch_apply остается с Diff_Timeout по умолчанию
         self.dmp = diff_match_patch()
         self.history = history_line
         self.time_machine = history.TimeMachine(history_line, self)
         self.logger = ApplicationSpecificAdapter(logger, {'name': name})
 
+    @property
+    def currentText(self):
+        """
+        Плоская строка текущего текста. Строится по модели только при обращении
+        """
+        return self.text_model.text
+
+    @currentText.setter
+    def currentText(self, text):
+        self.text_model = self.text_model_factory(text)
+
     @property
     def local_text(self):
         return self.currentText
@@ -68,82 +127,462 @@ class DiffMatchPatchAlgorithm(CommandLocator):
             self.logger.debug('client protocol is None')
             return ApplyPatchCommand.no_work_is_done_response
 
-        patches = self.dmp.patch_make(self.currentText, nextText)
+        if self.executor is not None and self.executor.offloads(self, len(self.currentText) + len(nextText)):
+            # большой дифф считается в процессе пула; правки документа, пришедшие за ним, ждут его в очереди
+            return self.executor.serialize(self, self._diff_offloaded, nextText).addCallback(lambda boxed: boxed[0])
+        return self._commit_text_change(self.make_patches(self.currentText, nextText), nextText)
+
+    def _diff_offloaded(self, nextText):
+        """
+        Дифф local_onTextChanged через executor
+        :return: defer.Deferred со списком из одного элемента - результата local_onTextChanged.
+        Очередь документа ждет только дифф, а не ответ координатора
+        """
+        model = self.text_model
+        before = model.text
+
+        def _diffed(result):
+            patches, optimal = result
+            if self.clientProtocol is None:
+                return [{'succeed': None, 'no_work_is_done': True}]
+            if self.text_model is not model:
+                # текст заменен (resync), пока считался дифф
+                patches = self.make_patches(self.currentText, nextText)
+            elif not optimal:
+                self.logger.debug('diff is cut by time budget, patch is not minimal')
+            if not patches:
+                return [{'succeed': None, 'no_work_is_done': True}]
+            return [self._commit_text_change(patches, nextText)]
+
+        return self.executor.run(len(before) + len(nextText), workers.make_patches_job,
+                                 workers.dmp_settings(self.dmp), before, nextText, self.diff_timeout) \
+            .addCallback(_diffed)
+
+    def _commit_text_change(self, patches, nextText):
         if not patches:
             return ApplyPatchCommand.no_work_is_done_response
         timestamp = self.time_machine.get_current_timestamp()
-        self._prepare_and_commit_on_local_changes(patches, nextText, timestamp)
+        self._commit_on_local_changes(patches, timestamp)
+        batch = self._open_batch()
         self.currentText = nextText
-        serialized = self.dmp.patch_toText(patches)
-        if not serialized:
+        return self._enqueue_local_patches(batch, patches, timestamp)
+
+    def expand_region(self, start, end, step=256):
+        """
+        Расширить область изменений до границ строк модели, чтобы команды, меняющие строки целиком
+        (отступы, комментирование), гарантированно попали в область
+        :param start: int начало области в координатах модели текста
+        :param end: int конец области в координатах модели текста
+        :param step: int по сколько символов читать модель в поисках перевода строки
+        :return: tuple (start, end)
+        """
+        model = self.text_model
+        while start > 0:
+            found = model.slice(max(0, start - step), start).rfind('\n')
+            if found != -1:
+                start = max(0, start - step) + found + 1
+                break
+            start = max(0, start - step)
+        while end < len(model):
+            found = model.slice(end, end + step).find('\n')
+            if found != -1:
+                end += found
+                break
+            end = min(len(model), end + step)
+        return start, end
+
+    def local_onRegionChanged(self, start, end, replacement):
+        """
+        Как local_onTextChanged, но изменения известны заранее: текст модели [start:end] заменен на replacement.
+        Дифф считается только по области изменений (с запасом под контекст патча), поэтому стоимость зависит
+        от размера правки, а не от размера документа.
+        :rtype : defer.Deferred с результатом команды ApplyPatchCommand
+        :param start: int начало области в координатах модели текста
+        :param end: int конец области в координатах модели текста
+        :param replacement: unicode новый текст области
+        """
+        if self.clientProtocol is None:
+            self.logger.debug('client protocol is None')
+            return ApplyPatchCommand.no_work_is_done_response
+
+        model = self.text_model
+        # запас нужен patch_addContext, который расширяет контекст патча до уникальности
+        margin = self.dmp.Match_MaxBits
+        window_start = max(0, start - margin)
+        window_end = min(len(model), end + margin)
+        before = model.slice(window_start, window_end)
+        after = before[:start - window_start] + replacement + before[end - window_start:]
+        patches = self.make_patches(before, after)
+        if not patches:
             return ApplyPatchCommand.no_work_is_done_response
-        self.logger.debug('sending patch:\n<patch>\n%s</patch>', serialized)
+        for patch in patches:
+            patch.start1 += window_start
+            patch.start2 += window_start
+        timestamp = self.time_machine.get_current_timestamp()
+        self._commit_on_local_changes(patches, timestamp)
+        batch = self._open_batch()
+        model.replace(start, end, replacement)
+        return self._enqueue_local_patches(batch, patches, timestamp)
+
+    def make_patches(self, before, after):
+        """
+        Патч между двумя версиями текста.
+        Дифф ограничен diff_timeout: большая вставка не останавливает реактор, но может дать не минимальный патч
+        :param before: unicode текст до изменения
+        :param after: unicode текст после изменения
+        :return: list [libs.dmp.diff_match_patch.patch_obj]
+        """
+        patches, optimal = workers.make_patches(self.dmp, before, after, self.diff_timeout)
+        if not optimal:
+            self.logger.debug('diff is cut by time budget, patch is not minimal')
+        return patches
+
+    def _open_batch(self):
+        """
+        Пачка, в которую попадет следующий локальный патч. Вызывается до изменения модели текста
+        :return: OutboundBatch
+        """
+        if not self.outbound or self.outbound[-1].sealed:
+            created = self.clock.seconds() if self.clock is not None else None
+            self.outbound.append(OutboundBatch(self.text_model.copy(), self.revision, created))
+        return self.outbound[-1]
+
+    def _seal_batch(self):
+        """
+        Закрыть пачку перед изменением текста не локальным патчем: патчи пачки сделаны на тексте без этого изменения
+        """
+        if self.outbound and not self.outbound[-1].sealed:
+            self.outbound[-1].seal(self.text_model, self.dmp)
+
+    def _enqueue_local_patches(self, batch, patches, timestamp):
+        operation = oplog.Operation(self.revision, self, patches)
+        self.pending_operations.append(operation)
+        result = batch.add(operation, timestamp)
+        self.flush()
+        return result
+
+    def _batch_is_ready(self, batch):
+        if batch.sealed or batch.size >= self.flush_size:
+            return True
+        return self.clock is not None and self.clock.seconds() - batch.created >= self.flush_delay
+
+    def flush(self, force=False):
+        """
+        Отправить пачки локальных патчей. Пока координатор не ответил ни на одну пачку, пачка уходит сразу;
+        иначе - если есть свободное место (max_in_flight) и пачка набрала flush_size или ждет дольше flush_delay
+        :param force: отправить все пачки сразу (например, перед загрузкой текста координатора)
+        """
+        while self.outbound and (force or self.in_flight < self.max_in_flight):
+            batch = self.outbound[0]
+            if not force and self.in_flight and not self._batch_is_ready(batch):
+                self._schedule_flush(batch)
+                break
+            self.outbound.popleft()
+            if not batch.sealed:
+                batch.seal(self.text_model, self.dmp)
+            self._send_batch(batch)
+
+    def _schedule_flush(self, batch):
+        if self.clock is None or self._flush_call is not None:
+            return
+
+        def _flush():
+            self._flush_call = None
+            self.flush()
+
+        delay = max(0, batch.created + self.flush_delay - self.clock.seconds())
+        self._flush_call = self.clock.callLater(delay, _flush)
+
+    def _send_batch(self, batch):
+        patches = batch.patches
+        if not patches:
+            # патчи пачки отменили друг друга
+            self._acknowledge_batch(batch)
+            batch.resolve({'succeed': None, 'no_work_is_done': True})
+            return
+        self.logger.debug('sending patch of %d local patches:\n<patch>\n%s</patch>', len(batch),
+                          ''.join([str(patch) for patch in patches]))
+        self.in_flight += 1
+
+        def _acknowledged(result):
+            self.in_flight -= 1
+            self._acknowledge_batch(batch)
+            return result
+
+        def _patch_accepted_case(response):
+            self.advance_revision(response.get('revision'))
+            return response
 
         def _patch_rejected_case(failure):
             failure.trap(PatchIsNotApplicableException)
             self.logger.warning(str(failure))
             return {'succeed': False}
 
-        return self.clientProtocol.callRemote(TryApplyPatchCommand, patch=serialized, timestamp=timestamp) \
-            .addErrback(_patch_rejected_case).addErrback(self._unknown_coordinators_error_case)
+        def _next(ignore):
+            self.flush()
+
+        # патчи пачки сделаны на ревизии ее первого патча; более поздние патчи координатора
+        # он сам перенесет через них
+        self.send_patch(self.clientProtocol, TRY_APPLY_COMMANDS, patches, batch.timestamp, self.patch_format,
+                        base_revision=batch.base_revision, document=self.document) \
+            .addBoth(_acknowledged) \
+            .addCallbacks(_patch_accepted_case, _patch_rejected_case).addErrback(self._unknown_coordinators_error_case) \
+            .addBoth(batch.resolve).addBoth(_next)
+
+    def _acknowledge_batch(self, batch):
+        # координатор отвечает на патчи в порядке их получения
+        for operation in batch.operations:
+            if self.pending_operations and self.pending_operations[0] is operation:
+                self.pending_operations.popleft()
+
+    def advance_revision(self, revision):
+        """
+        Запомнить ревизию координатора, которую получил известный нам текст
+        :param revision: int или None, если координатор не сообщил ревизию
+        """
+        if revision is not None and (self.revision is None or revision > self.revision):
+            self.revision = revision
+
+    def send_patch(self, proto, commands, patch_objects, timestamp, patch_format, serialized=None, **kwargs):
+        """
+        Отправить патч командой из commands, подходящей для формата. Патч в бинарном формате, который не помещается
+        в одно значение AMP, передается по частям
+        :param proto: AMP протокол получателя
+        :param commands: dict формат -> команда (TRY_APPLY_COMMANDS, APPLY_COMMANDS)
+        :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj]
+        :param patch_format: формат, о котором договорились с получателем
+        :param serialized: патч, уже сериализованный в patch_format (или None)
+        :param kwargs: остальные аргументы команды (base_revision, revision, document)
+        :return: defer.Deferred с ответом команды
+        """
+        if patch_format == PATCH_FORMAT_BINARY:
+            payload = serialized if serialized is not None else encode_patches(patch_objects)
+            if len(payload) > transfer.MAX_PATCH_VALUE_LENGTH:
+                return transfer.upload(proto, payload, document=kwargs.get('document')).addCallback(
+                    lambda transfer_id: proto.callRemote(commands[CHUNKED], transfer_id=transfer_id,
+                                                         patch_format=patch_format, timestamp=timestamp, **kwargs))
+        else:
+            # пиры, которые не договаривались о формате, не умеют принимать патч по частям
+            payload = serialized if serialized is not None else self.dmp.patch_toText(patch_objects)
+        return proto.callRemote(commands[patch_format], patch=payload, timestamp=timestamp, **kwargs)
+
+    def take_chunked_patch(self, transfer_id, patch_format):
+        """
+        Забрать патч, принятый по частям
+        :return: list [libs.dmp.diff_match_patch.patch_obj]
+        """
+        payload = transfer.take_received(self.incoming_transfers, transfer_id)
+        if patch_format == PATCH_FORMAT_BINARY:
+            return decode_patches(payload)
+        return self.dmp.patch_fromText(payload)
+
+    def negotiate_patch_format(self, client_proto):
+        """
+        Договориться с координатором о формате патчей. Координатор старой версии не знает
+        NegotiatePatchFormatCommand, с ним остается PATCH_FORMAT_TEXT
+        :param client_proto: AMP протокол соединения с координатором
+        :return: defer.Deferred с аргументом client_proto
+        """
+
+        def _cb(response):
+            self.patch_format = response['format']
+            self.logger.debug('patch format is %s', self.patch_format)
+            return client_proto
+
+        def _eb(failure):
+            failure.trap(UnhandledCommand)
+            self.patch_format = PATCH_FORMAT_TEXT
+            self.logger.debug('coordinator cannot negotiate patch format, %s is used', self.patch_format)
+            return client_proto
+
+        return client_proto.callRemote(NegotiatePatchFormatCommand, formats=SUPPORTED_PATCH_FORMATS) \
+            .addCallbacks(_cb, _eb)
 
     def _unknown_coordinators_error_case(self, failure):
         self.logger.error("Got unknown coordinators error:{0}", str(failure))
 
-    def _prepare_and_commit_on_remote_apply(self, patch_objects, patchedText, timestamp):
+    def _commit_on_remote_apply(self, patch_objects, backward_patches, timestamp):
         forward = history.HistoryEntry(patch=patch_objects,
                                        timestamp=timestamp,
                                        is_owner=False)
-        backward = history.HistoryEntry(patch=self.dmp.patch_make(patchedText, self.currentText),
+        backward = history.HistoryEntry(patch=backward_patches,
                                         timestamp=timestamp,
                                         is_owner=False)
-        self.history.commit_with_rollback(forward, backward)
+        self.history.commit_with_rollback(forward, backward, self.text_model)
 
-    def remote_applyPatch(self, patch, timestamp):
+    def remote_applyPatch(self, patch, timestamp, revision=None):
         """
         Применить патч в любом случае. Если патч подходит не идеально, то выполняется вначале RECOVERY.
         :param patch: force-патч от координатора
         :param timestamp: время патча
+        :param revision: ревизия координатора после патча (или None)
         :rtype tuple of (response dict, sublime_commands)
         """
         self.logger.debug('remote patch applying:\n<patch>\n%s</patch>', patch)
-        # serialize and try to patch
-        patch_objects = self.dmp.patch_fromText(patch)
-        patchedText, result, commands = self.dmp.patch_apply(patch_objects, self.currentText)
+        return self.remote_applyPatchObjects(self.dmp.patch_fromText(patch), timestamp, revision)
+
+    def remote_applyPatchObjects(self, patch_objects, timestamp, revision=None):
+        """
+        То же, что remote_applyPatch, но патч уже разобран
+        :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj]
+        :param timestamp: время патча
+        :param revision: ревизия координатора после патча (или None)
+        :rtype tuple of (response dict, sublime_commands)
+        """
+        if self.resyncing:
+            # текст вот-вот заменится текстом координатора; патч применится после этого, если его нет в снимке
+            self.postponed_patches.append((patch_objects, timestamp, revision))
+            return {'succeed': True}, []
+        self._seal_batch()
+        if revision is not None and self.pending_operations:
+            # патч сделан координатором на тексте без наших неподтвержденных патчей
+            oplog.rebase(patch_objects, self.pending_operations)
+        # патч применяется к копии модели, чтобы при неудаче текущий текст остался нетронутым
+        patched_model = self.text_model.copy()
+        result, commands = self.dmp.patch_applyInPlace(patch_objects, patched_model)
         if False in result:
             # if failed then recovery
-            commands = self.start_recovery(patch_objects, timestamp)
+            try:
+                commands = self.start_recovery(patch_objects, timestamp)
+            except history.RecoveryFailedException as e:
+                self.logger.warning('recovery failed (%s), text is going to be resynchronized', e)
+                self.resync()
+                self.postponed_patches.append((patch_objects, timestamp, revision))
+                return {'succeed': True}, []
+            self.advance_revision(revision)
             return {'succeed': True}, commands
 
-        before_text = self.currentText
-        self._prepare_and_commit_on_remote_apply(patch_objects, patchedText, timestamp)
-        self.currentText = patchedText
-        self.log_model_text(before_text)
+        before_model = self.text_model
+        # обратный патч - по заменам, которые сделал patch_applyInPlace, без диффа текстов
+        self._commit_on_remote_apply(patch_objects, InversePatch(self.dmp.sublime_applied_patches), timestamp)
+        self.text_model = patched_model
+        self.log_model_text(before_model)
+        self.advance_revision(revision)
 
         return {'succeed': True}, commands
 
+    @property
+    def resyncing(self):
+        return self.resync_transfer is not None
+
+    def resync(self):
+        """
+        Заменить текст текстом координатора. Нужно, когда RECOVERY не нашел точку истории, к которой подходит патч,
+        или обходится дороже бюджета (history.RecoveryBudget). Патчи координатора, пришедшие во время загрузки,
+        применяются после нее, если их нет в снимке
+        :return: defer.Deferred с ответом GetTextCommand
+        """
+        if self.clientProtocol is None:
+            return defer.succeed(None)
+        if self.resyncing:
+            return defer.succeed(None)
+        proto = self.clientProtocol
+        # неотправленные локальные патчи должны попасть в снимок текста координатора
+        self.flush(force=True)
+        text_transfer = self.resync_transfer = transfer.IncomingTransfer()
+
+        def _downloaded(rope):
+            return {'text': rope.text, 'revision': text_transfer.revision}
+
+        def _old_coordinator(failure):
+            failure.trap(UnhandledCommand)
+            return proto.callRemote(GetTextCommand, document=self.document)
+
+        def _failed(failure):
+            self.resync_transfer = None
+            return self._unknown_coordinators_error_case(failure)
+
+        return transfer.download_text(proto, text_transfer, self.document).addCallbacks(_downloaded, _old_coordinator) \
+            .addCallbacks(self._resynced, _failed)
+
+    def _resynced(self, response):
+        # правки, сделанные во время загрузки, не отправлены: они переносятся на текст координатора
+        edited = self.unsynced_local_text()
+        local_patches = self.make_patches(self.currentText, edited) if edited is not None else []
+        # координатор отвечает по порядку, поэтому принятые им наши патчи уже есть в тексте
+        self.pending_operations.clear()
+        self.history.clean()
+        self.local_text = response['text']
+        self.revision = response['revision']
+        self.resync_transfer = None
+        self.logger.info('text is resynchronized with the coordinator at revision %s', self.revision)
+        text = response['text']
+        if local_patches:
+            text = self.dmp.patch_apply(local_patches, text)[0]
+        self.on_resynced(text)
+        if text != response['text']:
+            # до отложенных патчей: их команды считаются по модели, которая должна совпадать с редактором
+            self.local_onTextChanged(text)
+        # патчи без ревизии (координатор их не ведет) отправлены раньше ответа и уже есть в снимке
+        postponed, self.postponed_patches = self.postponed_patches, []
+        for patch_objects, timestamp, revision in postponed:
+            if revision is not None and self.revision is not None and revision > self.revision:
+                self.apply_postponed_patch(patch_objects, timestamp, revision)
+        return response
+
+    def unsynced_local_text(self):
+        """
+        Текст редактора, если в нем есть правки, которых еще нет в модели
+        :return: unicode или None
+        """
+        return None
+
+    def on_resynced(self, text):
+        """
+        Текст заменен текстом координатора
+        :param text: unicode новый текст: текст координатора с перенесенными на него неотправленными правками
+        """
+
+    def apply_postponed_patch(self, patch_objects, timestamp, revision):
+        """
+        Применить патч, отложенный на время загрузки текста координатора
+        """
+        return self.remote_applyPatchObjects(patch_objects, timestamp, revision)
+
     @GetTextCommand.responder
-    def remote_getText(self):
+    def remote_getText(self, document=None):
         if self.local_text is None:
             raise NoTextAvailableException()
-        return {'text': self.local_text}
+        return {'text': self.local_text, 'revision': self.revision}
+
+    @GetTextChunkCommand.responder
+    def remote_getTextChunk(self, transfer_id, offset, document=None):
+        if transfer_id is None:
+            if self.local_text is None:
+                raise NoTextAvailableException()
+            # строки неизменяемы, поэтому снимок - это просто ссылка на текущий текст
+            transfer_id = self.outgoing_transfers.put((self.local_text, self.revision))
+        text, revision = self.outgoing_transfers.get(transfer_id)
+        chunk = text[offset:offset + transfer.TEXT_CHUNK_SIZE]
+        if offset + len(chunk) >= len(text):
+            self.outgoing_transfers.pop(transfer_id)
+        return {'transfer_id': transfer_id, 'chunk': chunk, 'length': len(text), 'revision': revision}
+
+    @PatchChunkCommand.responder
+    def remote_patchChunk(self, transfer_id, offset, chunk, length, document=None):
+        return transfer.receive_chunk(self.incoming_transfers, transfer_id, offset, chunk, length)
+
+    @ResyncCommand.responder
+    def remote_resync(self):
+        self.resync()
+        return {}
 
     def log_failed_apply_patch(self, patch):
         self.logger.debug('remote patch is not applied:\n<patch>\n%s</patch>', patch)
 
-    def _prepare_and_commit_on_local_changes(self, patches, nextText, timestamp):
+    def _commit_on_local_changes(self, patches, timestamp):
         forward = history.HistoryEntry(patch=patches,
                                        timestamp=timestamp,
                                        is_owner=True)
-        backward = history.HistoryEntry(patch=self.dmp.patch_make(nextText, self.currentText),
+        backward = history.HistoryEntry(patch=InversePatch(patches),
                                         timestamp=timestamp,
                                         is_owner=True)
-        self.history.commit_with_rollback(forward, backward)
-        return
+        self.history.commit_with_rollback(forward, backward, self.text_model)
 
-    def log_model_text(self, before_text):
-        self.logger.debug('\n<before.model>%s</before.model>\n<after.model>%s</after.model>', before_text,
-                          self.currentText)
+    def log_model_text(self, before_model):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('\n<before.model>%s</before.model>\n<after.model>%s</after.model>', before_model.text,
+                              self.currentText)
 
     def start_recovery(self, patch_objects, timestamp):
         self.log_failed_apply_patch('\n'.join([str(patch) for patch in patch_objects]))
@@ -178,8 +617,13 @@ class Application(object):
         self.clientFactory = None
         self.serverPort = None
         self.clientProtocol = None
+        # незавершенная загрузка начального текста, продолжается после переподключения
+        self.text_transfer = None
         self.history_line = history.HistoryLine(self)
+        # очереди правок документов и пул процессов для больших диффов, общие для всех алгоритмов приложения
+        self.executor = workers.Executor(reactor)
         self.locator = DiffMatchPatchAlgorithm(self.history_line, clientProtocol=self.clientProtocol, name=name)
+        self.locator.executor = self.executor
 
     @property
     def serverPortNumber(self):
@@ -221,6 +665,7 @@ class Application(object):
 
     def setClientProtocol(self, proto):
         self.locator.clientProtocol = proto
+        self.locator.clock = self.reactor
         return proto
 
     def setUpServerFromCfg(self, cfg):
@@ -246,10 +691,12 @@ class Application(object):
         :param clientConnString: str
         :rtype : defer.Deferred с аргументом self.clientProtocol
         """
-        return self._initClient(clientConnString).addCallback(self.init_first_text)
+        return self._initClient(clientConnString).addCallback(self.locator.negotiate_patch_format) \
+            .addCallback(self.init_first_text)
 
     def _got_first_text_cb(self, response):
         self.algorithm.local_text = response['text']
+        self.algorithm.revision = response.get('revision')
         return response
 
     def init_first_text(self, client_proto):
@@ -259,7 +706,22 @@ class Application(object):
             self.tearDown()
             return failure  # because we cannot do anything at this point
 
-        return client_proto.callRemote(GetTextCommand).addCallbacks(self._got_first_text_cb, _eb) \
+        def _downloaded(rope):
+            revision = self.text_transfer.revision
+            self.text_transfer = None
+            return {'text': rope.text, 'revision': revision}
+
+        def _old_coordinator(failure):
+            # координатор не умеет отдавать текст по частям
+            failure.trap(UnhandledCommand)
+            self.text_transfer = None
+            return client_proto.callRemote(GetTextCommand, document=self.algorithm.document)
+
+        if self.text_transfer is None:
+            self.text_transfer = transfer.IncomingTransfer()
+        return transfer.download_text(client_proto, self.text_transfer, self.algorithm.document) \
+            .addCallbacks(_downloaded, _old_coordinator) \
+            .addCallbacks(self._got_first_text_cb, _eb) \
             .addCallback(lambda ignore: client_proto)  # make sure that result value is still client_proto
 
     def setUpClientFromCfg(self, cfg):
@@ -283,78 +745,331 @@ class Application(object):
 
 
 class TryApplyPatchCommand(Command):
-    arguments = [('patch', Patch()), ('timestamp', Float())]
-    response = [('succeed', Boolean())]
+    """
+    Патч пира. base_revision - ревизия документа, на основе которой сделан патч; в ответе revision - ревизия,
+    которую получил документ после принятия патча
+    """
+    arguments = [('patch', Patch()), ('timestamp', Float()), ('base_revision', Integer(optional=True)),
+                 ('document', Unicode(optional=True))]
+    response = [('succeed', Boolean()), ('revision', Integer(optional=True))]
     errors = {
         PatchIsNotApplicableException: 'Патч не может быть применен. '
                                        'Сделайте пул, зарезолвите конфликты, потом сделайте пуш',
-        UnicodeEncodeError: 'Unicode не поддерживается'  # todo: review unicode
+        UnicodeEncodeError: 'Unicode не поддерживается',  # todo: review unicode
+        WrongDocumentException: 'Соединение уже открыто для другого документа'
     }
 
 
+class TryApplyBinaryPatchCommand(TryApplyPatchCommand):
+    arguments = [('patch', BinaryPatch()), ('timestamp', Float()), ('base_revision', Integer(optional=True)),
+                 ('document', Unicode(optional=True))]
+
+
+class TryApplyChunkedPatchCommand(TryApplyPatchCommand):
+    arguments = [('transfer_id', String()), ('patch_format', String()), ('timestamp', Float()),
+                 ('base_revision', Integer(optional=True)), ('document', Unicode(optional=True))]
+    errors = dict(TryApplyPatchCommand.errors)
+    errors[TransferExpiredException] = 'Передача патча не завершена'
+
+
+CHUNKED = 'chunked'
+TRY_APPLY_COMMANDS = {
+    PATCH_FORMAT_TEXT: TryApplyPatchCommand,
+    PATCH_FORMAT_BINARY: TryApplyBinaryPatchCommand,
+    CHUNKED: TryApplyChunkedPatchCommand,
+}
+APPLY_COMMANDS = {
+    PATCH_FORMAT_TEXT: ApplyPatchCommand,
+    PATCH_FORMAT_BINARY: ApplyBinaryPatchCommand,
+    CHUNKED: ApplyChunkedPatchCommand,
+}
+
+
 class CoordinatorLocatorDecorator(CommandLocator):
-    def __init__(self, to_be_decorated_locator):
+    def __init__(self, documents):
+        """
+        Координатор. Лишает права конфликтовать. Соединение относится к документу, указанному в первой
+        его команде (без идентификатора - документ по умолчанию)
+        :param documents: core.documents.DocumentRegistry документы координатора, общие для всех соединений
+        """
+        self.documents = documents
+        # документ этого соединения (core.documents.Document)
+        self.document = None
+        # протокол соединения этого локатора (задается фабрикой)
+        self.protocol = None
+        # очередь патчей координатора для пира этого соединения (создается вместе с document)
+        self.queue = None
+        # формат патчей, который понимает пир этого соединения
+        self.patch_format = PATCH_FORMAT_TEXT
+        self.logger = ApplicationSpecificAdapter(logger, {'name': 'Coordinator'})
+
+    @property
+    def decorated_locator(self):
         """
-        Координатор. Лишает права конфликтовать
-        :param to_be_decorated_locator: DiffMatchPatchAlgorithm
+        :return: CoordinatorDiffMatchPatchAlgorithm документа этого соединения
         """
-        assert isinstance(to_be_decorated_locator,
-                          DiffMatchPatchAlgorithm), 'current version of locator must be DiffMatchPatchAlgorithm'
-        self.peers = []
-        self.decorated_locator = to_be_decorated_locator
-        # self.main_locator должен строго относиться к нарушению контекста патча.
-        # Поэтому необходимо включить set_perfect_matching
-        self.set_perfect_matching()
-        self.logger = ApplicationSpecificAdapter(logger, {'name': self.decorated_locator.name})
+        return self.document.algorithm
+
+    @property
+    def group(self):
+        return self.document.group
+
+    def open_document(self, document_id):
+        """
+        Найти документ команды и, если это первая команда соединения, присоединиться к его участникам
+        :param document_id: unicode или None (документ по умолчанию)
+        :return: CoordinatorDiffMatchPatchAlgorithm
+        """
+        document_id = DEFAULT_DOCUMENT if document_id is None else document_id
+        if self.document is None:
+            self.document = self.documents.open(document_id)
+            self.queue = PeerQueue(self.decorated_locator, self._send_push, self._drop)
+            self.protocol.transport.registerProducer(self.queue, True)
+            self.document.group.join(self.protocol)
+            self.logger = ApplicationSpecificAdapter(logger, {'name': self.decorated_locator.name})
+        elif self.document.document_id != document_id:
+            raise WrongDocumentException('connection is opened for document {0!r}, not {1!r}'.format(
+                self.document.document_id, document_id))
+        else:
+            self.document.last_activity = self.documents.clock()
+        return self.decorated_locator
+
+    def close_document(self):
+        if self.document is not None:
+            self.document.group.leave(self.protocol)
+            self.document.last_activity = self.documents.clock()
 
     @GetTextCommand.responder
-    def get_text(self):
-        return self.decorated_locator.remote_getText()
+    def get_text(self, document):
+        algorithm = self.open_document(document)
+        # патчи из очереди уже есть в тексте, который получит пир
+        return self.queue.restart().addCallback(lambda ignore: algorithm.remote_getText())
+
+    @GetTextChunkCommand.responder
+    def get_text_chunk(self, transfer_id, offset, document):
+        algorithm = self.open_document(document)
+        if transfer_id is None:
+            return self.queue.restart().addCallback(lambda ignore: algorithm.remote_getTextChunk(transfer_id, offset))
+        return algorithm.remote_getTextChunk(transfer_id, offset)
+
+    @PatchChunkCommand.responder
+    def patch_chunk(self, transfer_id, offset, chunk, length, document):
+        return self.open_document(document).remote_patchChunk(transfer_id, offset, chunk, length)
+
+    @NegotiatePatchFormatCommand.responder
+    def negotiate_patch_format(self, formats):
+        for patch_format in formats:
+            if patch_format in SUPPORTED_PATCH_FORMATS:
+                self.patch_format = patch_format
+                break
+        else:
+            self.patch_format = PATCH_FORMAT_TEXT
+        return {'format': self.patch_format}
 
     @TryApplyPatchCommand.responder
-    def try_apply_patch(self, patch, timestamp):
+    def try_apply_patch(self, patch, timestamp, base_revision, document):
+        return self._try_apply_patch_objects(self.open_document(document).dmp.patch_fromText(patch), timestamp,
+                                             base_revision, text=patch)
+
+    @TryApplyBinaryPatchCommand.responder
+    def try_apply_binary_patch(self, patch, timestamp, base_revision, document):
+        self.open_document(document)
+        return self._try_apply_patch_objects(patch, timestamp, base_revision)
+
+    @TryApplyChunkedPatchCommand.responder
+    def try_apply_chunked_patch(self, transfer_id, patch_format, timestamp, base_revision, document):
+        return self._try_apply_patch_objects(self.open_document(document).take_chunked_patch(transfer_id, patch_format),
+                                             timestamp, base_revision)
+
+    def _try_apply_patch_objects(self, patch_objects, timestamp, base_revision, text=None):
+        """
+        :param base_revision: ревизия, на основе которой пир сделал патч. Если после нее были приняты патчи
+        других пиров, патч переносится через них (oplog.rebase). None - пир не знает ревизий, патч применяется как есть
+        """
+        algorithm = self.decorated_locator
+        executor = algorithm.executor
+        if executor is not None and executor.offloads(algorithm, workers.patch_size(patch_objects)):
+            # большой патч применяется в процессе пула; патчи документа, пришедшие за ним, ждут его в очереди
+            return executor.serialize(algorithm, self._apply_offloaded, patch_objects, timestamp, base_revision,
+                                      text).addCallback(lambda boxed: boxed[0])
+        text = self._prepare_patch(patch_objects, base_revision, text)
+        before_model = algorithm.text_model
         # если applyPatch не пройдет, то будет вызвано исключение и
         # вызывающий пир будет уведомлен о PatchIsNotApplicableException
-        self.decorated_locator.remote_applyPatch(patch, timestamp)
+        algorithm.remote_applyPatchObjects(patch_objects, timestamp)
+        return self._accept_patch(patch_objects, timestamp, before_model, text)
+
+    def _apply_offloaded(self, patch_objects, timestamp, base_revision, text):
+        """
+        То же, что _try_apply_patch_objects, через executor
+        :return: defer.Deferred со списком из одного элемента - ответа пиру (defer.Deferred).
+        Очередь документа ждет только применение патча, а не рассылку
+        """
+        algorithm = self.decorated_locator
+        text = self._prepare_patch(patch_objects, base_revision, text)
+        before_model = algorithm.text_model
+        return algorithm.apply_offloaded(patch_objects, timestamp) \
+            .addCallback(lambda ignore: [self._accept_patch(patch_objects, timestamp, before_model, text)])
+
+    def _prepare_patch(self, patch_objects, base_revision, text):
+        """
+        Перенести патч через патчи других пиров, принятые после base_revision
+        :param text: сериализованный патч в формате PATCH_FORMAT_TEXT или None
+        :return: сериализованный патч или None, если патч изменился
+        """
+        if base_revision is not None:
+            operations = self.decorated_locator.op_log.since(base_revision) or []
+            # свои предыдущие патчи пир уже учел
+            operations = [operation for operation in operations if operation.origin is not self]
+            if operations:
+                self.logger.debug('rebasing patch from revision %d over %d operations', base_revision,
+                                  len(operations))
+                oplog.rebase(patch_objects, operations)
+                text = None
+        # патчи в очереди пира сделаны на тексте без его патча
+        self.queue.seal()
+        return text
+
+    def _accept_patch(self, patch_objects, timestamp, before_model, text):
+        """
+        Зарегистрировать примененный патч и разослать его остальным пирам
+        :param before_model: модель текста до патча
+        :return: defer.Deferred с ответом пиру
+        """
+        revision = self.decorated_locator.commit_operation(self, patch_objects)
+        operation = oplog.Operation(revision, self, patch_objects)
         # все остальные пиры должны принять изменения, даже если это противоречит их религии
         # force push
-        for peer in self.peers:
-            peer.callRemote(ApplyPatchCommand, patch=patch, timestamp=timestamp)
-        return {'succeed': True}
+        cache = {PATCH_FORMAT_TEXT: text}
+        for peer in self.group.others(self.protocol):
+            peer.locator.queue.push(operation, timestamp, before_model, cache)
+        # ответ не должен обогнать патчи, которые пир еще не получил
+        return self.queue.when_drained().addCallback(lambda ignore: {'succeed': True, 'revision': revision})
 
-    def add_incoming_connection(self, server_proto):
-        assert hasattr(server_proto, 'callRemote'), 'clientProtocol должен иметь метод callRemote ' \
-                                                    'для того, чтобы можно было отправлять AMP пакеты'
-        self.peers.append(server_proto)
+    def _send_push(self, patch_objects, timestamp, revision, cache):
+        """
+        Отправить патч координатора пиру этого соединения
+        :param cache: dict сериализованный патч, общий для всех пиров, или None
+        :return: defer.Deferred, если патч передается по частям, иначе None
+        """
+        cache = {} if cache is None else cache
+        patch_format = self.patch_format
+        if cache.get(patch_format) is None:
+            cache[patch_format] = encode_patches(patch_objects) if patch_format == PATCH_FORMAT_BINARY \
+                else self.decorated_locator.dmp.patch_toText(patch_objects)
+        if patch_format == PATCH_FORMAT_BINARY and len(cache[patch_format]) > transfer.MAX_PATCH_VALUE_LENGTH:
+            return self.decorated_locator.send_patch(self.protocol, APPLY_COMMANDS, patch_objects, timestamp,
+                                                     patch_format, cache[patch_format], revision=revision)
+        # пакет команды ApplyPatch сериализуется один раз на формат и пишется в транспорт каждого пира
+        box = (patch_format, COMMAND)
+        if box not in cache:
+            cache[box] = serialize_command(APPLY_COMMANDS[patch_format], self.protocol, patch=cache[patch_format],
+                                           timestamp=timestamp, revision=revision)
+        self.protocol.transport.write(cache[box])
+
+    def _drop(self):
+        self.logger.warning('peer is too far behind, it has to download the text again')
 
-    def clean_incoming_connections(self):
-        del self.peers
-        self.peers = []
+        def _eb(failure):
+            if failure.check(UnhandledCommand):
+                # пир старой версии не умеет загружать текст заново
+                self.protocol.transport.loseConnection()
+            else:
+                self.logger.warning('cannot ask peer to resynchronize: %s', failure.getErrorMessage())
 
-    def remove_incoming_connection(self, server_proto):
-        assert hasattr(server_proto, 'callRemote'), 'server_proto должен иметь метод callRemote ' \
-                                                    'для того, чтобы можно было отправлять AMP пакеты'
-        self.peers.remove(server_proto)
+        self.protocol.callRemote(ResyncCommand).addErrback(_eb)
 
-    def set_perfect_matching(self):
-        self.decorated_locator.dmp.Match_Threshold = 0.0
+
+class CoordinatorProtocol(AMP):
+    """
+    Соединение пира с координатором. Закрытое соединение покидает группу рассылки своего документа
+    """
+
+    def connectionLost(self, reason):
+        self.locator.close_document()
+        AMP.connectionLost(self, reason)
 
 
 class CoordinatorDiffMatchPatchAlgorithm(DiffMatchPatchAlgorithm):
+    def __init__(self, history_line, initialText='', clientProtocol=None, name='', revision=0):
+        """
+        :param revision: int ревизия документа (документ загружен с диска)
+        """
+        super(CoordinatorDiffMatchPatchAlgorithm, self).__init__(history_line, initialText=initialText,
+                                                                 clientProtocol=clientProtocol, name=name)
+        # координатор должен строго относиться к нарушению контекста патча
+        self.dmp.Match_Threshold = 0.0
+        self.op_log = oplog.OperationLog(head=revision)
+        self.revision = self.op_log.head
+
+    def commit_operation(self, origin, patch_objects):
+        """
+        Зарегистрировать принятый патч в журнале операций
+        :param origin: CoordinatorLocatorDecorator соединение пира, приславшего патч
+        :return: int новая ревизия документа
+        """
+        self.revision = self.op_log.append(origin, patch_objects)
+        return self.revision
+
+    def apply_offloaded(self, patch_objects, timestamp):
+        """
+        То же, что remote_applyPatchObjects, но патч применяется и обратный патч считается в процессе пула (executor)
+        :return: defer.Deferred, ошибка PatchIsNotApplicableException - патч не подходит к тексту
+        """
+        before_model = self.text_model
+
+        def _applied(result):
+            patched_text, results, backward = result
+            if False in results:
+                self.start_recovery(patch_objects, timestamp)
+            self._commit_on_remote_apply(patch_objects, backward, timestamp)
+            self.text_model = self.text_model_factory(patched_text)
+            self.log_model_text(before_model)
+
+        return self.executor.run(workers.patch_size(patch_objects), workers.apply_patches_job,
+                                 workers.dmp_settings(self.dmp), patch_objects, before_model.text) \
+            .addCallback(_applied)
+
     def start_recovery(self, patch_objects, timestamp):
         raise PatchIsNotApplicableException('Your following patch is rejected:\n<patch>\n{0}</patch>'.format(
             ''.join([str(patch) for patch in patch_objects])))
 
 
 class CoordinatorApplication(Application):
-    def __init__(self, reactor, name='Coordinator', initial_text=''):
+    def __init__(self, reactor, name='Coordinator', initial_text='', storage_directory=None, idle_timeout=600):
+        """
+        Координатор, обслуживающий много документов через одну точку подключения
+        :param initial_text: текст документа по умолчанию
+        :param storage_directory: str каталог, куда выгружаются простаивающие документы (None - не выгружаются).
+        Каждый координатор пишет в свой подкаталог и не читает документы прошлых сессий
+        :param idle_timeout: сколько секунд документ без участников остается в памяти
+        """
         super(CoordinatorApplication, self).__init__(reactor, name=name)
         self.server_ports = []
-        self.decorated_locators = []
         self.beacon = beacon.Beacon(12000, "collaboration-sublime-text")
         self.beacon.daemon = True
-        self.locator = CoordinatorDiffMatchPatchAlgorithm(self.history_line, clientProtocol=self.clientProtocol,
-                                                          name=name, initialText=initial_text)
+        store = DocumentStore(os.path.join(storage_directory, uuid.uuid4().hex)) \
+            if storage_directory is not None else None
+        self.documents = DocumentRegistry(self._create_algorithm, store, idle_timeout, clock=reactor.seconds)
+        self.eviction = task.LoopingCall(self.documents.evict_idle)
+        self.eviction.clock = reactor
+        # документ по умолчанию - для пиров, которые не сообщают идентификатор документа
+        self.locator = self.documents.open(DEFAULT_DOCUMENT, initial_text, pinned=True).algorithm
+        self.history_line = self.locator.history
+
+    def _create_algorithm(self, document_id, text, revision):
+        name = self.name if document_id == DEFAULT_DOCUMENT else u'{0}:{1}'.format(self.name, document_id)
+        algorithm = CoordinatorDiffMatchPatchAlgorithm(history.HistoryLine(self), clientProtocol=self.clientProtocol,
+                                                       name=name, initialText=text, revision=revision)
+        algorithm.executor = self.executor
+        return algorithm
+
+    def open_document(self, document_id, initial_text=''):
+        """
+        Начать обслуживать документ с текстом initial_text. Документ, у которого уже есть участники, не меняется
+        :return: CoordinatorDiffMatchPatchAlgorithm
+        """
+        return self.documents.open(document_id, initial_text).algorithm
 
     def _start_beacon(self):
         self.beacon.start()
@@ -367,10 +1082,10 @@ class CoordinatorApplication(Application):
         """
         self._start_beacon()
         self.history_line.clean()
-        for decorated_locator in self.decorated_locators:
-            decorated_locator.clean_incoming_connections()
         self.serverEndpoint = serverFromString(self.reactor, serverConnString)
-        self.serverFactory = MultipleConnectionServerFactory(locator)
+        self.serverFactory = MultipleConnectionServerFactory(self.documents)
+        if self.documents.store is not None and not self.eviction.running:
+            self.eviction.start(min(self.documents.idle_timeout, 60), now=False)
 
         def connected_cb(port):
             self.server_ports.append(port)
@@ -381,6 +1096,9 @@ class CoordinatorApplication(Application):
     def tearDown(self):
         assert self.clientProtocol is None, 'Coordinator is not a client for any peer'
         del self.beacon
+        if self.eviction.running:
+            self.eviction.stop()
+        self.documents.close()
         d = defer.succeed(None)
         if self.server_ports:
             d = defer.DeferredList([defer.maybeDeferred(serverPort.stopListening) for serverPort in self.server_ports])
@@ -388,29 +1106,18 @@ class CoordinatorApplication(Application):
 
 
 class MultipleConnectionServerFactory(ServerFactory):
-    def __init__(self, coordinator_locator):
+    def __init__(self, documents):
         """
-        Фабрика по созданию протоколов на каджый входящий запрос. У всех локаторов созданных
-        протоколов один и тот же предок - coordinator_locator
-        :param coordinator_locator: DiffMatchPatchAlgorithm основной локатор, который выполняет всю нагрузку по патчингу
+        Фабрика по созданию протоколов на каджый входящий запрос. Все локаторы созданных
+        протоколов работают с одними и теми же документами
+        :param documents: core.documents.DocumentRegistry документы, которые выполняют всю нагрузку по патчингу
         """
-        self.coordinator_locator = coordinator_locator
-        # протокол AMP с локатором CoordinatorLocatorDecorator
-        self.protocol = lambda: AMP(locator=CoordinatorLocatorDecorator(coordinator_locator))
-        self.already_proto = []
-        ":type already_proto: list [AMP]"
+        self.documents = documents
 
     def buildProtocol(self, addr):
-        proto = Factory.buildProtocol(self, addr)
-        for prev_proto in self.already_proto:
-            assert isinstance(prev_proto.locator, CoordinatorLocatorDecorator), 'Каждый локатор должен быть ' \
-                                                                                'декорирован для задания своего ' \
-                                                                                'списка incoming_connections'
-            assert prev_proto.locator.decorated_locator is self.coordinator_locator, 'координирующий ' \
-                                                                                     'локатор должен быть один'
-            prev_proto.locator.add_incoming_connection(proto)
-            proto.locator.add_incoming_connection(prev_proto)
-
-        # add for the next protos
-        self.already_proto.append(proto)
+        # протокол AMP с локатором CoordinatorLocatorDecorator
+        locator = CoordinatorLocatorDecorator(self.documents)
+        proto = CoordinatorProtocol(locator=locator)
+        proto.factory = self
+        locator.protocol = proto
         return proto
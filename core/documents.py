@@ -0,0 +1,152 @@
+# coding=utf-8
+"""
+Документы координатора. Один координатор обслуживает много документов через одну точку подключения:
+у каждого документа свой алгоритм (CoordinatorDiffMatchPatchAlgorithm) и своя группа рассылки.
+Документы без участников, к которым долго не обращались, выгружаются на диск и загружаются при следующем обращении.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import time
+
+from broadcast import BroadcastGroup
+
+__author__ = 'snowy'
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOCUMENT = u''
+"""Документ пиров, которые не сообщают идентификатор документа"""
+
+
+class DocumentStore(object):
+    def __init__(self, directory):
+        """
+        Хранилище выгруженных документов: по файлу на документ. Хранилище принадлежит одной сессии координатора:
+        документы прошлых сессий устарели относительно текстов, которые открываются заново
+        :param directory: str каталог хранилища (создается при необходимости)
+        """
+        self.directory = directory
+
+    def path(self, document_id):
+        # идентификатор документа - произвольная строка, поэтому имя файла - ее хэш
+        return os.path.join(self.directory, hashlib.sha1(document_id.encode('utf-8')).hexdigest() + '.json')
+
+    def save(self, document_id, text, revision):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(document_id)
+        with io.open(path + '.tmp', 'wb') as f:
+            json.dump({'document': document_id, 'text': text, 'revision': revision}, f)
+        # на windows rename не заменяет существующий файл
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def load(self, document_id):
+        """
+        :return: tuple (text, revision) или None, если документ не сохранялся
+        """
+        path = self.path(document_id)
+        if not os.path.exists(path):
+            return None
+        with io.open(path, 'rb') as f:
+            saved = json.load(f)
+        return saved['text'], saved['revision']
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Document(object):
+    def __init__(self, document_id, algorithm, pinned=False):
+        """
+        :param algorithm: CoordinatorDiffMatchPatchAlgorithm состояние документа
+        :param pinned: bool документ никогда не выгружается
+        """
+        self.document_id = document_id
+        self.algorithm = algorithm
+        self.group = BroadcastGroup()
+        self.pinned = pinned
+        self.last_activity = None
+
+
+class DocumentRegistry(object):
+    def __init__(self, algorithm_factory, store=None, idle_timeout=600, clock=time.time):
+        """
+        Документы координатора в памяти
+        :param algorithm_factory: callable (document_id, text, revision) -> CoordinatorDiffMatchPatchAlgorithm
+        :param store: DocumentStore куда выгружаются простаивающие документы (None - документы не выгружаются)
+        :param idle_timeout: сколько секунд документ без участников остается в памяти
+        """
+        self.algorithm_factory = algorithm_factory
+        self.store = store
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.documents = {}
+        ":type documents: dict [unicode, Document]"
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, document_id):
+        return document_id in self.documents
+
+    def __iter__(self):
+        return self.documents.itervalues()
+
+    def open(self, document_id, initial_text=None, pinned=False):
+        """
+        Документ из памяти, с диска или новый
+        :param initial_text: unicode текст, которым документ открывает его владелец (None - документ открывает
+        участник). Текст владельца новее сохраненного: документ без участников создается с ним заново
+        :return: Document
+        """
+        document = self.documents.get(document_id)
+        if document is not None and initial_text is not None:
+            if len(document.group):
+                logger.warning('document %r has participants, its text is kept', document_id)
+            else:
+                pinned = pinned or document.pinned
+                document = None
+        if document is None:
+            saved = None
+            if initial_text is None and self.store is not None:
+                saved = self.store.load(document_id)
+            text, revision = saved if saved is not None else (initial_text or u'', 0)
+            logger.debug('document %r is %s at revision %d', document_id,
+                         'loaded' if saved is not None else 'created', revision)
+            document = self.documents[document_id] = Document(
+                document_id, self.algorithm_factory(document_id, text, revision), pinned)
+        document.pinned = document.pinned or pinned
+        document.last_activity = self.clock()
+        return document
+
+    def evict_idle(self):
+        """
+        Выгрузить на диск документы без участников, к которым не обращались дольше idle_timeout
+        :return: list идентификаторы выгруженных документов
+        """
+        if self.store is None:
+            return []
+        deadline = self.clock() - self.idle_timeout
+        idle = [document for document in self.documents.itervalues()
+                if not document.pinned and not len(document.group) and document.last_activity <= deadline]
+        for document in idle:
+            self._save(document)
+            del self.documents[document.document_id]
+            logger.debug('document %r is evicted', document.document_id)
+        return [document.document_id for document in idle]
+
+    def close(self):
+        """
+        Сессия координатора закончена: выгруженные документы больше не нужны
+        """
+        if self.store is not None:
+            self.store.clear()
+
+    def _save(self, document):
+        self.store.save(document.document_id, document.algorithm.local_text, document.algorithm.revision)
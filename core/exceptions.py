@@ -14,4 +14,16 @@ class PatchIsNotApplicableException(Exception):
 
 
 class ServerPortIsNotInitializedError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class TransferExpiredException(Exception):
+    pass
+
+
+class WrongDocumentException(Exception):
+    pass
+
+
+class JobFailedException(Exception):
+    pass
@@ -0,0 +1,42 @@
+# coding=utf-8
+"""
+Обратные патчи коммитов истории. Откат нужен редко, поэтому обратный патч не считается диффом текстов:
+хранится копия прямого патча, а обратный список libs.dmp.diff_match_patch.patch_obj строится из нее
+(diff_match_patch.patch_invert) только при обращении, за время, пропорциональное размеру патча.
+"""
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+_dmp = diff_match_patch()
+
+
+class InversePatch(object):
+    def __init__(self, patch_objects):
+        """
+        :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj] точный прямой патч: куски по порядку
+        применения, позиция каждого - в тексте, к которому уже применены предыдущие куски (так строит патчи
+        patch_make, а diff_match_patch.sublime_applied_patches описывает так сделанные замены)
+        """
+        # копия, потому что прямой патч могут сдвигать (rebase)
+        self.patch_objects = _dmp.patch_deepCopy(patch_objects)
+
+    def __nonzero__(self):
+        return bool(self.patch_objects)
+
+    def __len__(self):
+        return len(self.patch_objects)
+
+    def __iter__(self):
+        """
+        Куски обратного патча. Прямые куски откатываются от последнего к первому: перед откатом куска текст
+        такой же, как сразу после его применения, поэтому позиция и контекст куска подходят без поиска
+        """
+        return iter(_dmp.patch_invert(self.patch_objects))
+
+    @property
+    def size(self):
+        """
+        Сколько символов текста держит патч
+        """
+        return sum(len(data) for patch in self.patch_objects for _, data in patch.diffs)
@@ -0,0 +1,105 @@
+# coding=utf-8
+"""
+Журнал операций координатора. Каждый принятый патч получает следующий номер ревизии. Пир сообщает ревизию,
+на основе которой сделан его патч, и координатор переносит (rebase) патч через операции других пиров,
+принятые после этой ревизии, вместо того чтобы отклонять его.
+"""
+from collections import deque, namedtuple
+
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+Operation = namedtuple('Operation', ['revision', 'origin', 'patch'])
+
+
+class OperationLog(object):
+    def __init__(self, max_operations=1000, head=0):
+        """
+        :param max_operations: int сколько последних операций хранить для rebase
+        :param head: int ревизия, с которой начинается журнал (документ загружен с диска)
+        """
+        self.operations = deque(maxlen=max_operations)
+        self.head = head
+
+    def append(self, origin, patch_objects):
+        """
+        Зарегистрировать принятый патч
+        :param origin: источник патча (соединение пира)
+        :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj] патч относительно текста ревизии head
+        :return: int новая ревизия
+        """
+        self.head += 1
+        self.operations.append(Operation(self.head, origin, patch_objects))
+        return self.head
+
+    def since(self, revision):
+        """
+        :return: list [Operation] операции после revision или None, если часть из них уже вытеснена из журнала
+        """
+        if revision >= self.head:
+            return []
+        if not self.operations or self.operations[0].revision > revision + 1:
+            return None
+        return [operation for operation in self.operations if operation.revision > revision]
+
+
+def patch_changes(patch_objects):
+    """
+    Изменения патча в координатах исходного текста. Позиция куска патча (patch_make, patch_splitMax) - в тексте,
+    к которому уже применены предыдущие куски, поэтому из нее вычитается их изменение длины
+    :return: list of (start, end, delta) по возрастанию позиций: text[start:end] заменяется текстом длиной
+    end - start + delta
+    """
+    changes = []
+    delta = 0
+    for patch in patch_objects:
+        pos = patch.start1 - delta
+        for op, data in patch.diffs:
+            if op == diff_match_patch.DIFF_EQUAL:
+                pos += len(data)
+            elif op == diff_match_patch.DIFF_DELETE:
+                changes.append((pos, pos + len(data), -len(data)))
+                pos += len(data)
+            else:
+                changes.append((pos, pos, len(data)))
+        delta += patch.length2 - patch.length1
+    return changes
+
+
+def rebase(patch_objects, operations):
+    """
+    Перенести патч через операции, примененные после текста, на котором он сделан. Куски патча только
+    сдвигаются на длину изменений перед ними. Если операция изменила текст внутри куска патча (включая его
+    контекст), кусок просто сдвигается на изменения перед ним, а строгое применение патча решит, подходит ли он.
+    :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj] изменяется на месте
+    :param operations: list [Operation] в порядке ревизий
+    :return: patch_objects
+    """
+    for operation in operations:
+        shift(patch_objects, patch_changes(operation.patch))
+    return patch_objects
+
+
+def shift(patch_objects, changes):
+    """
+    Сдвинуть куски патча на изменения, сделанные на том же тексте, что и патч (см. rebase)
+    :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj] изменяется на месте
+    :param changes: list of (start, end, delta) см. patch_changes
+    :return: patch_objects
+    """
+    # изменение длины от предыдущих кусков переносимого патча: позиция куска в исходном тексте меньше на него
+    own_delta = 0
+    for patch in patch_objects:
+        start = patch.start1 - own_delta
+        own_delta += patch.length2 - patch.length1
+        offset = 0
+        for change_start, change_end, delta in changes:
+            if change_end <= start:
+                offset += delta
+            else:
+                # изменения после куска или пересекающие его не сдвигают кусок
+                break
+        patch.start1 += offset
+        patch.start2 += offset
+    return patch_objects
@@ -0,0 +1,96 @@
+# coding=utf-8
+"""
+Пачки локальных патчей. Пока координатор не ответил на предыдущие патчи, новые локальные патчи копятся в пачке
+и уходят одним патчем: меньше запросов при быстром наборе текста.
+"""
+from twisted.internet import defer
+
+from oplog import patch_changes
+
+__author__ = 'snowy'
+
+
+class OutboundBatch(object):
+    def __init__(self, base_model, base_revision, created=None):
+        """
+        Локальные патчи, которые отправляются координатору одним патчем
+        :param base_model: модель текста до первого патча пачки (не изменяется)
+        :param base_revision: ревизия координатора, на которой сделан первый патч пачки
+        :param created: время создания пачки (clock.seconds()) или None
+        """
+        self.base_model = base_model
+        self.base_revision = base_revision
+        self.created = created
+        # oplog.Operation каждого патча пачки (по ним переносятся патчи координатора, см. pending_operations)
+        self.operations = []
+        # defer.Deferred каждого патча пачки, срабатывают с ответом координатора на всю пачку
+        self.results = []
+        self.timestamp = None
+        self.size = 0
+        # область изменений пачки в координатах текущего текста и на сколько изменилась длина текста
+        self.start = None
+        self.end = None
+        self.delta = 0
+        # патч всей пачки, после seal пачка не пополняется
+        self.patches = None
+
+    def __len__(self):
+        return len(self.operations)
+
+    @property
+    def sealed(self):
+        return self.patches is not None
+
+    def add(self, operation, timestamp):
+        """
+        Добавить локальный патч
+        :param operation: oplog.Operation патч относительно текста после предыдущего патча пачки
+        :return: defer.Deferred с ответом координатора
+        """
+        assert not self.sealed, 'sealed batch cannot be extended'
+        # позиции изменений - в тексте до этого патча, а не в координатах кусков patch_make: иначе у патча из
+        # нескольких кусков конец области сдвигается на изменение длины дважды
+        changes = patch_changes(operation.patch)
+        start, end = changes[0][0], changes[-1][1]
+        delta = sum(change[2] for change in changes)
+        if self.start is None:
+            self.start, self.end = start, end + delta
+        else:
+            self.start = min(self.start, start)
+            # правка после конца области сдвигает его, правка внутри области - расширяет
+            self.end = self.end + delta if self.end >= end else max(self.end, end + delta)
+        self.delta += delta
+        self.operations.append(operation)
+        self.timestamp = timestamp
+        self.size += sum(len(data) for patch in operation.patch for _, data in patch.diffs)
+        result = defer.Deferred()
+        self.results.append(result)
+        return result
+
+    def seal(self, model, dmp):
+        """
+        Собрать патчи пачки в один. Дифф считается только по области изменений (с запасом под контекст патча)
+        :param model: модель текста после последнего патча пачки
+        :param dmp: diff_match_patch
+        :return: list [libs.dmp.diff_match_patch.patch_obj]
+        """
+        if len(self.operations) == 1:
+            self.patches = self.operations[0].patch
+        else:
+            margin = dmp.Match_MaxBits
+            window_start = max(0, self.start - margin)
+            before = self.base_model.slice(window_start, self.end - self.delta + margin)
+            after = model.slice(window_start, self.end + margin)
+            self.patches = dmp.patch_make(before, after)
+            for patch in self.patches:
+                patch.start1 += window_start
+                patch.start2 += window_start
+        self.base_model = None
+        return self.patches
+
+    def resolve(self, result):
+        """
+        Передать ответ координатора всем патчам пачки
+        """
+        for deferred in self.results:
+            deferred.callback(result)
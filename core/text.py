@@ -0,0 +1,210 @@
+# coding=utf-8
+"""
+Модели текста документа. Модель правится на месте (replace) и отдает плоскую строку (text) только по требованию.
+Интерфейс совпадает с libs.dmp.diff_match_patch.string_buffer, поэтому модель можно передавать
+в diff_match_patch.patch_applyInPlace.
+Позиции модели - позиции строки python. Sublime считает позиции в символах, а на узкой сборке python символ
+вне BMP занимает две позиции строки (суррогатная пара), поэтому модели переводят одни позиции в другие
+(code_points, position).
+"""
+from bisect import bisect_right
+import zlib
+
+from libs.dmp.diff_match_patch import NARROW_BUILD, diff_match_patch, string_buffer
+
+__author__ = 'snowy'
+
+
+def checksum(pieces):
+    """
+    Контрольная сумма текста, который читается кусками: не зависит от того, как текст разбит на куски,
+    и не требует склеивать его в одну строку. Куски кодируются в utf-16-le: на узких сборках python кусок
+    может кончаться половиной суррогатной пары, а utf-16-le кодирует такие половины независимо
+    :param pieces: iterable [unicode] куски текста по порядку
+    :return: int
+    """
+    value = 1
+    for piece in pieces:
+        value = zlib.adler32(piece.encode('utf-16-le'), value)
+    return value & 0xffffffff
+
+
+def _position(text, code_points):
+    """
+    :return: int позиция в text, перед которой ровно code_points символов; никогда не попадает внутрь
+    суррогатной пары. Если символов в text меньше - len(text)
+    """
+    for pos, char in enumerate(text):
+        if not diff_match_patch.isLowSurrogate(char):
+            if not code_points:
+                return pos
+            code_points -= 1
+    return len(text)
+
+
+class FlatText(string_buffer):
+    """
+    Модель-строка: каждая правка копирует весь текст
+    """
+
+    def copy(self):
+        return FlatText(self.text)
+
+    def checksum(self):
+        return checksum([self.text])
+
+    def code_points(self, pos):
+        """
+        :return: int сколько символов (как их считает sublime) в text[:pos]
+        """
+        if not NARROW_BUILD:
+            return pos
+        return diff_match_patch.codePointLength(self.text[:pos])
+
+    def position(self, code_points):
+        """
+        :return: int позиция модели, перед которой code_points символов (позиция sublime -> позиция модели)
+        """
+        if not NARROW_BUILD:
+            return code_points
+        return _position(self.text, code_points)
+
+
+class RopeText(object):
+    """
+    Модель-"веревка": текст хранится списком кусков ограниченного размера. Правка пересобирает только
+    затронутые куски, а смещения кусков пересчитываются целыми числами, без копирования текста.
+    """
+    CHUNK_SIZE = 2048
+
+    def __init__(self, text=u''):
+        self._chunks = []
+        self._starts = []
+        # сколько символов (позиций sublime) в каждом куске и перед ним: на узкой сборке python меньше длины куска
+        self._code_point_counts = []
+        self._code_point_starts = []
+        self._length = 0
+        self._flat = None
+        self._reset(text)
+
+    def _reset(self, text):
+        self._chunks = [text[i:i + self.CHUNK_SIZE] for i in xrange(0, len(text), self.CHUNK_SIZE)]
+        self._code_point_counts = [diff_match_patch.codePointLength(chunk) for chunk in self._chunks]
+        self._length = len(text)
+        self._flat = text
+        self._reindex()
+
+    def _reindex(self, since=0):
+        del self._starts[since:]
+        del self._code_point_starts[since:]
+        offset = self._starts[-1] + len(self._chunks[since - 1]) if since else 0
+        code_points = self._code_point_starts[-1] + self._code_point_counts[since - 1] if since else 0
+        for chunk, count in zip(self._chunks[since:], self._code_point_counts[since:]):
+            self._starts.append(offset)
+            self._code_point_starts.append(code_points)
+            offset += len(chunk)
+            code_points += count
+
+    def __len__(self):
+        return self._length
+
+    def copy(self):
+        """
+        Копия модели. Куски неизменяемы, поэтому копируются только списки
+        """
+        rope = RopeText.__new__(RopeText)
+        rope._chunks = self._chunks[:]
+        rope._starts = self._starts[:]
+        rope._code_point_counts = self._code_point_counts[:]
+        rope._code_point_starts = self._code_point_starts[:]
+        rope._length = self._length
+        rope._flat = self._flat
+        return rope
+
+    def checksum(self):
+        """
+        Контрольная сумма текста (см. checksum) без сборки плоской строки
+        """
+        return checksum(self._chunks)
+
+    @property
+    def text(self):
+        if self._flat is None:
+            self._flat = u''.join(self._chunks)
+        return self._flat
+
+    @text.setter
+    def text(self, text):
+        self._reset(text)
+
+    def _locate(self, pos):
+        """
+        :return: индекс куска, в котором лежит позиция pos
+        """
+        return max(0, bisect_right(self._starts, pos) - 1)
+
+    def slice(self, start, end):
+        start = max(0, start)
+        end = min(self._length, end)
+        if start >= end:
+            return u''
+        if self._flat is not None:
+            return self._flat[start:end]
+        first, last = self._locate(start), self._locate(end - 1)
+        if first == last:
+            offset = self._starts[first]
+            return self._chunks[first][start - offset:end - offset]
+        head = self._chunks[first][start - self._starts[first]:]
+        tail = self._chunks[last][:end - self._starts[last]]
+        return u''.join([head] + self._chunks[first + 1:last] + [tail])
+
+    def replace(self, start, end, data):
+        """
+        Заменить text[start:end] на data
+        """
+        if start == end and not data:
+            return
+        if not self._chunks:
+            self._reset(data)
+            return
+        first = self._locate(start)
+        last = self._locate(max(start, end - 1))
+        head = self._chunks[first][:start - self._starts[first]]
+        tail = self._chunks[last][end - self._starts[last]:]
+        merged = head + data + tail
+        # маленький кусок склеивается со следующим, чтобы список не дробился на мелочь
+        if len(merged) < self.CHUNK_SIZE // 4 and last + 1 < len(self._chunks):
+            last += 1
+            merged += self._chunks[last]
+        pieces = [merged[i:i + self.CHUNK_SIZE] for i in xrange(0, len(merged), self.CHUNK_SIZE)]
+        self._chunks[first:last + 1] = pieces
+        self._code_point_counts[first:last + 1] = [diff_match_patch.codePointLength(piece) for piece in pieces]
+        self._length += len(data) - (end - start)
+        self._flat = None
+        self._reindex(first)
+
+    def code_points(self, pos):
+        """
+        :return: int сколько символов (как их считает sublime) в text[:pos]. Читается только кусок с pos
+        """
+        if not NARROW_BUILD:
+            return pos
+        pos = max(0, min(self._length, pos))
+        if not pos:
+            return 0
+        index = self._locate(pos - 1)
+        offset = self._starts[index]
+        return self._code_point_starts[index] + diff_match_patch.codePointLength(self._chunks[index][:pos - offset])
+
+    def position(self, code_points):
+        """
+        :return: int позиция модели, перед которой code_points символов (позиция sublime -> позиция модели).
+        Читается только кусок с этой позицией
+        """
+        if not NARROW_BUILD:
+            return code_points
+        if not self._chunks:
+            return 0
+        index = max(0, bisect_right(self._code_point_starts, code_points) - 1)
+        chunk_start = self._starts[index]
+        return chunk_start + _position(self._chunks[index], code_points - self._code_point_starts[index])
@@ -0,0 +1,195 @@
+# coding=utf-8
+"""
+Передача по частям значений, которые не помещаются в одно значение AMP (amp.MAX_VALUE_LENGTH байт):
+начального текста документа и больших патчей.
+Отправитель держит значение до окончания передачи и отдает его кусками, получатель собирает куски
+по мере прихода. Незавершенная передача живет TRANSFER_TTL секунд, поэтому после переподключения
+ее можно продолжить с того же смещения.
+"""
+import time
+import uuid
+
+from twisted.internet import defer
+from twisted.protocols.amp import MAX_VALUE_LENGTH
+
+from command import GetTextChunkCommand, PatchChunkCommand
+from exceptions import TransferExpiredException
+from text import RopeText
+
+__author__ = 'snowy'
+
+TEXT_CHUNK_SIZE = MAX_VALUE_LENGTH // 4
+"""Символов текста в одном куске. Даже в худшем случае (4 байта UTF-8 на символ вне BMP) кусок не больше
+MAX_VALUE_LENGTH"""
+PATCH_CHUNK_SIZE = 32768
+"""Байт сериализованного патча в одном куске"""
+MAX_PATCH_VALUE_LENGTH = MAX_VALUE_LENGTH
+"""Патч длиннее этого передается по частям"""
+TRANSFER_TTL = 300
+
+
+class Transfers(object):
+    def __init__(self, ttl=TRANSFER_TTL):
+        """
+        Реестр незавершенных передач transfer_id -> значение. Передачи, к которым не обращались ttl секунд, забываются
+        :param ttl: int секунды
+        """
+        self.ttl = ttl
+        self._transfers = {}
+
+    def _expire(self):
+        now = time.time()
+        for transfer_id, (_, touched) in self._transfers.items():
+            if now - touched > self.ttl:
+                del self._transfers[transfer_id]
+
+    def put(self, value, transfer_id=None):
+        self._expire()
+        transfer_id = transfer_id or uuid.uuid4().hex
+        self._transfers[transfer_id] = (value, time.time())
+        return transfer_id
+
+    def get(self, transfer_id):
+        """
+        :raise TransferExpiredException: передачи нет или она устарела
+        """
+        self._expire()
+        if transfer_id not in self._transfers:
+            raise TransferExpiredException('transfer {0} is unknown or expired'.format(transfer_id))
+        value, _ = self._transfers[transfer_id]
+        self._transfers[transfer_id] = (value, time.time())
+        return value
+
+    def pop(self, transfer_id):
+        value = self.get(transfer_id)
+        del self._transfers[transfer_id]
+        return value
+
+    def __contains__(self, transfer_id):
+        return transfer_id in self._transfers
+
+
+class IncomingTransfer(object):
+    def __init__(self, transfer_id=None, length=None):
+        """
+        Собираемое по кускам значение
+        :param transfer_id: str идентификатор передачи на стороне отправителя
+        :param length: int полная длина значения
+        """
+        self.transfer_id = transfer_id
+        self.length = length
+        self.chunks = []
+        self.offset = 0
+        # ревизия документа, снимок которого передается (для текста документа)
+        self.revision = None
+
+    @property
+    def done(self):
+        return self.length is not None and self.offset >= self.length
+
+    def append(self, offset, chunk):
+        """
+        Добавить кусок. Повторно присланные куски (после переподключения) пропускаются
+        :return: int сколько уже получено
+        """
+        if offset == self.offset:
+            self.chunks.append(chunk)
+            self.offset += len(chunk)
+        return self.offset
+
+    @property
+    def value(self):
+        return ''.join(self.chunks)
+
+
+def download_text(proto, transfer=None, document=None):
+    """
+    Скачать текст документа кусками GetTextChunkCommand. Куски сразу складываются в RopeText,
+    поэтому одновременно в памяти нет двух копий текста.
+    :param proto: AMP протокол соединения с координатором
+    :param transfer: IncomingTransfer незавершенная передача, которую надо продолжить (или None)
+    :param document: unicode идентификатор документа на координаторе (None - документ по умолчанию)
+    :return: defer.Deferred с результатом RopeText (ревизия текста остается в transfer.revision);
+    если соединение оборвалось, transfer можно передать снова
+    """
+    transfer = transfer or IncomingTransfer()
+    rope = RopeText(u''.join(transfer.chunks))
+    transfer.chunks = []
+    result = defer.Deferred()
+
+    def _request():
+        return proto.callRemote(GetTextChunkCommand, transfer_id=transfer.transfer_id, offset=transfer.offset,
+                                document=document).addCallbacks(_got_chunk, _failed)
+
+    def _got_chunk(response):
+        transfer.transfer_id = response['transfer_id']
+        transfer.length = response['length']
+        transfer.revision = response['revision']
+        rope.replace(len(rope), len(rope), response['chunk'])
+        transfer.offset = len(rope)
+        if transfer.done or not response['chunk']:
+            result.callback(rope)
+        else:
+            _request()
+
+    def _failed(failure):
+        if failure.check(TransferExpiredException) and transfer.offset:
+            # координатор уже забыл передачу: начинаем заново
+            rope.text = u''
+            transfer.transfer_id, transfer.offset, transfer.length = None, 0, None
+            _request()
+        else:
+            # чтобы передачу можно было продолжить после переподключения
+            transfer.chunks = [rope.text]
+            result.errback(failure)
+
+    _request()
+    return result
+
+
+def upload(proto, payload, transfer_id=None, chunk_size=PATCH_CHUNK_SIZE, document=None):
+    """
+    Передать значение получателю кусками PatchChunkCommand. Получатель отвечает, сколько уже получил,
+    поэтому повторный вызов с тем же transfer_id продолжает передачу с места обрыва.
+    :param proto: AMP протокол получателя
+    :param payload: str
+    :param transfer_id: str идентификатор передачи (новый, если None)
+    :param document: unicode идентификатор документа на координаторе (None - документ по умолчанию)
+    :return: defer.Deferred с результатом transfer_id
+    """
+    transfer_id = transfer_id or uuid.uuid4().hex
+    result = defer.Deferred()
+
+    def _send(offset):
+        if offset >= len(payload):
+            result.callback(transfer_id)
+            return
+        proto.callRemote(PatchChunkCommand, transfer_id=transfer_id, offset=offset,
+                         chunk=payload[offset:offset + chunk_size], length=len(payload), document=document) \
+            .addCallbacks(lambda response: _send(response['offset']), result.errback)
+
+    _send(0)
+    return result
+
+
+def receive_chunk(transfers, transfer_id, offset, chunk, length):
+    """
+    Принять кусок, присланный upload
+    :param transfers: Transfers реестр получателя
+    :return: dict ответ PatchChunkCommand
+    """
+    if transfer_id not in transfers:
+        transfers.put(IncomingTransfer(transfer_id, length), transfer_id)
+    return {'offset': transfers.get(transfer_id).append(offset, chunk)}
+
+
+def take_received(transfers, transfer_id):
+    """
+    Забрать полностью принятое значение
+    :raise TransferExpiredException: передача не завершена или неизвестна
+    """
+    transfer = transfers.pop(transfer_id)
+    if not transfer.done:
+        raise TransferExpiredException('transfer {0} is not complete: {1} of {2}'.format(
+            transfer_id, transfer.offset, transfer.length))
+    return transfer.value
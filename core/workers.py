@@ -0,0 +1,242 @@
+# coding=utf-8
+"""
+Тяжелые диффы и патчи вне потока реактора. Работы одного документа выполняются по порядку, маленькие - сразу
+в потоке реактора (передача в процесс и обратно стоит дороже), большие - в пуле процессов.
+Работы пула - функции этого модуля: в процесс передаются только тексты, патчи и настройки diff_match_patch
+"""
+from collections import deque
+import logging
+import os
+import sys
+import traceback
+
+from twisted.internet import defer, task, threads
+
+from exceptions import JobFailedException
+from inverse import InversePatch
+from libs.dmp import diff_match_patch, diff_task
+from libs.dmp.diff_match_patch import string_buffer
+
+__author__ = 'snowy'
+
+logger = logging.getLogger(__name__)
+
+DMP_SETTINGS = ('Diff_Timeout', 'Diff_EditCost', 'Match_Threshold', 'Match_Distance', 'Patch_DeleteThreshold',
+                'Patch_Margin', 'Match_MaxBits')
+"""Настройки diff_match_patch, которые передаются в процесс вместе с работой"""
+
+
+def dmp_settings(dmp):
+    """
+    :param dmp: diff_match_patch
+    :return: dict настройки для работ пула
+    """
+    return dict((name, getattr(dmp, name)) for name in DMP_SETTINGS)
+
+
+def create_dmp(settings):
+    dmp = diff_match_patch()
+    for name, value in settings.iteritems():
+        setattr(dmp, name, value)
+    return dmp
+
+
+def patch_size(patch_objects):
+    """
+    Объем работы применения патча (символов в патчах)
+    """
+    return sum(len(data) for patch in patch_objects for _, data in patch.diffs)
+
+
+def make_patches(dmp, before, after, timeout):
+    """
+    Патч между двумя версиями текста. Обратный патч строится по нему (core.inverse.InversePatch)
+    :param timeout: сколько секунд может считаться дифф (см. diff_task)
+    :return: tuple (patches, optimal), optimal - False, если дифф прерван по времени
+    """
+    diff = diff_task(dmp, before, after, timeout=timeout)
+    diff.step()
+    return _diff_patches(dmp, before, diff)
+
+
+def _diff_patches(dmp, before, diff):
+    """
+    :param diff: посчитанный diff_task
+    :return: tuple (patches, optimal) см. make_patches
+    """
+    diffs = diff.diffs
+    if len(diffs) > 2:
+        dmp.diff_cleanupSemantic(diffs)
+        dmp.diff_cleanupEfficiency(diffs)
+    return dmp.patch_make(before, diffs), diff.optimal
+
+
+def make_patches_job(settings, before, after, timeout):
+    return make_patches(create_dmp(settings), before, after, timeout)
+
+
+def make_patches_sliced(cooperator, settings, before, after, timeout):
+    """
+    make_patches_job в потоке реактора, когда пула нет: дифф считается срезами по diff_task.slice_seconds
+    между итерациями реактора. Бюджет timeout считает только время срезов
+    :param cooperator: twisted.internet.task.Cooperator
+    :return: defer.Deferred с результатом make_patches
+    """
+    dmp = create_dmp(settings)
+    diff = diff_task(dmp, before, after, timeout=timeout)
+    return cooperator.cooperate(diff).whenDone().addCallback(lambda ignore: _diff_patches(dmp, before, diff))
+
+
+def apply_patches_job(settings, patch_objects, text):
+    """
+    Применить патч к тексту и посчитать обратный патч
+    :return: tuple (patched_text, results, backward_patches), backward_patches - core.inverse.InversePatch
+    или None, если патч применился не весь
+    """
+    dmp = create_dmp(settings)
+    buf = string_buffer(text)
+    results, _ = dmp.patch_applyInPlace(patch_objects, buf)
+    if False in results:
+        return buf.text, results, None
+    return buf.text, results, InversePatch(dmp.sublime_applied_patches)
+
+
+_SLICED_JOBS = {make_patches_job: make_patches_sliced}
+"""Работы, которые без пула выполняются срезами в потоке реактора"""
+
+
+def _call(function, args):
+    """
+    Выполняется в процессе пула. Исключение возвращается текстом: не всякое исключение переживет pickle
+    """
+    try:
+        return True, function(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+_pool = None
+_pool_available = True
+
+
+def _runs_in_interpreter():
+    """
+    Запущены ли мы обычным интерпретатором python. Внутри редактора sys.executable - сам редактор (plugin_host),
+    и процессы пула запустили бы его копии
+    """
+    executable = os.path.basename(sys.executable or '').lower()
+    return executable.startswith('python') or executable.startswith('pypy')
+
+
+def get_pool(processes=None):
+    """
+    Пул процессов, общий для всех приложений (view). Создается при первой большой работе
+    :return: multiprocessing.Pool или None, если процессы здесь не запускаются - тогда все считается в потоке реактора
+    """
+    global _pool, _pool_available
+    if _pool is None and _pool_available:
+        if not _runs_in_interpreter():
+            logger.warning('%s is not a python interpreter, heavy diffs stay in the reactor thread', sys.executable)
+            _pool_available = False
+            return None
+        try:
+            import multiprocessing
+            _pool = multiprocessing.Pool(processes)
+        except Exception as e:
+            logger.warning('worker processes are not available (%s), heavy diffs stay in the reactor thread', e)
+            _pool_available = False
+    return _pool
+
+
+class Executor(object):
+    inline_size = 65536
+    """Объем работы (символов), до которого она выполняется сразу в потоке реактора"""
+    job_timeout = 300
+    """Сколько секунд ждать результата работы пула, после этого работа считается упавшей (процесс завис или умер)"""
+
+    def __init__(self, reactor, processes=None):
+        """
+        Очереди работ документов и передача больших работ в пул процессов
+        :param reactor: реактор, в потоке которого срабатывают результаты работ пула
+        :param processes: int размер пула (None - по числу процессоров)
+        """
+        self.reactor = reactor
+        self.processes = processes
+        # срезы больших работ, когда пула нет
+        self.cooperator = task.Cooperator(scheduler=lambda work: self.reactor.callLater(0, work))
+        # ключ (документ) -> deque работ, ждущих окончания текущей; ключа нет - работ нет
+        self._queues = {}
+
+    def busy(self, key):
+        """
+        Есть ли у ключа незавершенные работы
+        """
+        return key in self._queues
+
+    def offloads(self, key, size):
+        """
+        Нужна ли работе очередь ключа: работа большая или ключ занят.
+        Иначе ее можно выполнить сразу, не превращая результат в defer.Deferred
+        """
+        return size >= self.inline_size or self.busy(key)
+
+    def serialize(self, key, function, *args):
+        """
+        Выполнить function(*args) после всех работ, поставленных раньше с тем же ключом
+        :param key: ключ очереди, например алгоритм документа
+        :param function: может вернуть defer.Deferred, следующая работа ключа ждет его
+        :return: defer.Deferred с результатом function. Срабатывает до начала следующей работы ключа
+        """
+        result = defer.Deferred()
+        if key in self._queues:
+            self._queues[key].append((function, args, result))
+        else:
+            self._queues[key] = deque()
+            self._start(key, function, args, result)
+        return result
+
+    def _start(self, key, function, args, result):
+        defer.maybeDeferred(function, *args).addBoth(self._finished, key, result)
+
+    def _finished(self, outcome, key, result):
+        result.callback(outcome)
+        queue = self._queues[key]
+        if queue:
+            function, args, next_result = queue.popleft()
+            self._start(key, function, args, next_result)
+        else:
+            del self._queues[key]
+
+    def run(self, size, function, *args):
+        """
+        Выполнить function(*args): большую работу - в процессе пула (без пула - срезами, если работа это умеет),
+        маленькую - сразу
+        :param size: int объем работы (символов)
+        :param function: функция этого модуля, аргументы и результат должны переживать pickle
+        :return: defer.Deferred с результатом, любая ошибка работы в пуле - JobFailedException
+        """
+        pool = get_pool(self.processes) if size >= self.inline_size else None
+        if pool is None:
+            if size >= self.inline_size and function in _SLICED_JOBS:
+                # большая работа не останавливает реактор на все время работы
+                return _SLICED_JOBS[function](self.cooperator, *args)
+            return defer.maybeDeferred(function, *args)
+        try:
+            pending = pool.apply_async(_call, (function, args))
+        except Exception:
+            return defer.fail(JobFailedException(traceback.format_exc()))
+        # callback apply_async не вызывается, если работа или результат не пережили pickle или процесс пула умер,
+        # поэтому результат ждет поток из пула реактора: любая ошибка get() становится JobFailedException
+        return threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(), pending.get, self.job_timeout) \
+            .addCallbacks(self._unpack, self._failed)
+
+    @staticmethod
+    def _unpack(outcome):
+        succeed, value = outcome
+        if not succeed:
+            raise JobFailedException(value)
+        return value
+
+    @staticmethod
+    def _failed(failure):
+        raise JobFailedException(failure.getTraceback())
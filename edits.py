@@ -0,0 +1,77 @@
+# coding=utf-8
+"""
+Пакетное применение команд diff_match_patch (diff_match_patch.patch_sublimeCommand) к view.
+Команды dmp идут по порядку: позиции каждой - в тексте после предыдущих. Здесь они сводятся в непересекающиеся
+правки в позициях исходного текста; по убыванию позиций правки не сдвигают друг друга, поэтому view меняется за один
+проход без чтения между правками. Модуль не зависит от sublime.
+"""
+
+__author__ = 'snowy'
+
+
+def _command(start, end, text):
+    if not text:
+        return 'erase', start, end
+    return 'insert', start, end, text
+
+
+def batch(commands):
+    """
+    :param commands: list команд ('insert', from, to, text) или ('erase', from, to), каждая в позициях текста,
+    к которому применены предыдущие
+    :return: list команд того же вида в позициях исходного текста, без пересечений, по убыванию позиций
+    """
+    edits = []
+    """:type edits: list of [start, end, text]: исходный [start, end) заменен на text, по возрастанию позиций"""
+    for command in commands:
+        start, end = command[1], command[2]
+        text = command[3] if command[0] == 'insert' else u''
+        # shift - насколько правки левее edits[i] сдвинули текущий текст относительно исходного
+        shift, i = 0, 0
+        while i < len(edits) and edits[i][0] + shift + len(edits[i][2]) < start:
+            shift += len(edits[i][2]) - (edits[i][1] - edits[i][0])
+            i += 1
+        new_start, prefix, suffix = start - shift, u'', u''
+        new_end = None
+        j = i
+        # правки, которых команда касается, сливаются с ней в одну
+        while j < len(edits) and edits[j][0] + shift <= end:
+            edit_start, edit_end, edit_text = edits[j]
+            current_start = edit_start + shift
+            if current_start < start:
+                new_start, prefix = edit_start, edit_text[:start - current_start]
+            if current_start + len(edit_text) > end:
+                new_end, suffix = edit_end, edit_text[end - current_start:]
+            shift += len(edit_text) - (edit_end - edit_start)
+            j += 1
+        if new_end is None:
+            new_end = end - shift
+        merged = prefix + text + suffix
+        edits[i:j] = [[new_start, new_end, merged]] if new_start != new_end or merged else []
+    return [_command(start, end, text) for start, end, text in reversed(edits)]
+
+
+def collapse(batched, read):
+    """
+    Свести команды batch в одну замену от первой до последней правки
+    :param batched: list результат batch
+    :param read: функция (start, end) -> текст исходного текста [start, end), вызывается один раз
+    :return: команда ('insert', from, to, text) или ('erase', from, to)
+    """
+    start, end = batched[-1][1], batched[0][2]
+    original = read(start, end)
+    pieces = []
+    position = start
+    for command in reversed(batched):
+        pieces.append(original[position - start:command[1] - start])
+        if command[0] == 'insert':
+            pieces.append(command[3])
+        position = command[2]
+    return _command(start, end, u''.join(pieces))
+
+
+def rewritten(batched):
+    """
+    :return: int сколько символов исходного текста заменяют команды batch
+    """
+    return sum(command[2] - command[1] for command in batched)
@@ -1,54 +1,283 @@
 # coding=utf-8
+from bisect import bisect_left, bisect_right, insort
 from collections import namedtuple
 import logging
 import time
 
+from core.inverse import InversePatch
+from core.oplog import Operation, patch_changes, rebase, shift
 from libs.dmp.diff_match_patch import diff_match_patch
 from misc import ApplicationSpecificAdapter
+from recovery import PatchLocator, advance, back, hunk_ranges, intersects, invert
 
 
 __author__ = 'snowy'
 
 HistoryEntry = namedtuple('HistoryEntry', ['patch', 'timestamp', 'is_owner'])
+# снимок текста, который был до самого старого коммита истории
+Checkpoint = namedtuple('Checkpoint', ['text', 'timestamp'])
 logger = logging.getLogger(__name__)
+# больше любого номера коммита: (timestamp, _LAST) в индексе стоит после всех коммитов с этим timestamp
+_LAST = float('inf')
+
+
+def _patch_size(patch_objects):
+    """
+    Примерный объем патча: сколько символов текста он держит
+    """
+    if isinstance(patch_objects, InversePatch):
+        return patch_objects.size
+    return sum(len(data) for patch in patch_objects for _, data in patch.diffs)
+
+
+class RetentionPolicy(object):
+    def __init__(self, max_entries=2000, max_bytes=8 * 1024 * 1024, max_age=None):
+        """
+        Ограничения на размер истории. None - ограничения нет.
+        Когда ограничение превышено, старые коммиты сворачиваются так, чтобы истории осталось вдвое меньше лимита:
+        тогда сжатие происходит редко, а его стоимость распределяется по многим коммитам
+        :param max_entries: int сколько коммитов хранить
+        :param max_bytes: int сколько символов текста могут держать патчи истории (прямые и обратные)
+        :param max_age: float сколько секунд хранить коммит
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def exceeded(self, entries, size, now):
+        """
+        :param entries: list [HistoryEntry] коммиты истории, от старых к новым
+        :param size: int объем патчей истории
+        :param now: float текущее время
+        """
+        return bool(self.max_entries is not None and len(entries) > self.max_entries or
+                    self.max_bytes is not None and size > self.max_bytes or
+                    self.max_age is not None and entries and entries[0].timestamp < now - self.max_age)
+
+    def collapse_count(self, entries, sizes, now):
+        """
+        :param entries: list [HistoryEntry] коммиты истории, от старых к новым
+        :param sizes: list [int] объемы коммитов
+        :param now: float текущее время
+        :return: int сколько самых старых коммитов свернуть
+        """
+        count = 0
+        if self.max_entries is not None:
+            count = max(count, len(entries) - self.max_entries // 2)
+        if self.max_bytes is not None:
+            size = sum(sizes)
+            for index, entry_size in enumerate(sizes):
+                if size <= self.max_bytes // 2:
+                    count = max(count, index)
+                    break
+                size -= entry_size
+            else:
+                count = len(entries)
+        if self.max_age is not None:
+            while count < len(entries) and entries[count].timestamp < now - self.max_age / 2.0:
+                count += 1
+        return min(count, len(entries))
 
 
 class HistoryLine(object):
-    def __init__(self, history_owner):
+    def __init__(self, history_owner, retention=None):
         """
         Линия истории патчей текущего application.
         :param history_owner: core.core.Application
+        :param retention: RetentionPolicy ограничения на размер истории
         """
         self.owner = history_owner
+        self.retention = retention or RetentionPolicy()
+        self.strict_dmp = diff_match_patch()
+        self.strict_dmp.Match_Threshold = 0.0
         # История, которая держит патчи, обратные к тем, что лежат в self.history
         # необходимо для верного rollback патчей
         self.rollback_history = []
         # История примененных патчей
         self.history = []
+        # объемы коммитов (прямой и обратный патч вместе)
+        self.sizes = []
+        self.size = 0
+        # если история сжималась: Checkpoint, а первый коммит истории - свернутые старые коммиты
+        self.checkpoint = None
+        # индекс по времени: отсортированный список (timestamp, номер коммита).
+        # Коммиты снимаются только с концов истории, поэтому self.history[i] имеет номер self._first + i
+        self._index = []
+        self._first = 0
+
+    def __len__(self):
+        return len(self.history)
+
+    def __iter__(self):
+        """
+        Коммиты в порядке коммитов, без копирования истории
+        """
+        return iter(self.history)
 
     def clean(self):
-        del self.history
         self.history = []
+        self.rollback_history = []
+        self.sizes = []
+        self.size = 0
+        self.checkpoint = None
+        self._index = []
+        self._first = 0
 
     def commit(self, patch, timestamp, is_owner):
         self._commit(HistoryEntry(patch, timestamp, is_owner), self.history)
+        self.sizes.append(0)
+        self._index_last()
+
+    def _index_last(self):
+        """
+        Добавить в индекс последний коммит. Обычно время коммитов растет, и вставка - это просто append
+        """
+        key = (self.history[-1].timestamp, self._first + len(self.history) - 1)
+        if not self._index or self._index[-1] <= key:
+            self._index.append(key)
+        else:
+            insort(self._index, key)
 
     @staticmethod
     def _commit(entry, where):
         assert isinstance(entry, HistoryEntry)
         where.append(entry)
 
-    def commit_with_rollback(self, forwards, backwards):
+    def commit_with_rollback(self, forwards, backwards, text_model=None):
         """
         Комит изменений с rollback патчем
         :param forwards: HistoryEntry стандартный патч, применение которого ведет вперед по истории
-        :param backwards: HistoryEntry патч, являющийся обратным к forwards
+        :param backwards: HistoryEntry патч, являющийся обратным к forwards. Обычно core.inverse.InversePatch:
+        список патчей строится, только когда коммит откатывается
+        :param text_model: модель текста, к которой применяется forwards (core.text). Если передана, то история
+        при необходимости сжимается согласно self.retention
         """
+        retained_size = self.size - self.sizes[0] if self.checkpoint is not None else self.size
+        if text_model is not None and \
+                self.retention.exceeded(self._retained(self.history), retained_size, time.time()):
+            self.compact(text_model)
         self._commit(forwards, self.history)
         self._commit(backwards, self.rollback_history)
+        entry_size = _patch_size(forwards.patch) + _patch_size(backwards.patch)
+        self.sizes.append(entry_size)
+        self.size += entry_size
+        self._index_last()
+
+    def pop(self):
+        """
+        Снять последний коммит
+        :return: tuple (backward HistoryEntry, forward HistoryEntry)
+        """
+        self.size -= self.sizes.pop()
+        if len(self.history) == 1:
+            self.checkpoint = None
+        key = (self.history[-1].timestamp, self._first + len(self.history) - 1)
+        del self._index[bisect_left(self._index, key)]
+        return self.rollback_history.pop(), self.history.pop()
+
+    def remove(self, index, newer):
+        """
+        Убрать коммит из-под более новых коммитов
+        :param index: int номер коммита в истории
+        :param newer: list [HistoryEntry] прямые патчи коммитов после index, сдвинутые в текст без него.
+        Обратные патчи строятся из них
+        :return: tuple (backward HistoryEntry, forward HistoryEntry) убранного коммита
+        """
+        assert index or self.checkpoint is None
+        removed = self.rollback_history[index], self.history[index]
+        while len(self.history) > index:
+            self.pop()
+        for forward in newer:
+            self.commit_with_rollback(forward, forward._replace(patch=InversePatch(forward.patch)))
+        return removed
+
+    def _retained(self, entries):
+        """
+        Коммиты истории без свернутого коммита
+        """
+        return entries[1:] if self.checkpoint is not None else entries
+
+    def compact(self, text_model):
+        """
+        Свернуть старые коммиты в один. Текст до свернутого коммита запоминается в self.checkpoint, а то, что было
+        свернуто раньше, забывается. Тексты на границах вычисляются откатом истории от text_model
+        :param text_model: модель текста после последнего коммита
+        """
+        retained = self._retained(self.history)
+        count = self.retention.collapse_count(retained, self._retained(self.sizes), time.time())
+        if not count:
+            return
+        offset = len(self.history) - len(retained)
+        model = text_model.copy()
+        boundary = None
+        try:
+            for index in xrange(len(self.history) - 1, offset - 1, -1):
+                if index == offset + count - 1:
+                    boundary = model.text
+                result, _ = self.strict_dmp.patch_applyInPlace(self.rollback_history[index].patch, model)
+                if False in result:
+                    raise RollbackFailedException('cannot roll back the commit at {0}'.format(index))
+        except RollbackFailedException as e:
+            # историю нельзя откатить дальше: старые коммиты просто забываются
+            logger.warning('history is not consistent (%s), %d old commits are dropped', e, count)
+            self._drop(offset + count)
+            self.checkpoint = None
+            return
+        base = model.text
+        last = self.history[offset + count - 1]
+        is_owner = any(entry.is_owner for entry in self.history[offset:offset + count])
+        forward = HistoryEntry(self.strict_dmp.patch_make(base, boundary), last.timestamp, is_owner)
+        backward = HistoryEntry(InversePatch(forward.patch), last.timestamp, is_owner)
+        previous_timestamp = self.history[offset - 1].timestamp if offset else None
+        self._drop(offset + count)
+        entry_size = _patch_size(forward.patch) + _patch_size(backward.patch)
+        self.history.insert(0, forward)
+        self.rollback_history.insert(0, backward)
+        self.sizes.insert(0, entry_size)
+        self.size += entry_size
+        self._first -= 1
+        insort(self._index, (forward.timestamp, self._first))
+        self.checkpoint = Checkpoint(base, previous_timestamp)
+        logger.debug('%d commits are collapsed, %d are retained', count, len(self.history) - 1)
+
+    def _drop(self, count):
+        """
+        Забыть count самых старых коммитов
+        """
+        self.size -= sum(self.sizes[:count])
+        del self.history[:count]
+        del self.rollback_history[:count]
+        del self.sizes[:count]
+        self._first += count
+        self._index = [key for key in self._index if key[1] >= self._first]
+
+    def since(self, timestamp):
+        """
+        Коммиты, сделанные позже timestamp, в порядке времени
+        :return: генератор; историю нельзя менять, пока он не исчерпан
+        """
+        return self._from_index(bisect_right(self._index, (timestamp, _LAST)), len(self._index))
+
+    def between(self, start, end):
+        """
+        Коммиты со временем в (start, end], в порядке времени
+        :return: генератор; историю нельзя менять, пока он не исчерпан
+        """
+        return self._from_index(bisect_right(self._index, (start, _LAST)), bisect_right(self._index, (end, _LAST)))
+
+    def last(self, count):
+        """
+        Последние count коммитов в порядке коммитов
+        :return: генератор; историю нельзя менять, пока он не исчерпан
+        """
+        return (self.history[index] for index in xrange(max(0, len(self.history) - count), len(self.history)))
+
+    def _from_index(self, start, end):
+        for position in xrange(start, end):
+            yield self.history[self._index[position][1] - self._first]
 
     def get_all_since(self, timestamp):
-        return [entry for entry in self.history if entry.timestamp > timestamp]
+        return list(self.since(timestamp))
 
 
 class RollbackFailedException(Exception):
@@ -59,12 +288,47 @@ class FailedToApplyPatchSilentlyException(Exception):
     pass
 
 
+class RecoveryFailedException(Exception):
+    pass
+
+
+class RecoveryBudgetExceededException(RecoveryFailedException):
+    pass
+
+
+class RecoveryBudget(object):
+    def __init__(self, milliseconds=50, commits=200):
+        """
+        Сколько может стоить RECOVERY. Дороже - дешевле заново получить текст координатора.
+        None - ограничения нет
+        :param milliseconds: int сколько времени может занять RECOVERY
+        :param commits: int сколько коммитов можно откатить
+        """
+        self.milliseconds = milliseconds
+        self.commits = commits
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+
+    def check(self, rolled_back=0):
+        """
+        :param rolled_back: int сколько коммитов уже откачено
+        :raise RecoveryBudgetExceededException: бюджет исчерпан
+        """
+        if self.commits is not None and rolled_back > self.commits:
+            raise RecoveryBudgetExceededException('more than {0} commits are rolled back'.format(self.commits))
+        if self.milliseconds is not None and (time.time() - self.started) * 1000 > self.milliseconds:
+            raise RecoveryBudgetExceededException('recovery takes more than {0} ms'.format(self.milliseconds))
+
+
 class TimeMachine(object):
-    def __init__(self, history_line, owner):
+    def __init__(self, history_line, owner, budget=None):
         """
 
         :param history_line: HistoryLine
         :param owner: DiffMatchPatchAlgorithm
+        :param budget: RecoveryBudget
         """
         from core.core import DiffMatchPatchAlgorithm
 
@@ -77,7 +341,8 @@ class TimeMachine(object):
         self.loose_dmp = diff_match_patch()
         self.loose_dmp.Match_Threshold = 1.0
         self.logger = ApplicationSpecificAdapter(logger, {'name': owner.name})
-        # buffer text which determines state of the time machine
+        self.budget = budget or RecoveryBudget()
+        # buffer text which determines state of the time machine (core.text model, edited in place)
         self.model_text = None
 
     @staticmethod
@@ -85,13 +350,17 @@ class TimeMachine(object):
         return time.time()
 
     def _pop_one_commit(self, pop_stack):
-        to_be_rolled_back = self.history.rollback_history.pop()
-        to_be_roll_forward = self.history.history.pop()
+        checkpoint = self.history.checkpoint if len(self.history) == 1 else None
+        to_be_rolled_back, to_be_roll_forward = self.history.pop()
+        if checkpoint is not None:
+            # свернутый коммит откатывается прямо к тексту снимка, даже если его патч уже не подходит
+            to_be_rolled_back = to_be_rolled_back._replace(
+                patch=self.strict_dmp.patch_make(self.model_text.text, checkpoint.text))
         pop_stack.append((to_be_rolled_back, to_be_roll_forward))
         return to_be_rolled_back, to_be_roll_forward
 
     def _rollback(self, to_be_rolled_back_patch):
-        patchedText, result, commands = self.strict_dmp.patch_apply(to_be_rolled_back_patch, self.model_text)
+        result, commands = self.strict_dmp.patch_applyInPlace(to_be_rolled_back_patch, self.model_text)
         serialized = '\n'.join([str(patch) for patch in to_be_rolled_back_patch])
         if False in result:
             raise RollbackFailedException(
@@ -99,62 +368,154 @@ class TimeMachine(object):
                 'Cannot rollback history. <patch>{0}</patch>'.format(serialized))
         self.logger.debug('rolled back: <patch>%s</patch>', serialized)
         self.logger.debug('rolled back commands: %s', commands)
-        self.model_text = patchedText
         return commands
 
     # noinspection PyUnusedLocal
     def start_recovery(self, patch_objects, timestamp):
         """
-        Процедура RECOVERY.
+        Процедура RECOVERY. Глубина истории, на тексте которой сделан патч, ищется по свернутым изменениям коммитов
+        (recovery.PatchLocator) без отката текста. Если куски патча не задеты коммитами выше этой глубины, патч
+        просто сдвигается в текущий текст: неподтвержденные локальные патчи координатор перенесет сам. Иначе
+        откатывается самый новый коммит, задевающий куски патча (см. _conflicting_commit), а более новые коммиты
+        остаются и сдвигаются в текст без него. Так повторяется, пока патч не найдет свою глубину, поэтому
+        откатываются только конфликтующие коммиты.
         :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj] Список патчей
         :param timestamp: временная метка
-        :return tuple of ([rollforward_command], [rollback_command]) which can be applied to sublime's view
+        :return tuple of ([rollforward_command], [rollback_command], d1d3): команды переводят view из текущего
+        текста в откаченный и из откаченного в итоговый (self.model_text); d1d3 - откаченный текст с патчем
+        :raise RecoveryFailedException: патч не подходит ни к одной сохраненной точке истории
+        :raise RecoveryBudgetExceededException: RECOVERY обходится дороже, чем позволяет self.budget
         """
         assert self.owner.name != 'Coordinator'
         self.logger.info('starting recovery...')
-        text_before = self.owner.currentText
+        self.budget.start()
         # to be recovered text:
-        self.model_text = self.owner.currentText
+        self.model_text = self.owner.text_model.copy()
         pop_stack = []
         rollback_commands = []
-        d1d3 = None
-        while True:  # todo: what if there is no pop and match?
-            # pop one commit, roll it back and try patch
-            to_be_rolled_back, _ = self._pop_one_commit(pop_stack)
-            rollback_command = self._rollback(to_be_rolled_back.patch)
-            rollback_commands.extend(rollback_command)
-            # try patch
-            perfectly_patched_text = self._try_patch(patch_objects)
-            if perfectly_patched_text is not None:
-                self.model_text = perfectly_patched_text
-                d1d3 = self.model_text  # currentText = d1+d3
-                self._rollforward(pop_stack)
-                self.logger.info('recovery has stopped. Everything seems okay now. Lets try again')
-                break
-        patches = self.strict_dmp.patch_make(d1d3, self.model_text)
-        patched_text, result, rollforward_commands = self.strict_dmp.patch_apply(patches, d1d3)
+        try:
+            while True:
+                locator = PatchLocator(patch_objects)
+                depth, shifts = self._locate_depth(locator)
+                patched = self._try_patch(locator.rebased(shifts)) if shifts is not None else None
+                if patched is not None:
+                    break
+                index = self._conflicting_commit(locator)
+                if index is None:
+                    raise RecoveryFailedException('patch does not fit any retained point of the history')
+                self.budget.check(len(pop_stack) + 1)
+                rollback_commands.extend(self._remove_commit(index, pop_stack))
+        except RollbackFailedException as e:
+            raise RecoveryFailedException(str(e))
+        self.model_text, rollforward_commands = patched
+        d1d3 = self.model_text.text  # currentText = d1+d3
+        rollforward_commands.extend(self._rollforward(pop_stack))
+        self.logger.info('recovery has stopped after %d rollbacks, the patch is rebased over %d commits. '
+                         'Everything seems okay now. Lets try again', len(pop_stack), depth)
         return rollforward_commands, rollback_commands, d1d3  # d1 -> d1+d3(+)d2, d1+d2 -> d1
 
+    def _conflicting_commit(self, locator):
+        """
+        Самый новый коммит, изменения которого задевают куски патча. Куски берутся на своих позициях в текущем
+        тексте: если координатор ведет ревизии, патч уже сдвинут через неподтвержденные локальные патчи
+        (core.core.DiffMatchPatchAlgorithm.remote_applyPatchObjects), иначе позиции приблизительны. Если куски
+        не задевает ни один коммит, конфликтующим считается последний: коммиты откатываются по одному
+        :return: int номер коммита в истории или None, если история пуста
+        """
+        ranges = []
+        for start, text1 in locator.hunks:
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], start + len(text1)))
+            else:
+                ranges.append((start, start + len(text1)))
+        entries = self.history.history
+        for index in xrange(len(entries) - 1, -1, -1):
+            self.budget.check()
+            changes = patch_changes(entries[index].patch)
+            if intersects(ranges, invert(changes)):
+                return index
+            ranges = back(changes, ranges)
+        return len(entries) - 1 if entries else None
+
+    def _remove_commit(self, index, pop_stack):
+        """
+        Откатить коммит index. Более новые коммиты остаются: их патчи сдвигаются в текст без него (core.oplog.shift).
+        Если кусок патча более нового коммита задевает его изменения, сначала откатывается этот более новый коммит
+        :return: команды отката
+        """
+        entries = self.history.history
+        if index or self.history.checkpoint is None:
+            blocking = index
+            while blocking is not None:
+                index, blocking = blocking, None
+                forward = entries[index]
+                undo = invert(patch_changes(forward.patch))
+                newer = []
+                for position in xrange(index + 1, len(entries)):
+                    entry = entries[position]
+                    if intersects(hunk_ranges(entry.patch), undo):
+                        blocking = position
+                        break
+                    newer.append(entry._replace(patch=shift(self.strict_dmp.patch_deepCopy(entry.patch), undo)))
+                    undo = advance(undo, patch_changes(entry.patch))
+            # коммит как будто сделан последним: его патч в координатах текущего текста
+            current = rebase(self.strict_dmp.patch_deepCopy(forward.patch),
+                             [Operation(None, None, entry.patch) for entry in newer])
+            model = self.model_text.copy()
+            result, commands = self.strict_dmp.patch_applyInPlace(list(InversePatch(current)), model)
+            if False not in result:
+                self.model_text = model
+                backward, _ = self.history.remove(index, newer)
+                pop_stack.append((backward, forward._replace(patch=current)))
+                self.logger.debug('rolled back the commit %d, %d newer commits are kept', index, len(newer))
+                return list(commands)
+        commands = []
+        while len(self.history) > index:
+            self.budget.check(len(pop_stack) + 1)
+            commands.extend(self._rollback(self._pop_one_commit(pop_stack)[0].patch))
+        return commands
+
+    def _locate_depth(self, locator):
+        """
+        :return: tuple (глубина, сдвиги кусков патча) или (None, None), если куски патча задеты коммитами
+        на любой глубине
+        """
+        entries = self.history.history
+        for index in xrange(len(entries) - 1, -1, -1):
+            shifts = locator.shifts(self.model_text)
+            if shifts is not None:
+                return locator.depth, shifts
+            self.budget.check()
+            locator.descend(entries[index].patch)
+        shifts = locator.shifts(self.model_text)
+        return (locator.depth, shifts) if shifts is not None else (None, None)
+
     def _try_patch(self, patch_objects):
         """
         Попробовать применить патч
         :param patch_objects:
-        :return: bool is successful patch
+        :return: tuple (пропатченная копия self.model_text, команды) или None, если патч не применяется идеально
         """
-        patchedText, result, commands = self.strict_dmp.patch_apply(patch_objects, self.model_text)
+        patched_model = self.model_text.copy()
+        result, commands = self.strict_dmp.patch_applyInPlace(patch_objects, patched_model)
         if False in result:
             return None
         else:
             # everything all right rolled back and patch is perfect match this version
             self.logger.debug('conflicts are fixed. The following patch\'s applied: <patch>%s</patch>',
                               ''.join([str(patch) for patch in patch_objects]))
-            return patchedText
+            return patched_model, list(commands)
 
     def _rollforward(self, pop_stack):
+        """
+        :return: команды, которые накатывают откаченные коммиты
+        """
+        rollforward_commands = []
         for _, forward in reversed(pop_stack):
-            patchedText, result, commands = self.loose_dmp.patch_apply(forward.patch, self.model_text)
+            result, commands = self.loose_dmp.patch_applyInPlace(forward.patch, self.model_text)
+            rollforward_commands.extend(commands)
             serialized = '\n'.join([str(patch) for patch in forward.patch])
             if False in result:
                 self.logger.debug('could not roll forward even with loose matching: <patch>%s</patch>', serialized)
-            self.model_text = patchedText
-            self.logger.debug('rolled forward: <patch>%s</patch>', serialized)
\ No newline at end of file
+            self.logger.debug('rolled forward: <patch>%s</patch>', serialized)
+        return rollforward_commands
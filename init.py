@@ -7,10 +7,13 @@ from twisted.internet import task, threads
 import main
 from misc import erase_view
 import misc
+from scheduler import SyncScheduler
 
 __author__ = 'snowy'
 
 import logging
+import os
+import tempfile
 # noinspection PyUnresolvedReferences
 import sublime
 import sublime_plugin
@@ -26,6 +29,12 @@ registry = {}
 
 RegistryEntry = namedtuple('RegistryEntry', ['application', 'connection_string'])
 
+scheduler = SyncScheduler(reactor)
+"""Синхронизация всех shared view"""
+
+COORDINATOR_STORAGE = os.path.join(tempfile.gettempdir(), 'collaboration-sublime-text')
+"""Каталог, куда координатор выгружает простаивающие документы"""
+
 
 class ViewIsNotInitializedError(Exception):
     pass
@@ -48,9 +57,13 @@ def run_server(view):
     return app.setUpServerFromStr('tcp:0').addCallback(_cb)
 
 
-def run_client(view, connection_str):
+def run_client(view, connection_str, document=None):
+    """
+    :param document: unicode идентификатор документа на координаторе (None - документ по умолчанию)
+    """
     assert view.id() in registry, "view's id must be in registry"
     app = registry[view.id()].application
+    app.algorithm.document = document
 
     # noinspection PyUnusedLocal
     def _cb(client_proto):
@@ -107,11 +120,16 @@ class AcceptConnections(sublime_plugin.WindowCommand):
         view = self.window.active_view()
         terminate_collaboration(view.id())
         initial_text = misc.all_text_view(view)
-        d_list = [run_server(view), run_coordinator_server(initial_text)]
+        # координатор уже запущен для другого view - документ открывается на нем же
+        document = document_name(view) if local_coordinator() is not None else None
+        d_list = [run_server(view), run_coordinator_server(initial_text, document)]
 
         def _servers_up(_):
-            run_client(view, registry['coordinator'].connection_string)
+            run_client(view, registry['coordinator'].connection_string, document)
             logger.info(registry['coordinator'].connection_string)
+            if document is not None:
+                sublime.status_message('Document "{0}" is shared. Connect with "{1}#{0}"'.format(
+                    document, registry['coordinator'].connection_string))
             sublime.run_command('collaboration', {'listening': 'start', 'view_id': view.id()})
 
         defer.DeferredList(d_list).addCallback(_servers_up)
@@ -155,11 +173,16 @@ class ConnectToCoordinator(sublime_plugin.WindowCommand):
 
 
 def on_get_connection_str(window, conn_str):
+    """
+    :param conn_str: строка подключения к координатору, после # - идентификатор документа
+    """
+    conn_str, _, document = conn_str.partition('#')
+    document = document or None
     if 'coordinator' not in registry:
         registry['coordinator'] = RegistryEntry(application=None, connection_string=conn_str)
     view = window.active_view()
     try:
-        d = run_server(view).addCallback(lambda _: run_client(view, conn_str))
+        d = run_server(view).addCallback(lambda _: run_client(view, conn_str, document))
         d.addCallback(lambda _: sublime.run_command('collaboration', {'listening': 'start', 'view_id': view.id()}))
     except BaseException as e:
         logger.error("Couldn't connect to %s. An error occurred: %s", conn_str, e.message)
@@ -167,10 +190,37 @@ def on_get_connection_str(window, conn_str):
             del registry['coordinator']
 
 
-def run_coordinator_server(initial_text):
+def local_coordinator():
+    """
+    :return: CoordinatorApplication, запущенный в этом процессе, или None
+    """
+    entry = registry.get('coordinator')
+    return entry.application if entry is not None else None
+
+
+def document_name(view):
+    """
+    Идентификатор документа view на координаторе: полный путь файла (одноименные файлы разных каталогов - разные
+    документы) или id view без файла
+    """
+    return view.file_name() if view.file_name() else u'view-{0}'.format(view.id())
+
+
+def run_coordinator_server(initial_text, document=None):
+    """
+    Запустить координатор или, если он уже запущен в этом процессе, открыть на нем документ.
+    Один координатор обслуживает все документы через порт 13256
+    :param document: unicode идентификатор документа (None - документ по умолчанию)
+    """
     from core.core import CoordinatorApplication
+    from core.documents import DEFAULT_DOCUMENT
 
-    app = CoordinatorApplication(reactor, initial_text=initial_text)
+    coordinator = local_coordinator()
+    if coordinator is not None:
+        coordinator.open_document(document if document is not None else DEFAULT_DOCUMENT, initial_text)
+        return defer.succeed(registry['coordinator'].connection_string)
+
+    app = CoordinatorApplication(reactor, initial_text=initial_text, storage_directory=COORDINATOR_STORAGE)
     logger.debug('%s is created', app.name)
 
     def _cb(client_connection_string):
@@ -194,19 +244,6 @@ class ViewsDivergeException(Exception):
 
 
 class Collaboration(sublime_plugin.ApplicationCommand):
-    def __init__(self):
-        self.view_id2task = {}
-
-    def _get_task(self, view_id):
-        if view_id not in self.view_id2task:
-            from twisted.internet import task
-
-            _task = task.LoopingCall(main.run_every_second(view_id))
-            self.view_id2task[view_id] = _task
-        else:
-            _task = self.view_id2task[view_id]
-        return _task
-
     @staticmethod
     def _preconditions(view_id):
         if view_id is None:
@@ -214,18 +251,39 @@ class Collaboration(sublime_plugin.ApplicationCommand):
 
     def run(self, listening=None, view_id=None):
         self._preconditions(view_id)
-        _task = self._get_task(view_id)
 
         if listening == 'start':
-            if not _task.running:
-                _task.start(1.0)
+            scheduler.add(view_id, main.sync_view(view_id))
         elif listening == 'stop':
-            if _task.running:
-                _task.stop()
+            scheduler.remove(view_id)
         else:
             raise TypeError('"listening" argument legal values are "start" or "stop".')
 
 
+class CollaborationEventListener(sublime_plugin.EventListener):
+    """
+    Передает события редактирования shared view в ChangeTracker соответствующего приложения
+    """
+
+    @staticmethod
+    def _tracker(view):
+        entry = registry.get(view.id())
+        if entry is None or entry.application is None:
+            return None
+        return getattr(entry.application, 'tracker', None)
+
+    def on_modified(self, view):
+        tracker = self._tracker(view)
+        if tracker is not None:
+            tracker.modified(view.size(), misc.view_selection(view), view.change_count())
+            scheduler.wake(view.id())
+
+    def on_selection_modified(self, view):
+        tracker = self._tracker(view)
+        if tracker is not None:
+            tracker.selection_modified(misc.view_selection(view))
+
+
 def terminate_collaboration(view_id):
     assert Collaboration
     sublime.run_command('collaboration', {'listening': 'stop', 'view_id': view_id})
@@ -1,2 +1,2 @@
-from .diff_match_patch import diff_match_patch, patch_obj
+from .diff_match_patch import diff_match_patch, diff_task, patch_obj
 
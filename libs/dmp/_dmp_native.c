@@ -0,0 +1,398 @@
+/*
+ * Компилированные ядра diff_match_patch: общий префикс/суффикс, поиск "middle snake" (diff_bisect)
+ * и поиск Bitap (match_bitap). Модуль необязательный: если он не собран, diff_match_patch работает
+ * на чистом питоне. Результаты совпадают с питоновской реализацией символ в символ.
+ *
+ * Сборка: python build_native.py
+ */
+#include <Python.h>
+
+#define BITAP_MAX_BITS 63
+
+typedef unsigned PY_LONG_LONG bitmask_t;
+
+static PyObject *time_time = NULL;
+
+/* Текст str или unicode без копирования */
+typedef struct {
+    const unsigned char *bytes;
+    const Py_UNICODE *chars;
+    Py_ssize_t length;
+} text_t;
+
+#define CHAR_AT(text, i) ((text).chars != NULL ? (Py_UCS4)(text).chars[i] : (Py_UCS4)(text).bytes[i])
+
+static int
+get_text(PyObject *object, text_t *text)
+{
+    if (PyString_Check(object)) {
+        text->bytes = (const unsigned char *)PyString_AS_STRING(object);
+        text->chars = NULL;
+        text->length = PyString_GET_SIZE(object);
+        return 0;
+    }
+    if (PyUnicode_Check(object)) {
+        text->bytes = NULL;
+        text->chars = PyUnicode_AS_UNICODE(object);
+        text->length = PyUnicode_GET_SIZE(object);
+        return 0;
+    }
+    PyErr_SetString(PyExc_TypeError, "str or unicode expected");
+    return -1;
+}
+
+/* Оба текста одного типа: str с unicode питон сравнивает через декодирование, здесь этого нет */
+static int
+get_texts(PyObject *object1, PyObject *object2, text_t *text1, text_t *text2)
+{
+    if (get_text(object1, text1) < 0 || get_text(object2, text2) < 0)
+        return -1;
+    if ((text1->chars == NULL) != (text2->chars == NULL)) {
+        PyErr_SetString(PyExc_TypeError, "texts must be of the same type");
+        return -1;
+    }
+    return 0;
+}
+
+/* 1 - время вышло, 0 - нет, -1 - ошибка */
+static int
+deadline_passed(double deadline)
+{
+    PyObject *now = PyObject_CallObject(time_time, NULL);
+    double seconds;
+    if (now == NULL)
+        return -1;
+    seconds = PyFloat_AsDouble(now);
+    Py_DECREF(now);
+    if (seconds == -1.0 && PyErr_Occurred())
+        return -1;
+    return seconds > deadline;
+}
+
+PyDoc_STRVAR(common_prefix_doc,
+"common_prefix(text1, text2) -> int\n\nNumber of characters common to the start of each string.");
+
+static PyObject *
+dmp_common_prefix(PyObject *self, PyObject *args)
+{
+    PyObject *object1, *object2;
+    text_t text1, text2;
+    Py_ssize_t i, length;
+
+    if (!PyArg_ParseTuple(args, "OO:common_prefix", &object1, &object2))
+        return NULL;
+    if (get_texts(object1, object2, &text1, &text2) < 0)
+        return NULL;
+    length = text1.length < text2.length ? text1.length : text2.length;
+    for (i = 0; i < length && CHAR_AT(text1, i) == CHAR_AT(text2, i); i++)
+        ;
+    return PyInt_FromSsize_t(i);
+}
+
+PyDoc_STRVAR(common_suffix_doc,
+"common_suffix(text1, text2) -> int\n\nNumber of characters common to the end of each string.");
+
+static PyObject *
+dmp_common_suffix(PyObject *self, PyObject *args)
+{
+    PyObject *object1, *object2;
+    text_t text1, text2;
+    Py_ssize_t i, length;
+
+    if (!PyArg_ParseTuple(args, "OO:common_suffix", &object1, &object2))
+        return NULL;
+    if (get_texts(object1, object2, &text1, &text2) < 0)
+        return NULL;
+    length = text1.length < text2.length ? text1.length : text2.length;
+    for (i = 0; i < length && CHAR_AT(text1, text1.length - i - 1) == CHAR_AT(text2, text2.length - i - 1); i++)
+        ;
+    return PyInt_FromSsize_t(i);
+}
+
+PyDoc_STRVAR(bisect_doc,
+"bisect(text1, text2, deadline, max_steps=-1) -> (x, y, steps)\n\n"
+"Find the 'middle snake' of a diff (see diff_match_patch.diff_bisectSteps).\n"
+"Returns the split point and the number of steps made. x and y are -1 if there is no\n"
+"commonality or if the deadline or max_steps (negative for no limit) is reached first.");
+
+static PyObject *
+dmp_bisect(PyObject *self, PyObject *args)
+{
+    PyObject *object1, *object2, *result = NULL;
+    text_t text1, text2;
+    double deadline;
+    Py_ssize_t max_steps = -1;
+    Py_ssize_t text1_length, text2_length, max_d, v_offset, v_length, delta;
+    Py_ssize_t k1start = 0, k1end = 0, k2start = 0, k2end = 0;
+    Py_ssize_t d, k1, k2, k1_offset, k2_offset, x1, y1, x2, y2, i;
+    Py_ssize_t *v1 = NULL, *v2 = NULL;
+    int front, passed;
+
+    if (!PyArg_ParseTuple(args, "OOd|n:bisect", &object1, &object2, &deadline, &max_steps))
+        return NULL;
+    if (get_texts(object1, object2, &text1, &text2) < 0)
+        return NULL;
+
+    text1_length = text1.length;
+    text2_length = text2.length;
+    max_d = (text1_length + text2_length + 1) / 2;
+    v_offset = max_d;
+    v_length = 2 * max_d;
+    /* запас в пару элементов: питоновская версия не выходит за границы только благодаря порядку проверок */
+    v1 = PyMem_New(Py_ssize_t, v_length + 2);
+    v2 = PyMem_New(Py_ssize_t, v_length + 2);
+    if (v1 == NULL || v2 == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i = 0; i < v_length + 2; i++)
+        v1[i] = v2[i] = -1;
+    v1[v_offset + 1] = 0;
+    v2[v_offset + 1] = 0;
+    delta = text1_length - text2_length;
+    front = (delta % 2 != 0);
+
+    for (d = 0; d < max_d; d++) {
+        if (d == max_steps)
+            break;
+        passed = deadline_passed(deadline);
+        if (passed < 0)
+            goto done;
+        if (passed)
+            break;
+
+        for (k1 = -d + k1start; k1 < d + 1 - k1end; k1 += 2) {
+            k1_offset = v_offset + k1;
+            if (k1 == -d || (k1 != d && v1[k1_offset - 1] < v1[k1_offset + 1]))
+                x1 = v1[k1_offset + 1];
+            else
+                x1 = v1[k1_offset - 1] + 1;
+            y1 = x1 - k1;
+            while (x1 < text1_length && y1 < text2_length && CHAR_AT(text1, x1) == CHAR_AT(text2, y1)) {
+                x1++;
+                y1++;
+            }
+            v1[k1_offset] = x1;
+            if (x1 > text1_length) {
+                k1end += 2;
+            }
+            else if (y1 > text2_length) {
+                k1start += 2;
+            }
+            else if (front) {
+                k2_offset = v_offset + delta - k1;
+                if (k2_offset >= 0 && k2_offset < v_length && v2[k2_offset] != -1) {
+                    x2 = text1_length - v2[k2_offset];
+                    if (x1 >= x2) {
+                        result = Py_BuildValue("(nnn)", x1, y1, d + 1);
+                        goto done;
+                    }
+                }
+            }
+        }
+
+        for (k2 = -d + k2start; k2 < d + 1 - k2end; k2 += 2) {
+            k2_offset = v_offset + k2;
+            if (k2 == -d || (k2 != d && v2[k2_offset - 1] < v2[k2_offset + 1]))
+                x2 = v2[k2_offset + 1];
+            else
+                x2 = v2[k2_offset - 1] + 1;
+            y2 = x2 - k2;
+            while (x2 < text1_length && y2 < text2_length &&
+                   CHAR_AT(text1, text1_length - x2 - 1) == CHAR_AT(text2, text2_length - y2 - 1)) {
+                x2++;
+                y2++;
+            }
+            v2[k2_offset] = x2;
+            if (x2 > text1_length) {
+                k2end += 2;
+            }
+            else if (y2 > text2_length) {
+                k2start += 2;
+            }
+            else if (!front) {
+                k1_offset = v_offset + delta - k2;
+                if (k1_offset >= 0 && k1_offset < v_length && v1[k1_offset] != -1) {
+                    x1 = v1[k1_offset];
+                    y1 = v_offset + x1 - k1_offset;
+                    x2 = text1_length - x2;
+                    if (x1 >= x2) {
+                        result = Py_BuildValue("(nnn)", x1, y1, d + 1);
+                        goto done;
+                    }
+                }
+            }
+        }
+    }
+    result = Py_BuildValue("(nnn)", (Py_ssize_t)-1, (Py_ssize_t)-1, d);
+
+done:
+    PyMem_Free(v1);
+    PyMem_Free(v2);
+    return result;
+}
+
+/* Алфавит Bitap: маска позиций символа в шаблоне */
+typedef struct {
+    bitmask_t ascii[256];
+    Py_UCS4 chars[BITAP_MAX_BITS];
+    bitmask_t masks[BITAP_MAX_BITS];
+    Py_ssize_t count;
+} alphabet_t;
+
+static void
+alphabet_init(alphabet_t *alphabet, text_t *pattern)
+{
+    Py_ssize_t i, j;
+    Py_UCS4 c;
+    bitmask_t bit;
+
+    memset(alphabet, 0, sizeof(alphabet_t));
+    for (i = 0; i < pattern->length; i++) {
+        c = CHAR_AT(*pattern, i);
+        bit = (bitmask_t)1 << (pattern->length - i - 1);
+        if (c < 256) {
+            alphabet->ascii[c] |= bit;
+            continue;
+        }
+        for (j = 0; j < alphabet->count && alphabet->chars[j] != c; j++)
+            ;
+        if (j == alphabet->count) {
+            alphabet->chars[j] = c;
+            alphabet->count++;
+        }
+        alphabet->masks[j] |= bit;
+    }
+}
+
+static bitmask_t
+alphabet_get(alphabet_t *alphabet, Py_UCS4 c)
+{
+    Py_ssize_t j;
+    if (c < 256)
+        return alphabet->ascii[c];
+    for (j = 0; j < alphabet->count; j++)
+        if (alphabet->chars[j] == c)
+            return alphabet->masks[j];
+    return 0;
+}
+
+static double
+bitap_score(Py_ssize_t e, Py_ssize_t x, Py_ssize_t loc, Py_ssize_t pattern_length, double distance)
+{
+    double accuracy = (double)e / pattern_length;
+    Py_ssize_t proximity = loc > x ? loc - x : x - loc;
+    if (distance == 0.0)
+        return proximity ? 1.0 : accuracy;
+    return accuracy + proximity / distance;
+}
+
+PyDoc_STRVAR(bitap_doc,
+"bitap(text, pattern, loc, score_threshold, distance) -> int\n\n"
+"Bitap search of diff_match_patch.match_bitap after the exact match speedups.\n"
+"The pattern must not be longer than MAX_BITS. Returns best match index or -1.");
+
+static PyObject *
+dmp_bitap(PyObject *self, PyObject *args)
+{
+    PyObject *text_object, *pattern_object, *result = NULL;
+    text_t text, pattern;
+    Py_ssize_t loc, m, n, d, j, bin_min, bin_mid, bin_max, start, finish, best_loc = -1;
+    double score_threshold, distance, score;
+    bitmask_t matchmask, char_match;
+    bitmask_t *rd = NULL, *last_rd = NULL;
+    alphabet_t alphabet;
+
+    if (!PyArg_ParseTuple(args, "OOndd:bitap", &text_object, &pattern_object, &loc, &score_threshold, &distance))
+        return NULL;
+    if (get_texts(text_object, pattern_object, &text, &pattern) < 0)
+        return NULL;
+    m = pattern.length;
+    n = text.length;
+    if (m < 1 || m > BITAP_MAX_BITS) {
+        PyErr_SetString(PyExc_ValueError, "pattern length is out of range");
+        return NULL;
+    }
+    alphabet_init(&alphabet, &pattern);
+
+    matchmask = (bitmask_t)1 << (m - 1);
+    bin_max = m + n;
+    for (d = 0; d < m; d++) {
+        bin_min = 0;
+        bin_mid = bin_max;
+        while (bin_min < bin_mid) {
+            if (bitap_score(d, loc + bin_mid, loc, m, distance) <= score_threshold)
+                bin_min = bin_mid;
+            else
+                bin_max = bin_mid;
+            bin_mid = (bin_max - bin_min) / 2 + bin_min;
+        }
+        bin_max = bin_mid;
+        start = loc - bin_mid + 1 > 1 ? loc - bin_mid + 1 : 1;
+        finish = (loc + bin_mid < n ? loc + bin_mid : n) + m;
+
+        rd = PyMem_New(bitmask_t, finish + 2);
+        if (rd == NULL) {
+            PyErr_NoMemory();
+            goto done;
+        }
+        memset(rd, 0, (finish + 2) * sizeof(bitmask_t));
+        rd[finish + 1] = ((bitmask_t)1 << d) - 1;
+        /* границы цикла, как и у xrange в питоновской версии, вычисляются один раз */
+        for (j = finish; j >= start; j--) {
+            char_match = n <= j - 1 ? 0 : alphabet_get(&alphabet, CHAR_AT(text, j - 1));
+            if (d == 0)
+                rd[j] = ((rd[j + 1] << 1) | 1) & char_match;
+            else
+                rd[j] = (((rd[j + 1] << 1) | 1) & char_match) |
+                        (((last_rd[j + 1] | last_rd[j]) << 1) | 1) | last_rd[j + 1];
+            if (rd[j] & matchmask) {
+                score = bitap_score(d, j - 1, loc, m, distance);
+                if (score <= score_threshold) {
+                    score_threshold = score;
+                    best_loc = j - 1;
+                    if (best_loc <= loc)
+                        break;
+                }
+            }
+        }
+        if (bitap_score(d + 1, loc, loc, m, distance) > score_threshold)
+            break;
+        PyMem_Free(last_rd);
+        last_rd = rd;
+        rd = NULL;
+    }
+    result = PyInt_FromSsize_t(best_loc);
+
+done:
+    PyMem_Free(rd);
+    PyMem_Free(last_rd);
+    return result;
+}
+
+static PyMethodDef dmp_methods[] = {
+    {"common_prefix", dmp_common_prefix, METH_VARARGS, common_prefix_doc},
+    {"common_suffix", dmp_common_suffix, METH_VARARGS, common_suffix_doc},
+    {"bisect", dmp_bisect, METH_VARARGS, bisect_doc},
+    {"bitap", dmp_bitap, METH_VARARGS, bitap_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+init_dmp_native(void)
+{
+    PyObject *module, *time_module;
+
+    time_module = PyImport_ImportModule("time");
+    if (time_module == NULL)
+        return;
+    time_time = PyObject_GetAttrString(time_module, "time");
+    Py_DECREF(time_module);
+    if (time_time == NULL)
+        return;
+
+    module = Py_InitModule3("_dmp_native", dmp_methods, "Compiled cores of diff_match_patch");
+    if (module == NULL)
+        return;
+    PyModule_AddIntConstant(module, "MAX_BITS", BITAP_MAX_BITS);
+}
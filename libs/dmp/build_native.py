@@ -0,0 +1,32 @@
+# coding=utf-8
+"""
+Сборка необязательного компилированного модуля _dmp_native рядом с diff_match_patch.py:
+
+    python build_native.py
+
+Собирать тем же питоном, которым запускается плагин. Без модуля diff_match_patch работает на чистом питоне.
+"""
+import os
+import shutil
+import tempfile
+from distutils.core import setup, Extension
+
+__author__ = 'snowy'
+
+
+def build():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    build_temp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        setup(name='_dmp_native',
+              ext_modules=[Extension('_dmp_native', ['_dmp_native.c'])],
+              script_args=['build_ext', '--inplace', '--build-temp', build_temp])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(build_temp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    build()
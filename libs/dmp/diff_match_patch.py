@@ -31,12 +31,23 @@ Applies the patch onto another text, allowing for errors.
 
 __author__ = 'fraser@google.com (Neil Fraser)'
 
+import bisect
 import math
 import re
 import sys
 import time
 import urllib
 
+try:
+    # необязательный компилированный модуль, собирается build_native.py
+    import _dmp_native
+except ImportError:
+    _dmp_native = None
+
+# Sublime counts buffer offsets in code points, a narrow Python build counts
+# UTF-16 code units: a character outside the BMP is a surrogate pair there.
+NARROW_BUILD = sys.maxunicode == 0xFFFF
+
 class diff_match_patch:
     """Class containing the diff, match and patch methods.
 
@@ -44,6 +55,8 @@ class diff_match_patch:
     """
     view = None
     ":type view: sublime.View"
+    native = _dmp_native
+    "Компилированные ядра diff и match (модуль _dmp_native) или None - все на чистом питоне"
 
     def __init__(self):
         """Inits a diff_match_patch object with default settings.
@@ -54,12 +67,20 @@ class diff_match_patch:
         self.Diff_Timeout = 1.0
         # Cost of an empty edit operation in terms of edit characters.
         self.Diff_EditCost = 4
+        # Lines occurring more often than this are not used to split a line-level diff.
+        self.Diff_LineChain = 64
+        # Largest line-level problem (lines1 * lines2) solved by the bit-parallel LCS
+        # when no rare common line is found.  Larger ones are left to the character diff.
+        self.Diff_LineLcsCells = 10000000
         # At what point is no match declared (0.0 = perfection, 1.0 = very loose).
         self.Match_Threshold = 0.0
         # How far to search for a match (0 = exact location, 1000+ = broad match).
         # A match this many characters away from the expected location will add
         # 1.0 to the score (0.0 is a perfect match).
         self.Match_Distance = 1000
+        # How many alphabets of recently matched patterns to keep (see match_alphabet).
+        self.Match_AlphabetCacheSize = 256
+        self._alphabets = {}
         # When deleting a large block of text (over ~64 characters), how close do
         # the contents have to be to match the expected contents. (0.0 = perfection,
         # 1.0 = very loose).  Note that Match_Threshold controls how closely the
@@ -80,11 +101,25 @@ class diff_match_patch:
         # пример:
         # на вход) текст1 и патч1
         # на выходе) текст2 (= текст1+патч1) и список команд саблайма, которые производят патчинг (над view объектом).
+        # Команды минимальны (только изменившиеся символы), без null padding, в позициях саблайма (см.
+        # patch_sublimeCommand) и выполняются по порядку.
         self.sublime_patch_commands = []
 
         # Размер null padding в тексте
         self.sublime_null_padding_len = None
 
+        # (позиция в буфере, сколько символов саблайма до нее) после последней команды patch_applyInPlace:
+        # на узкой сборке python следующая команда досчитывает символы от нее, а не от начала текста.
+        # None - считать от начала
+        self.sublime_cursor = None
+
+        # Замены последнего patch_applyInPlace в порядке применения: точные патчи без null padding, с контекстом
+        # не длиннее Patch_Margin, в координатах текста на момент замены. По ним строится откат без диффа текстов
+        self.sublime_applied_patches = []
+
+        # False, если последний дифф (diff_main, patch_make) прерван по Diff_Timeout и не минимален
+        self.diff_optimal = True
+
     # DIFF FUNCTIONS
 
     # The data structure representing a diff is an array of tuples:
@@ -112,6 +147,7 @@ class diff_match_patch:
         """
         # Set a deadline by which time the diff must be complete.
         if deadline == None:
+            self.diff_optimal = True
             # Unlike in most languages, Python counts time in seconds.
             if self.Diff_Timeout <= 0:
                 deadline = sys.maxint
@@ -169,6 +205,38 @@ class diff_match_patch:
         Returns:
           Array of changes.
         """
+        diffs = self.diff_computeTrivial(text1, text2)
+        if diffs is not None:
+            return diffs
+
+        # Check to see if the problem can be split in two.
+        hm = self.diff_halfMatch(text1, text2)
+        if hm:
+            # A half-match was found, sort out the return data.
+            (text1_a, text1_b, text2_a, text2_b, mid_common) = hm
+            # Send both pairs off for separate processing.
+            diffs_a = self.diff_main(text1_a, text2_a, checklines, deadline)
+            diffs_b = self.diff_main(text1_b, text2_b, checklines, deadline)
+            # Merge the results.
+            return diffs_a + [(self.DIFF_EQUAL, mid_common)] + diffs_b
+
+        if checklines and len(text1) > 100 and len(text2) > 100:
+            return self.diff_lineMode(text1, text2, deadline)
+
+        return self.diff_bisect(text1, text2, deadline)
+
+    def diff_computeTrivial(self, text1, text2):
+        """Find the differences between two texts without common prefix or
+          suffix if no search is needed: one text is empty, inside the other
+          or a single character.
+
+        Args:
+          text1: Old string to be diffed.
+          text2: New string to be diffed.
+
+        Returns:
+          Array of changes or None.
+        """
         if not text1:
             # Just add some text (speedup).
             return [(self.DIFF_INSERT, text2)]
@@ -197,21 +265,7 @@ class diff_match_patch:
             # After the previous speedup, the character can't be an equality.
             return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
 
-        # Check to see if the problem can be split in two.
-        hm = self.diff_halfMatch(text1, text2)
-        if hm:
-            # A half-match was found, sort out the return data.
-            (text1_a, text1_b, text2_a, text2_b, mid_common) = hm
-            # Send both pairs off for separate processing.
-            diffs_a = self.diff_main(text1_a, text2_a, checklines, deadline)
-            diffs_b = self.diff_main(text1_b, text2_b, checklines, deadline)
-            # Merge the results.
-            return diffs_a + [(self.DIFF_EQUAL, mid_common)] + diffs_b
-
-        if checklines and len(text1) > 100 and len(text2) > 100:
-            return self.diff_lineMode(text1, text2, deadline)
-
-        return self.diff_bisect(text1, text2, deadline)
+        return None
 
     def diff_lineMode(self, text1, text2, deadline):
         """Do a quick line-level diff on both strings, then rediff the parts for
@@ -226,16 +280,7 @@ class diff_match_patch:
         Returns:
           Array of changes.
         """
-
-        # Scan the text on a line-by-line basis first.
-        (text1, text2, linearray) = self.diff_linesToChars(text1, text2)
-
-        diffs = self.diff_main(text1, text2, False, deadline)
-
-        # Convert the diff back to original text.
-        self.diff_charsToLines(diffs, linearray)
-        # Eliminate freak matches (e.g. blank lines)
-        self.diff_cleanupSemantic(diffs)
+        diffs = self.diff_lineBlocks(text1, text2, deadline)
 
         # Rediff any replacement blocks, this time character-by-character.
         # Add a dummy entry at the end.
@@ -270,6 +315,215 @@ class diff_match_patch:
 
         return diffs
 
+    def diff_lineBlocks(self, text1, text2, deadline):
+        """Line-level diff of two strings, the first half of diff_lineMode.
+
+        Args:
+          text1: Old string to be diffed.
+          text2: New string to be diffed.
+          deadline: Time when the diff should be complete by.
+
+        Returns:
+          Array of changes of whole lines.
+        """
+
+        # Scan the text on a line-by-line basis first.
+        (lines1, lines2, lineArray) = self.diff_linesToInts(text1, text2)
+
+        diffs = []
+        pointer1 = 0
+        pointer2 = 0
+        for (op, count) in self.diff_lineHistogram(lines1, lines2, deadline):
+            if op == self.DIFF_INSERT:
+                diffs.append((op, "".join([lineArray[line] for line in lines2[pointer2:pointer2 + count]])))
+                pointer2 += count
+            else:
+                diffs.append((op, "".join([lineArray[line] for line in lines1[pointer1:pointer1 + count]])))
+                pointer1 += count
+                if op == self.DIFF_EQUAL:
+                    pointer2 += count
+
+        # Eliminate freak matches (e.g. blank lines)
+        self.diff_cleanupSemantic(diffs)
+        return diffs
+
+    def diff_lineHistogram(self, lines1, lines2, deadline):
+        """Line-level diff of two arrays of line hashes (see diff_linesToInts).
+          Histogram diff: the common region whose rarest line occurs least often
+          in lines1 splits the problem in two.  Regions without such a line are solved by
+          the bit-parallel LCS (diff_lineLcs) or left as a replacement.
+
+        Args:
+          lines1: Old array of line hashes.
+          lines2: New array of line hashes.
+          deadline: Time at which to bail if not yet complete.
+
+        Returns:
+          Array of (op, number of lines) tuples.
+        """
+        runs = []
+
+        def diff_lineHistogramEmit(op, count):
+            if not count:
+                return
+            if runs and runs[-1][0] == op:
+                runs[-1] = (op, runs[-1][1] + count)
+            else:
+                runs.append((op, count))
+
+        # Trim off common prefix and suffix (the binary search works on lists too).
+        prefix = self.diff_commonPrefix(lines1, lines2)
+        suffix = self.diff_commonSuffix(lines1[prefix:], lines2[prefix:])
+        diff_lineHistogramEmit(self.DIFF_EQUAL, prefix)
+        # Positions of every line in lines1, built once for all the ranges.
+        occurrences = {}
+        for i in xrange(prefix, len(lines1) - suffix):
+            occurrences.setdefault(lines1[i], []).append(i)
+        # Ranges still to diff and equalities between them, last to first.
+        stack = [(None, suffix), (prefix, len(lines1) - suffix, prefix, len(lines2) - suffix)]
+        while stack:
+            item = stack.pop()
+            if item[0] is None:
+                diff_lineHistogramEmit(self.DIFF_EQUAL, item[1])
+                continue
+            (lo1, hi1, lo2, hi2) = item
+            split = None
+            if lo1 < hi1 and lo2 < hi2 and time.time() > deadline:
+                self.diff_optimal = False
+            elif lo1 < hi1 and lo2 < hi2:
+                split = self.diff_lineSplit(lines1, lo1, hi1, lines2, lo2, hi2, occurrences)
+                if split is None:
+                    lcs = self.diff_lineLcs(lines1[lo1:hi1], lines2[lo2:hi2])
+                    if lcs is not None:
+                        for (op, count) in lcs:
+                            diff_lineHistogramEmit(op, count)
+                        continue
+            if split is None:
+                diff_lineHistogramEmit(self.DIFF_DELETE, hi1 - lo1)
+                diff_lineHistogramEmit(self.DIFF_INSERT, hi2 - lo2)
+                continue
+            (start1, end1, start2) = split
+            end2 = start2 + end1 - start1
+            stack.append((end1, hi1, end2, hi2))
+            stack.append((None, end1 - start1))
+            stack.append((lo1, start1, lo2, start2))
+        return runs
+
+    def diff_lineSplit(self, lines1, lo1, hi1, lines2, lo2, hi2, occurrences):
+        """Find the common region of lines1[lo1:hi1] and lines2[lo2:hi2] whose
+          rarest line occurs least often in lines1; longer regions win ties.
+
+        Args:
+          lines1: Old array of line hashes.
+          lo1, hi1: Range of lines1.
+          lines2: New array of line hashes.
+          lo2, hi2: Range of lines2.
+          occurrences: Hash of sorted positions of each line in lines1.
+
+        Returns:
+          Three element tuple (start1, end1, start2) of the region or None if
+          every common line occurs more than Diff_LineChain times.
+        """
+        best = None
+        best_count = self.Diff_LineChain
+        best_length = 0
+        j = lo2
+        while j < hi2:
+            positions = occurrences.get(lines2[j])
+            next_j = j + 1
+            if positions is not None and len(positions) <= best_count:
+                for i in positions[bisect.bisect_left(positions, lo1):bisect.bisect_left(positions, hi1)]:
+                    start1, start2 = i, j
+                    while start1 > lo1 and start2 > lo2 and lines1[start1 - 1] == lines2[start2 - 1]:
+                        start1 -= 1
+                        start2 -= 1
+                    end1, end2 = i + 1, j + 1
+                    while end1 < hi1 and end2 < hi2 and lines1[end1] == lines2[end2]:
+                        end1 += 1
+                        end2 += 1
+                    count = min([len(occurrences[lines1[k]]) for k in xrange(start1, end1)])
+                    if count < best_count or (count == best_count and end1 - start1 > best_length):
+                        best = (start1, end1, start2)
+                        best_count = count
+                        best_length = end1 - start1
+                    # Lines inside the region can not start a better one.
+                    next_j = max(next_j, end2)
+            j = next_j
+        return best
+
+    def diff_lineLcs(self, lines1, lines2):
+        """Line-level diff by the bit-parallel longest common subsequence
+          (Hyyro 2004: one column of the LCS table is a Python long).
+
+        Args:
+          lines1: Old array of line hashes.
+          lines2: New array of line hashes.
+
+        Returns:
+          Array of (op, number of lines) tuples or None if the problem is
+          larger than Diff_LineLcsCells.
+        """
+        length1 = len(lines1)
+        length2 = len(lines2)
+        if length1 * length2 > self.Diff_LineLcsCells:
+            return None
+        masks = {}
+        for (i, line) in enumerate(lines1):
+            masks[line] = masks.get(line, 0) | (1 << i)
+        # Bit i of columns[j] is set if the LCS of lines1[:i + 1] and lines2[:j]
+        # is not longer than the LCS of lines1[:i] and lines2[:j].
+        full = (1 << length1) - 1
+        v = full
+        columns = [v]
+        for line in lines2:
+            u = v & masks.get(line, 0)
+            v = ((v + u) | (v - u)) & full
+            columns.append(v)
+
+        # Walk the table back from the bottom right corner.
+        ops = []
+        i = length1
+        j = length2
+        while i and j:
+            if lines1[i - 1] == lines2[j - 1]:
+                ops.append(self.DIFF_EQUAL)
+                i -= 1
+                j -= 1
+            elif (columns[j] >> (i - 1)) & 1:
+                ops.append(self.DIFF_DELETE)
+                i -= 1
+            else:
+                ops.append(self.DIFF_INSERT)
+                j -= 1
+        ops.extend([self.DIFF_DELETE] * i)
+        ops.extend([self.DIFF_INSERT] * j)
+        ops.reverse()
+        ops.append(None)  # Dummy equality at the end.
+
+        # Deletions go before insertions between two equalities.
+        runs = []
+        count_delete = 0
+        count_insert = 0
+        count_equal = 0
+        for op in ops:
+            if op == self.DIFF_DELETE:
+                count_delete += 1
+            elif op == self.DIFF_INSERT:
+                count_insert += 1
+            elif count_delete or count_insert or op is None:
+                if count_equal:
+                    runs.append((self.DIFF_EQUAL, count_equal))
+                if count_delete:
+                    runs.append((self.DIFF_DELETE, count_delete))
+                if count_insert:
+                    runs.append((self.DIFF_INSERT, count_insert))
+                count_delete = 0
+                count_insert = 0
+                count_equal = 1
+            else:
+                count_equal += 1
+        return runs
+
     def diff_bisect(self, text1, text2, deadline):
         """Find the 'middle snake' of a diff, split the problem in two
           and return the recursively constructed diff.
@@ -284,6 +538,38 @@ class diff_match_patch:
           Array of diff tuples.
         """
 
+        if self._native_texts(text1, text2):
+            (x, y, steps) = self.native.bisect(text1, text2, deadline)
+            if x != -1:
+                return self.diff_bisectSplit(text1, text2, x, y, deadline)
+            if steps < (len(text1) + len(text2) + 1) // 2:
+                self.diff_optimal = False
+            return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+        for split in self.diff_bisectSteps(text1, text2):
+            if split is not None:
+                return self.diff_bisectSplit(text1, text2, split[0], split[1], deadline)
+            # Bail out if deadline is reached.
+            if time.time() > deadline:
+                self.diff_optimal = False
+                break
+
+        # Diff took too long and hit the deadline or
+        # number of diffs equals number of characters, no commonality at all.
+        return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+    def diff_bisectSteps(self, text1, text2):
+        """Search for the 'middle snake' of a diff one step at a time.
+
+        Args:
+          text1: Old string to be diffed.
+          text2: New string to be diffed.
+
+        Returns:
+          Generator which yields None before every step and the (x, y) split
+          point when the snake is found.  It stops without the split point if
+          there is no commonality at all.
+        """
         # Cache the text lengths to prevent multiple calls.
         text1_length = len(text1)
         text2_length = len(text2)
@@ -304,9 +590,8 @@ class diff_match_patch:
         k2start = 0
         k2end = 0
         for d in xrange(max_d):
-            # Bail out if deadline is reached.
-            if time.time() > deadline:
-                break
+            # The caller decides whether to go on.
+            yield None
 
             # Walk the front path one step.
             for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
@@ -335,7 +620,8 @@ class diff_match_patch:
                         x2 = text1_length - v2[k2_offset]
                         if x1 >= x2:
                             # Overlap detected.
-                            return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+                            yield (x1, y1)
+                            return
 
             # Walk the reverse path one step.
             for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
@@ -366,11 +652,8 @@ class diff_match_patch:
                         x2 = text1_length - x2
                         if x1 >= x2:
                             # Overlap detected.
-                            return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
-
-        # Diff took too long and hit the deadline or
-        # number of diffs equals number of characters, no commonality at all.
-        return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+                            yield (x1, y1)
+                            return
 
     def diff_bisectSplit(self, text1, text2, x, y, deadline):
         """Given the location of the 'middle snake', split the diff in two parts
@@ -453,6 +736,47 @@ class diff_match_patch:
         chars2 = diff_linesToCharsMunge(text2)
         return (chars1, chars2, lineArray)
 
+    def diff_linesToInts(self, text1, text2):
+        """Split two texts into arrays of line hashes.  Unlike diff_linesToChars
+        the number of unique lines is not limited by the Unicode range.
+
+        Args:
+          text1: First string.
+          text2: Second string.
+
+        Returns:
+          Three element tuple, containing the array of line hashes of text1, of
+          text2 and the array of unique strings.
+        """
+        lineArray = []  # e.g. lineArray[4] == "Hello\n"
+        lineHash = {}  # e.g. lineHash["Hello\n"] == 4
+
+        def diff_linesToIntsMunge(text):
+            """Split a text into an array of line hashes.
+            Modifies lineArray and lineHash through being a closure.
+
+            Args:
+              text: String to encode.
+
+            Returns:
+              Array of line hashes.
+            """
+            lines = text.split("\n")
+            for i in xrange(len(lines) - 1):
+                lines[i] += "\n"
+            if not lines[-1]:
+                lines.pop()
+            hashes = []
+            for line in lines:
+                index = lineHash.get(line)
+                if index is None:
+                    index = lineHash[line] = len(lineArray)
+                    lineArray.append(line)
+                hashes.append(index)
+            return hashes
+
+        return (diff_linesToIntsMunge(text1), diff_linesToIntsMunge(text2), lineArray)
+
     def diff_charsToLines(self, diffs, lineArray):
         """Rehydrate the text in a diff from a string of line hashes to real lines
         of text.
@@ -467,6 +791,13 @@ class diff_match_patch:
                 text.append(lineArray[ord(char)])
             diffs[x] = (diffs[x][0], "".join(text))
 
+    def _native_texts(self, text1, text2):
+        """
+        Можно ли отдать тексты компилированному модулю: он работает только с str или unicode,
+        причем оба текста одного типа (str с unicode питон сравнивает через декодирование)
+        """
+        return self.native is not None and type(text1) is type(text2) and isinstance(text1, basestring)
+
     def diff_commonPrefix(self, text1, text2):
         """Determine the common prefix of two strings.
 
@@ -477,6 +808,8 @@ class diff_match_patch:
         Returns:
           The number of characters common to the start of each string.
         """
+        if self._native_texts(text1, text2):
+            return self.native.common_prefix(text1, text2)
         # Quick check for common null cases.
         if not text1 or not text2 or text1[0] != text2[0]:
             return 0
@@ -505,6 +838,8 @@ class diff_match_patch:
         Returns:
           The number of characters common to the end of each string.
         """
+        if self._native_texts(text1, text2):
+            return self.native.common_suffix(text1, text2)
         # Quick check for common null cases.
         if not text1 or not text2 or text1[-1] != text2[-1]:
             return 0
@@ -1309,14 +1644,23 @@ class diff_match_patch:
             if best_loc != -1:
                 score_threshold = min(match_bitapScore(0, best_loc), score_threshold)
 
+        if self._native_texts(text, pattern) and 0 < len(pattern) <= self.native.MAX_BITS:
+            return self.native.bitap(text, pattern, loc, score_threshold, self.Match_Distance)
+
         # Initialise the bit arrays.
-        matchmask = 1 << (len(pattern) - 1)
+        pattern_length = len(pattern)
+        text_length = len(text)
+        matchmask = 1 << (pattern_length - 1)
         best_loc = -1
 
-        bin_max = len(pattern) + len(text)
+        bin_max = pattern_length + text_length
+        # Alphabet masks of the text characters.  They are looked up once for the
+        # widest (first) window and shared by all the error levels.
+        masks = None
+        masks_start = 0
         # Empty initialization added to appease pychecker.
         last_rd = None
-        for d in xrange(len(pattern)):
+        for d in xrange(pattern_length):
             # Scan for the best match each iteration allows for one more error.
             # Run a binary search to determine how far from 'loc' we can stray at
             # this error level.
@@ -1332,22 +1676,30 @@ class diff_match_patch:
             # Use the result from this iteration as the maximum for the next.
             bin_max = bin_mid
             start = max(1, loc - bin_mid + 1)
-            finish = min(loc + bin_mid, len(text)) + len(pattern)
+            finish = min(loc + bin_mid, text_length) + pattern_length
+            if masks is None:
+                masks_start = start
+                masks = [s.get(char, 0) for char in text[start - 1:finish]]
+                # Out of range.
+                masks.extend([0] * (finish - start + 1 - len(masks)))
 
             rd = [0] * (finish + 2)
-            rd[finish + 1] = (1 << d) - 1
-            for j in xrange(finish, start - 1, -1):
-                if len(text) <= j - 1:
-                    # Out of range.
-                    charMatch = 0
-                else:
-                    charMatch = s.get(text[j - 1], 0)
+            rd[finish + 1] = value = (1 << d) - 1
+            if d:
+                above = last_rd[finish + 1]
+            j = finish + 1
+            # Windows only shrink, so this one is inside the masks.
+            for charMatch in reversed(masks[start - masks_start:finish - masks_start + 1]):
+                j -= 1
+                # value and above are rd[j + 1] and last_rd[j + 1].
                 if d == 0:  # First pass: exact match.
-                    rd[j] = ((rd[j + 1] << 1) | 1) & charMatch
+                    value = ((value << 1) | 1) & charMatch
                 else:  # Subsequent passes: fuzzy match.
-                    rd[j] = (((rd[j + 1] << 1) | 1) & charMatch) | (
-                        ((last_rd[j + 1] | last_rd[j]) << 1) | 1) | last_rd[j + 1]
-                if rd[j] & matchmask:
+                    left = last_rd[j]
+                    value = (((value << 1) | 1) & charMatch) | (((above | left) << 1) | 1) | above
+                    above = left
+                rd[j] = value
+                if value & matchmask:
                     score = match_bitapScore(d, j - 1)
                     # This match will almost certainly be better than any existing match.
                     # But check anyway.
@@ -1374,13 +1726,19 @@ class diff_match_patch:
           pattern: The text to encode.
 
         Returns:
-          Hash of character locations.
+          Hash of character locations.  The hash is cached, do not modify it.
         """
+        s = self._alphabets.get(pattern)
+        if s is not None:
+            return s
         s = {}
         for char in pattern:
             s[char] = 0
         for i in xrange(len(pattern)):
             s[pattern[i]] |= 1 << (len(pattern) - i - 1)
+        if len(self._alphabets) >= self.Match_AlphabetCacheSize:
+            self._alphabets.clear()
+        self._alphabets[pattern] = s
         return s
 
     #  PATCH FUNCTIONS
@@ -1562,6 +1920,46 @@ class diff_match_patch:
             patchesCopy.append(patchCopy)
         return patchesCopy
 
+    def patch_invert(self, patches):
+        """Given an array of patches, return another array that undoes them:
+        applied to the text produced by the patches, it restores the original
+        text.  No diff is computed, the cost is linear in the size of the
+        patches.
+
+        The patches are undone from last to first.  Each inverted patch then
+        meets exactly the text its patch produced: start2 of a patch (also of
+        the pieces produced by patch_splitMax) is the location of the patch in
+        the text where all previous patches are already applied.
+
+        Args:
+          patches: Array of Patch objects.
+
+        Returns:
+          Array of Patch objects.
+        """
+        patchesInverted = []
+        for patch in reversed(patches):
+            patchInverted = patch_obj()
+            # Swap insertions and deletions, keeping deletions first in each
+            # run of changes, as patch_make does.
+            insertions = []
+            for (op, data) in patch.diffs:
+                if op == self.DIFF_INSERT:
+                    patchInverted.diffs.append((self.DIFF_DELETE, data))
+                elif op == self.DIFF_DELETE:
+                    insertions.append((self.DIFF_INSERT, data))
+                else:
+                    patchInverted.diffs.extend(insertions)
+                    insertions = []
+                    patchInverted.diffs.append((op, data))
+            patchInverted.diffs.extend(insertions)
+            patchInverted.start1 = patch.start2
+            patchInverted.start2 = patch.start2
+            patchInverted.length1 = patch.length2
+            patchInverted.length2 = patch.length1
+            patchesInverted.append(patchInverted)
+        return patchesInverted
+
     def patch_apply(self, patches, text):
         """Merge a set of patches onto the text.  Return a patched text, as well
         as a list of true/false values indicating which patches were applied.
@@ -1575,39 +1973,74 @@ class diff_match_patch:
         """
         if not patches:
             return (text, [])
+        buf = string_buffer(text)
+        results, commands = self.patch_applyInPlace(patches, buf)
+        return (buf.text, results, commands)
+
+    def patch_applyInPlace(self, patches, buf):
+        """Merge a set of patches onto the text buffer, modifying it in place.
+        Matching is done only inside a window around the expected location of
+        each patch, so the buffer is never flattened as a whole.
+
+        Args:
+          patches: Array of Patch objects.
+          buf: Text buffer (string_buffer or any object with the same
+            __len__/slice/replace interface).
+
+        Returns:
+          Two element Array, containing an array of boolean values and
+          the sublime commands.
+        """
+        self.sublime_patch_commands = []
+        self.sublime_applied_patches = []
+        self.sublime_cursor = None
+        if not patches:
+            return ([], self.sublime_patch_commands)
 
         # Deep copy the patches so that no changes are made to originals.
         patches = self.patch_deepCopy(patches)
 
         nullPadding = self.patch_addPadding(patches)
-        text = nullPadding + text + nullPadding
+        buf.replace(0, 0, nullPadding)
+        buf.replace(len(buf), len(buf), nullPadding)
         self.patch_splitMax(patches)
 
+        # How far from the expected location a match may be found.
+        if self.Match_Distance:
+            radius = int(self.Match_Threshold * self.Match_Distance) + self.Match_MaxBits
+        else:
+            radius = len(buf)
+
         # delta keeps track of the offset between the expected and actual location
         # of the previous patch.  If there are patches expected at positions 10 and
         # 20, but the first patch was found at 12, delta is 2 and the second patch
         # has an effective expected position of 22.
         delta = 0
         results = []
-        self.sublime_patch_commands = []
         self.sublime_null_padding_len = len(nullPadding)
         for patch in patches:
             expected_loc = patch.start2 + delta
             text1 = self.diff_text1(patch.diffs)
+            # Only the window around expected_loc can contain an acceptable match.
+            window_start = max(0, min(expected_loc, len(buf)) - radius)
+            window_end = min(len(buf), expected_loc + len(text1) + radius)
+            text = buf.slice(window_start, window_end)
             end_loc = -1
             if len(text1) > self.Match_MaxBits:
                 # patch_splitMax will only provide an oversized pattern in the case of
                 # a monster delete.
                 start_loc = self.match_main(text, text1[:self.Match_MaxBits],
-                                            expected_loc)
+                                            expected_loc - window_start)
                 if start_loc != -1:
                     end_loc = self.match_main(text, text1[-self.Match_MaxBits:],
-                                              expected_loc + len(text1) - self.Match_MaxBits)
+                                              expected_loc - window_start + len(text1) - self.Match_MaxBits)
                     if end_loc == -1 or start_loc >= end_loc:
                         # Can't find valid trailing context.  Drop this patch.
                         start_loc = -1
+                    else:
+                        end_loc += window_start
             else:
-                start_loc = self.match_main(text, text1, expected_loc)
+                start_loc = self.match_main(text, text1, expected_loc - window_start)
             if start_loc == -1:
                 # No match found.  :(
                 results.append(False)
@@ -1615,32 +2048,19 @@ class diff_match_patch:
                 delta -= patch.length2 - patch.length1
             else:
                 # Found a match.  :)
+                start_loc += window_start
                 results.append(True)
                 delta = start_loc - expected_loc
                 if end_loc == -1:
-                    text2 = text[start_loc: start_loc + len(text1)]
+                    text2 = buf.slice(start_loc, start_loc + len(text1))
                 else:
-                    text2 = text[start_loc: end_loc + self.Match_MaxBits]
+                    text2 = buf.slice(start_loc, end_loc + self.Match_MaxBits)
                 if text1 == text2:
                     # Perfect match, just shove the replacement text in.
-                    # a1 = text[start_loc:start_loc + len(text1)]
-                    text = (text[:start_loc] + self.diff_text2(patch.diffs) +
-                            text[start_loc + len(text1):])
+                    replacement = self.diff_text2(patch.diffs)
+                    buf.replace(start_loc, start_loc + len(text1), replacement)
+                    self.patch_recordReplace(buf, start_loc, text1, replacement, len(nullPadding))
                     log.msg('perfect match', logLevel=logging.DEBUG)
-                    # mine:
-                    # import spdb ; spdb.start()
-
-                    # a2 = self.diff_text2(patch.diffs)
-                    #
-                    # def common_prefix_f(b1, b2):
-                    #     return [i[0] for i in takewhile(lambda x: len(set(x)) == 1, izip(b1, b2))]
-
-                    # common_prefix = common_prefix_f(a1, a2)
-                    # common_suffix = common_prefix_f(reversed(a1), reversed(a2))
-                    from_index = start_loc # + len(common_prefix)
-                    dest_index = start_loc + len(text1) # - len(common_suffix)
-                    pseudo_command = ('insert', from_index, dest_index, self.diff_text2(patch.diffs))
-                    self.sublime_patch_commands.append(pseudo_command)
                 else:
                     # Imperfect match.
                     # Run a diff to get a framework of equivalent indices.
@@ -1656,24 +2076,128 @@ class diff_match_patch:
                         for (op, data) in patch.diffs:
                             if op != self.DIFF_EQUAL:
                                 index2 = self.diff_xIndex(diffs, index1)
+                                # The padding is stripped by length, so edits mapped
+                                # into it are moved to the edge of the text.
+                                low, high = len(nullPadding), len(buf) - len(nullPadding)
+                                from_index = min(max(start_loc + index2, low), high)
                             if op == self.DIFF_INSERT:  # Insertion
-                                text = text[:start_loc + index2] + data + text[start_loc +
-                                                                               index2:]
+                                buf.replace(from_index, from_index, data)
+                                self.patch_recordReplace(buf, from_index, data[:0], data, len(nullPadding))
                                 log.msg('imperfect match', logLevel=logging.DEBUG)
-                                pseudo_command = ('insert', start_loc + index2, start_loc + index2, data)
-                                self.sublime_patch_commands.append(pseudo_command)
                             elif op == self.DIFF_DELETE:  # Deletion
-                                text = text[:start_loc + index2] + text[start_loc +
-                                                                        self.diff_xIndex(diffs, index1 + len(data)):]
-                                pseudo_command = (
-                                    'erase', start_loc + index2,
-                                    start_loc + self.diff_xIndex(diffs, index1 + len(data)))
-                                self.sublime_patch_commands.append(pseudo_command)
+                                end_index2 = self.diff_xIndex(diffs, index1 + len(data))
+                                dest_index = min(max(start_loc + end_index2, from_index), high)
+                                removed = buf.slice(from_index, dest_index)
+                                buf.replace(from_index, dest_index, '')
+                                self.patch_recordReplace(buf, from_index, removed, removed[:0], len(nullPadding))
                             if op != self.DIFF_DELETE:
                                 index1 += len(data)
         # Strip the padding off.
-        text = text[len(nullPadding):-len(nullPadding)]
-        return (text, results, self.sublime_patch_commands)
+        buf.replace(0, len(nullPadding), '')
+        buf.replace(len(buf) - len(nullPadding), len(buf), '')
+        return (results, self.sublime_patch_commands)
+
+    def patch_recordReplace(self, buf, start, removed, inserted, padding):
+        """Remember a replacement made by patch_applyInPlace as an exact patch
+        (see sublime_applied_patches) and as a minimal Sublime command (see
+        sublime_patch_commands).  Called after the buffer is changed.
+
+        Args:
+          buf: Padded text buffer after the replacement.
+          start: Offset of the replacement in buf.
+          removed: Text which was replaced.
+          inserted: Text which replaced it.
+          padding: Length of the null padding on each side of buf.
+        """
+        prefix = self.diff_commonPrefix(removed, inserted)
+        if prefix and self.isHighSurrogate(removed[prefix - 1]):
+            # Never split a surrogate pair.
+            prefix -= 1
+        removed, inserted = removed[prefix:], inserted[prefix:]
+        suffix = self.diff_commonSuffix(removed, inserted)
+        if suffix and self.isLowSurrogate(removed[-suffix]):
+            suffix -= 1
+        if suffix:
+            removed, inserted = removed[:-suffix], inserted[:-suffix]
+        if not removed and not inserted:
+            return
+        start += prefix
+        self.sublime_patch_commands.append(self.patch_sublimeCommand(buf, start, removed, inserted, padding))
+        end = start + len(inserted)
+        before = buf.slice(max(padding, start - self.Patch_Margin), start)
+        after = buf.slice(end, min(len(buf) - padding, end + self.Patch_Margin))
+        patch = patch_obj()
+        patch.start1 = patch.start2 = start - len(before) - padding
+        for op, data in ((self.DIFF_EQUAL, before), (self.DIFF_DELETE, removed),
+                         (self.DIFF_INSERT, inserted), (self.DIFF_EQUAL, after)):
+            if data:
+                patch.diffs.append((op, data))
+        patch.length1 = len(before) + len(removed) + len(after)
+        patch.length2 = len(before) + len(inserted) + len(after)
+        self.sublime_applied_patches.append(patch)
+
+    def patch_sublimeCommand(self, buf, start, removed, inserted, padding):
+        """Build the Sublime command for a trimmed replacement made by
+        patch_applyInPlace.  Offsets are in the unpadded text before the
+        replacement, counted in code points as Sublime counts them.
+
+        Args:
+          buf: Padded text buffer after the replacement.
+          start: Offset of the replacement in buf.
+          removed: Text which was replaced.
+          inserted: Text which replaced it.
+          padding: Length of the null padding on each side of buf.
+
+        Returns:
+          ('insert', from, to, text) which replaces [from, to) with text
+          (from == to for a pure insertion), or ('erase', from, to).
+        """
+        sublime_start = max(0, start - padding)
+        if NARROW_BUILD:
+            # Commands of a patch go forward, so only the text since the
+            # previous command is counted.
+            position, code_points = self.sublime_cursor or (padding, 0)
+            if start < position:
+                position, code_points = padding, 0
+            sublime_start = code_points + self.codePointLength(buf.slice(position, max(position, start)))
+            if start >= padding:
+                self.sublime_cursor = (start + len(inserted), sublime_start + self.codePointLength(inserted))
+        sublime_end = sublime_start + self.codePointLength(removed)
+        if not inserted:
+            return ('erase', sublime_start, sublime_end)
+        return ('insert', sublime_start, sublime_end, inserted)
+
+    @staticmethod
+    def codePointLength(text):
+        """Length of the text in code points.
+
+        Args:
+          text: Text (unicode or str).
+
+        Returns:
+          Number of characters, a surrogate pair counted as one on a narrow build.
+        """
+        if NARROW_BUILD and isinstance(text, unicode):
+            return len(text) - sum(1 for char in text if diff_match_patch.isLowSurrogate(char))
+        return len(text)
+
+    @staticmethod
+    def isHighSurrogate(char):
+        """Whether the character is the first half of a surrogate pair.
+
+        Args:
+          char: One character (unicode or str).
+        """
+        return isinstance(char, unicode) and u'\ud800' <= char <= u'\udbff'
+
+    @staticmethod
+    def isLowSurrogate(char):
+        """Whether the character is the second half of a surrogate pair.
+
+        Args:
+          char: One character (unicode or str).
+        """
+        return isinstance(char, unicode) and u'\udc00' <= char <= u'\udfff'
 
     def patch_addPadding(self, patches):
         """Add some padding on text start and end so that edges can match
@@ -1913,6 +2437,251 @@ class diff_match_patch:
         return patches
 
 
+class diff_task:
+    """Diff of two texts computed in slices.
+    The result equals diff_main, but the work can be spread over several
+    calls of step() (e.g. reactor iterations) and is bounded by a wall-clock
+    and an operation budget.  The task is also an iterator: each next() runs
+    one slice, so it can be passed to twisted.internet.task.cooperate.
+    """
+
+    # Length of a slice when the task is iterated, in seconds.
+    slice_seconds = 0.005
+
+    def __init__(self, dmp, text1, text2, checklines=True, timeout=None, operations=None):
+        """Prepare the diff, nothing is computed yet.
+
+        Args:
+          dmp: diff_match_patch instance with the settings to use.
+          text1: Old string to be diffed.
+          text2: New string to be diffed.
+          checklines: Speedup flag, as in diff_main.
+          timeout: Seconds of work spent in step() before the rest is diffed
+            as plain replacements.  Defaults to dmp.Diff_Timeout, 0 means
+            unlimited.
+          operations: Maximum number of middle snake steps or None for
+            unlimited.
+        """
+        # Check for null inputs.
+        if text1 == None or text2 == None:
+            raise ValueError("Null inputs. (diff_task)")
+        self.dmp = dmp
+        if timeout is None:
+            timeout = dmp.Diff_Timeout
+        self.timeout = timeout
+        self.operations = operations
+        # Resulting array of changes, None until the task is done.
+        self.diffs = None
+        # False if a budget was exhausted and the result is not minimal.
+        self.optimal = True
+        self.cancelled = False
+        self.used_operations = 0
+        self.used_seconds = 0.0
+        self._output = []
+        # Pending work, the last node is processed first:
+        # (None, text1, text2, checklines) is a diff, (op, text) is a ready change,
+        # (snake, text1, text2) is a middle snake search in progress and (start,)
+        # merges the changes of a finished diff like diff_main does.
+        self._stack = [(None, text1, text2, checklines)]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.cancelled or self.step(self.slice_seconds):
+            raise StopIteration
+
+    def cancel(self):
+        """Stop the task, diffs stay None."""
+        self.cancelled = True
+        del self._stack[:]
+
+    def exhausted(self):
+        """Has the task spent its time or operation budget?"""
+        if self.operations is not None and self.used_operations >= self.operations:
+            return True
+        return self.timeout > 0 and self.used_seconds >= self.timeout
+
+    def step(self, seconds=None):
+        """Run the task for about the given time.
+
+        Args:
+          seconds: Length of the slice or None to run until done.  At least
+            one node of work is processed on every call.
+
+        Returns:
+          True if the diff is done (or the task is cancelled).
+        """
+        if self.cancelled:
+            return True
+        started = now = time.time()
+        stack = self._stack
+        while stack:
+            node = stack.pop()
+            if len(node) == 2:
+                self._output.append(node)
+            elif len(node) == 1:
+                diffs = self._output[node[0]:]
+                self.dmp.diff_cleanupMerge(diffs)
+                self._output[node[0]:] = diffs
+            elif node[0] is None:
+                self._diff(*node[1:])
+            else:
+                self._snake(*node)
+            self.used_seconds += time.time() - now
+            now = time.time()
+            if stack and seconds is not None and now - started >= seconds:
+                return False
+        self.diffs = self._output
+        return True
+
+    def _deadline(self):
+        """Absolute time when the time budget ends."""
+        if self.timeout <= 0:
+            return sys.maxint
+        return time.time() + max(0.0, self.timeout - self.used_seconds)
+
+    def _replace(self, text1, text2):
+        """Push the replacement of text1 by text2."""
+        dmp = self.dmp
+        if text2:
+            self._stack.append((dmp.DIFF_INSERT, text2))
+        if text1:
+            self._stack.append((dmp.DIFF_DELETE, text1))
+
+    def _diff(self, text1, text2, checklines):
+        """Process the diff node: the same steps as diff_main and diff_compute."""
+        dmp = self.dmp
+        stack = self._stack
+        # Check for equality (speedup).
+        if text1 == text2:
+            if text1:
+                self._output.append((dmp.DIFF_EQUAL, text1))
+            return
+        stack.append((len(self._output),))
+
+        # Trim off common prefix and suffix (speedup).
+        commonlength = dmp.diff_commonPrefix(text1, text2)
+        if commonlength:
+            self._output.append((dmp.DIFF_EQUAL, text1[:commonlength]))
+            text1 = text1[commonlength:]
+            text2 = text2[commonlength:]
+        commonlength = dmp.diff_commonSuffix(text1, text2)
+        if commonlength:
+            stack.append((dmp.DIFF_EQUAL, text1[-commonlength:]))
+            text1 = text1[:-commonlength]
+            text2 = text2[:-commonlength]
+
+        diffs = dmp.diff_computeTrivial(text1, text2)
+        if diffs is not None:
+            stack.extend(reversed(diffs))
+            return
+
+        if self.exhausted():
+            self.optimal = False
+            self._replace(text1, text2)
+            return
+
+        # Check to see if the problem can be split in two.
+        hm = dmp.diff_halfMatch(text1, text2) if self.timeout > 0 else None
+        if hm:
+            (text1_a, text1_b, text2_a, text2_b, mid_common) = hm
+            stack.append((None, text1_b, text2_b, checklines))
+            stack.append((dmp.DIFF_EQUAL, mid_common))
+            stack.append((None, text1_a, text2_a, checklines))
+            return
+
+        if checklines and len(text1) > 100 and len(text2) > 100:
+            # Line-level diff, then rediff the replacement blocks.
+            optimal = dmp.diff_optimal
+            dmp.diff_optimal = True
+            diffs = dmp.diff_lineBlocks(text1, text2, self._deadline())
+            if not dmp.diff_optimal:
+                self.optimal = False
+            dmp.diff_optimal = optimal
+            nodes = []
+            text_delete = ''
+            text_insert = ''
+            for (op, data) in diffs + [(dmp.DIFF_EQUAL, '')]:
+                if op == dmp.DIFF_DELETE:
+                    text_delete += data
+                elif op == dmp.DIFF_INSERT:
+                    text_insert += data
+                else:
+                    if text_delete and text_insert:
+                        nodes.append((None, text_delete, text_insert, False))
+                    elif text_delete:
+                        nodes.append((dmp.DIFF_DELETE, text_delete))
+                    elif text_insert:
+                        nodes.append((dmp.DIFF_INSERT, text_insert))
+                    if data:
+                        nodes.append((op, data))
+                    text_delete = ''
+                    text_insert = ''
+            stack.extend(reversed(nodes))
+            return
+
+        if dmp._native_texts(text1, text2):
+            if self.operations is None:
+                max_steps = -1
+            else:
+                max_steps = self.operations - self.used_operations
+            (x, y, steps) = dmp.native.bisect(text1, text2, self._deadline(), max_steps)
+            self.used_operations += steps
+            if x != -1:
+                self._split(text1, text2, x, y)
+                return
+            if steps < (len(text1) + len(text2) + 1) // 2:
+                self.optimal = False
+            self._replace(text1, text2)
+            return
+
+        stack.append((dmp.diff_bisectSteps(text1, text2), text1, text2))
+
+    def _snake(self, steps, text1, text2):
+        """Process one step of the middle snake search."""
+        split = None
+        try:
+            if self.exhausted():
+                self.optimal = False
+            else:
+                self.used_operations += 1
+                split = next(steps)
+                if split is None:
+                    self._stack.append((steps, text1, text2))
+                    return
+        except StopIteration:
+            # No commonality at all.
+            pass
+        if split is None:
+            self._replace(text1, text2)
+        else:
+            self._split(text1, text2, split[0], split[1])
+
+    def _split(self, text1, text2, x, y):
+        """Push both halves of the diff split at the middle snake, as diff_bisectSplit."""
+        self._stack.append((None, text1[x:], text2[y:], False))
+        self._stack.append((None, text1[:x], text2[:y], False))
+
+
+class string_buffer:
+    """Text buffer backed by a single immutable string.
+    Every replace copies the whole string.
+    """
+
+    def __init__(self, text=''):
+        self.text = text
+
+    def __len__(self):
+        return len(self.text)
+
+    def slice(self, start, end):
+        return self.text[start:end]
+
+    def replace(self, start, end, data):
+        self.text = self.text[:start] + data + self.text[end:]
+
+
 class patch_obj:
     """Class representing one patch operation.
     """
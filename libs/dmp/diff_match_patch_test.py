@@ -18,6 +18,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import random
 import sys
 import time
 import unittest
@@ -27,10 +28,15 @@ import diff_match_patch as dmp_module
 reload(dmp_module)
 
 class DiffMatchPatchTest(unittest.TestCase):
+  # Backend under test: None for pure Python, _dmp_native for the compiled one.
+  native = None
 
   def setUp(self):
     "Test harness for dmp_module."
     self.dmp = dmp_module.diff_match_patch()
+    self.dmp.native = self.native
+    # The tests are written for the upstream default threshold.
+    self.dmp.Match_Threshold = 0.5
 
   def diff_rebuildtexts(self, diffs):
     # Construct the two texts which made up the diff originally.
@@ -163,6 +169,51 @@ class DiffTest(DiffMatchPatchTest):
     self.dmp.diff_charsToLines(diffs, lineList)
     self.assertEquals([(self.dmp.DIFF_DELETE, lines)], diffs)
 
+  def testDiffLinesToInts(self):
+    # Convert lines down to line hashes.
+    self.assertEquals(([0, 1, 0], [1, 0, 1], ["alpha\n", "beta\n"]), self.dmp.diff_linesToInts("alpha\nbeta\nalpha\n", "beta\nalpha\nbeta\n"))
+
+    self.assertEquals(([], [0, 1, 2], ["alpha\r\n", "beta\r\n", "\r\n"]), self.dmp.diff_linesToInts("", "alpha\r\nbeta\r\n\r\n"))
+
+    self.assertEquals(([0], [1], ["a", "b"]), self.dmp.diff_linesToInts("a", "b"))
+
+    # More unique lines than a narrow Unicode build has code points.
+    n = 70000
+    lines = "".join([str(x) + "\n" for x in range(n)])
+    (lines1, lines2, lineArray) = self.dmp.diff_linesToInts(lines, "")
+    self.assertEquals((range(n), [], n), (lines1, lines2, len(lineArray)))
+
+  def testDiffLineHistogram(self):
+    # Runs of (op, number of lines).
+    self.assertEquals([], self.dmp.diff_lineHistogram([], [], sys.maxint))
+
+    self.assertEquals([(self.dmp.DIFF_EQUAL, 1), (self.dmp.DIFF_DELETE, 1), (self.dmp.DIFF_INSERT, 2), (self.dmp.DIFF_EQUAL, 1)], self.dmp.diff_lineHistogram([0, 1, 2], [0, 3, 4, 2], sys.maxint))
+
+    # The rarest common line is the anchor.
+    self.assertEquals([(self.dmp.DIFF_DELETE, 1), (self.dmp.DIFF_EQUAL, 1), (self.dmp.DIFF_INSERT, 1), (self.dmp.DIFF_EQUAL, 1)], self.dmp.diff_lineHistogram([9, 1, 9], [1, 9, 9], sys.maxint))
+
+    self.assertEquals([(self.dmp.DIFF_DELETE, 1), (self.dmp.DIFF_EQUAL, 5), (self.dmp.DIFF_INSERT, 1)], self.dmp.diff_lineHistogram([5, 9, 9, 1, 9, 9], [9, 9, 1, 9, 9, 6], sys.maxint))
+
+    # Only frequent lines in common: bit-parallel LCS.
+    self.dmp.Diff_LineChain = 1
+    self.assertEquals([(self.dmp.DIFF_DELETE, 1), (self.dmp.DIFF_EQUAL, 1), (self.dmp.DIFF_INSERT, 1), (self.dmp.DIFF_EQUAL, 1), (self.dmp.DIFF_DELETE, 1), (self.dmp.DIFF_INSERT, 1)], self.dmp.diff_lineHistogram([1, 9, 9, 3], [9, 2, 9, 4], sys.maxint))
+
+    # Too large for the LCS: left to the character diff.
+    self.dmp.Diff_LineLcsCells = 1
+    self.assertEquals([(self.dmp.DIFF_DELETE, 4), (self.dmp.DIFF_INSERT, 4)], self.dmp.diff_lineHistogram([1, 9, 9, 3], [9, 2, 9, 4], sys.maxint))
+
+    # Deadline is reached.
+    self.assertEquals([(self.dmp.DIFF_DELETE, 2), (self.dmp.DIFF_INSERT, 2)], self.dmp.diff_lineHistogram([0, 1], [1, 2], 0))
+
+  def testDiffLineLcs(self):
+    # Longest common subsequence of line hashes.
+    self.assertEquals([(self.dmp.DIFF_DELETE, 1), (self.dmp.DIFF_EQUAL, 2), (self.dmp.DIFF_INSERT, 1), (self.dmp.DIFF_EQUAL, 1)], self.dmp.diff_lineLcs([0, 1, 2, 3], [1, 2, 4, 3]))
+
+    self.assertEquals([(self.dmp.DIFF_INSERT, 2)], self.dmp.diff_lineLcs([], [1, 2]))
+
+    self.dmp.Diff_LineLcsCells = 3
+    self.assertEquals(None, self.dmp.diff_lineLcs([0, 1], [1, 2]))
+
   def testDiffCleanupMerge(self):
     # Cleanup a messy diff.
     # Null case.
@@ -513,7 +564,11 @@ class DiffTest(DiffMatchPatchTest):
     # Theoretically this test could fail very occasionally if the
     # OS task swaps or locks up for a second at the wrong moment.
     self.assertTrue(self.dmp.Diff_Timeout * 2 > endTime - startTime)
+    # The truncated diff is reported.
+    self.assertFalse(self.dmp.diff_optimal)
     self.dmp.Diff_Timeout = 0
+    self.dmp.diff_main("abc", "ab123c")
+    self.assertTrue(self.dmp.diff_optimal)
 
     # Test the linemode speedup.
     # Must be long to pass the 100 char cutoff.
@@ -542,6 +597,68 @@ class DiffTest(DiffMatchPatchTest):
       # Exception expected.
       pass
 
+  def testDiffTask(self):
+    # Same result as diff_main, computed at once or a node per step.
+    self.dmp.Diff_Timeout = 0
+    cases = [("", ""), ("abc", "abc"), ("abc", "ab123c"), ("1ayb2", "abxab"), ("abcy", "xaxcxabc"),
+             ("Apples are a fruit.", "Bananas are also fruit."), ("ax\t", u"\u0680x\x00"),
+             ("1234567890\n" * 13, "abcdefghij\n1234567890\n1234567890\nabcdefghij\n1234567890\n" * 3)]
+    for (a, b) in cases:
+      task = dmp_module.diff_task(self.dmp, a, b)
+      self.assertTrue(task.step())
+      self.assertEquals(self.dmp.diff_main(a, b), task.diffs)
+      self.assertTrue(task.optimal)
+      task = dmp_module.diff_task(self.dmp, a, b)
+      while not task.step(0):
+        self.assertEquals(None, task.diffs)
+      self.assertEquals(self.dmp.diff_main(a, b), task.diffs)
+
+    # Iteration runs the slices.
+    task = dmp_module.diff_task(self.dmp, "Apples are a fruit.", "Bananas are also fruit.")
+    list(task)
+    self.assertEquals(self.dmp.diff_main("Apples are a fruit.", "Bananas are also fruit."), task.diffs)
+
+    # Exhausted operation budget gives a valid but not minimal diff.
+    a = "`Twas brillig, and the slithy toves\nDid gyre and gimble in the wabe:\n"
+    b = "I am the very model of a modern major general,\nI've information vegetable, animal, and mineral,\n"
+    task = dmp_module.diff_task(self.dmp, a, b, operations=10)
+    task.step()
+    self.assertFalse(task.optimal)
+    self.assertTrue(task.used_operations >= 10)
+    self.assertEquals((a, b), self.diff_rebuildtexts(task.diffs))
+    self.assertTrue(self.dmp.diff_levenshtein(task.diffs) > self.dmp.diff_levenshtein(self.dmp.diff_main(a, b)))
+
+    task = dmp_module.diff_task(self.dmp, "cat", "map", operations=0)
+    task.step()
+    self.assertEquals([(self.dmp.DIFF_DELETE, "cat"), (self.dmp.DIFF_INSERT, "map")], task.diffs)
+    self.assertFalse(task.optimal)
+
+    # No commonality is still optimal.
+    task = dmp_module.diff_task(self.dmp, "abc", "xyz")
+    task.step()
+    self.assertEquals([(self.dmp.DIFF_DELETE, "abc"), (self.dmp.DIFF_INSERT, "xyz")], task.diffs)
+    self.assertTrue(task.optimal)
+
+    # Time budget.
+    for x in range(6):
+      a = a + a
+      b = b + b
+    task = dmp_module.diff_task(self.dmp, a, b, timeout=0.05)
+    list(task)
+    self.assertFalse(task.optimal)
+    self.assertEquals((a, b), self.diff_rebuildtexts(task.diffs))
+
+    # Cancel.
+    task = dmp_module.diff_task(self.dmp, a, b, checklines=False)
+    self.assertFalse(task.step(0))
+    task.cancel()
+    self.assertTrue(task.step())
+    self.assertEquals([], list(task))
+    self.assertEquals(None, task.diffs)
+
+    # Test null inputs.
+    self.assertRaises(ValueError, dmp_module.diff_task, self.dmp, None, None)
+
 
 class MatchTest(DiffMatchPatchTest):
   """MATCH TEST FUNCTIONS"""
@@ -552,6 +669,15 @@ class MatchTest(DiffMatchPatchTest):
 
     self.assertEquals({"a":37, "b":18, "c":8}, self.dmp.match_alphabet("abcaba"))
 
+    # Alphabets are cached per pattern.
+    self.assertTrue(self.dmp.match_alphabet("abcaba") is self.dmp.match_alphabet("abcaba"))
+
+    self.dmp.Match_AlphabetCacheSize = 2
+    for pattern in ("x", "y", "z"):
+      self.dmp.match_alphabet(pattern)
+    self.assertTrue(len(self.dmp._alphabets) <= 2)
+    self.assertEquals({"z":1}, self.dmp.match_alphabet("z"))
+
   def testMatchBitap(self):
     self.dmp.Match_Distance = 100
     self.dmp.Match_Threshold = 0.5
@@ -770,6 +896,37 @@ class PatchTest(DiffMatchPatchTest):
     self.dmp.patch_splitMax(patches)
     self.assertEquals("@@ -2,32 +2,32 @@\n bcdefghij , h : \n-0\n+1\n  , t : 1 abcdef\n@@ -29,32 +29,32 @@\n bcdefghij , h : \n-0\n+1\n  , t : 1 abcdef\n", self.dmp.patch_toText(patches))
 
+  def testPatchInvert(self):
+    # Null case.
+    self.assertEquals([], self.dmp.patch_invert([]))
+
+    patches = self.dmp.patch_make("The quick brown fox jumps over the lazy dog.", "That quick brown fox jumped over a lazy dog.")
+    oldToText = self.dmp.patch_toText(patches)
+    self.assertEquals("@@ -22,17 +22,18 @@\n jump\n-ed\n+s\n  over \n-a\n+the\n  laz\n@@ -1,12 +1,11 @@\n Th\n-at\n+e\n  quick b\n", self.dmp.patch_toText(self.dmp.patch_invert(patches)))
+    # The original patches are untouched.
+    self.assertEquals(oldToText, self.dmp.patch_toText(patches))
+
+    # Inverted patches meet the exact text their patches produced, so they apply strictly.
+    self.dmp.Match_Threshold = 0.0
+    rand = random.Random(20)
+    for _ in xrange(200):
+      text1 = "".join(rand.choice("ab \n") for _ in xrange(rand.randint(0, 200)))
+      text2 = text1
+      for _ in xrange(rand.randint(1, 4)):
+        start = rand.randint(0, len(text2))
+        end = min(len(text2), start + rand.choice([0, 1, 5, 60]))
+        text2 = text2[:start] + "".join(rand.choice("ab \n") for _ in xrange(rand.choice([0, 1, 5, 70]))) + text2[end:]
+      patches = self.dmp.patch_make(text1, text2)
+      text2 = self.dmp.patch_apply(patches, text1)[0]
+      expected = self.dmp.patch_apply(self.dmp.patch_make(text2, text1), text2)[:2]
+      self.assertEquals(expected[0], text1)
+      results = self.dmp.patch_apply(self.dmp.patch_invert(patches), text2)[:2]
+      self.assertEquals((text1, [True] * len(results[1])), results)
+      # Pieces of patch_splitMax are inverted as well.
+      self.dmp.patch_splitMax(patches)
+      results = self.dmp.patch_apply(self.dmp.patch_invert(patches), text2)[:2]
+      self.assertEquals((text1, [True] * len(results[1])), results)
+
   def testPatchAddPadding(self):
     # Both edges full.
     patches = self.dmp.patch_make("", "test")
@@ -795,36 +952,36 @@ class PatchTest(DiffMatchPatchTest):
     self.dmp.Patch_DeleteThreshold = 0.5
     # Null case.
     patches = self.dmp.patch_make("", "")
-    results = self.dmp.patch_apply(patches, "Hello world.")
+    results = self.dmp.patch_apply(patches, "Hello world.")[:2]
     self.assertEquals(("Hello world.", []), results)
 
     # Exact match.
     patches = self.dmp.patch_make("The quick brown fox jumps over the lazy dog.", "That quick brown fox jumped over a lazy dog.")
-    results = self.dmp.patch_apply(patches, "The quick brown fox jumps over the lazy dog.")
+    results = self.dmp.patch_apply(patches, "The quick brown fox jumps over the lazy dog.")[:2]
     self.assertEquals(("That quick brown fox jumped over a lazy dog.", [True, True]), results)
 
     # Partial match.
-    results = self.dmp.patch_apply(patches, "The quick red rabbit jumps over the tired tiger.")
+    results = self.dmp.patch_apply(patches, "The quick red rabbit jumps over the tired tiger.")[:2]
     self.assertEquals(("That quick red rabbit jumped over a tired tiger.", [True, True]), results)
 
     # Failed match.
-    results = self.dmp.patch_apply(patches, "I am the very model of a modern major general.")
+    results = self.dmp.patch_apply(patches, "I am the very model of a modern major general.")[:2]
     self.assertEquals(("I am the very model of a modern major general.", [False, False]), results)
 
     # Big delete, small change.
     patches = self.dmp.patch_make("x1234567890123456789012345678901234567890123456789012345678901234567890y", "xabcy")
-    results = self.dmp.patch_apply(patches, "x123456789012345678901234567890-----++++++++++-----123456789012345678901234567890y")
+    results = self.dmp.patch_apply(patches, "x123456789012345678901234567890-----++++++++++-----123456789012345678901234567890y")[:2]
     self.assertEquals(("xabcy", [True, True]), results)
 
     # Big delete, big change 1.
     patches = self.dmp.patch_make("x1234567890123456789012345678901234567890123456789012345678901234567890y", "xabcy")
-    results = self.dmp.patch_apply(patches, "x12345678901234567890---------------++++++++++---------------12345678901234567890y")
+    results = self.dmp.patch_apply(patches, "x12345678901234567890---------------++++++++++---------------12345678901234567890y")[:2]
     self.assertEquals(("xabc12345678901234567890---------------++++++++++---------------12345678901234567890y", [False, True]), results)
 
     # Big delete, big change 2.
     self.dmp.Patch_DeleteThreshold = 0.6
     patches = self.dmp.patch_make("x1234567890123456789012345678901234567890123456789012345678901234567890y", "xabcy")
-    results = self.dmp.patch_apply(patches, "x12345678901234567890---------------++++++++++---------------12345678901234567890y")
+    results = self.dmp.patch_apply(patches, "x12345678901234567890---------------++++++++++---------------12345678901234567890y")[:2]
     self.assertEquals(("xabcy", [True, True]), results)
     self.dmp.Patch_DeleteThreshold = 0.5
 
@@ -832,7 +989,7 @@ class PatchTest(DiffMatchPatchTest):
     self.dmp.Match_Threshold = 0.0
     self.dmp.Match_Distance = 0
     patches = self.dmp.patch_make("abcdefghijklmnopqrstuvwxyz--------------------1234567890", "abcXXXXXXXXXXdefghijklmnopqrstuvwxyz--------------------1234567YYYYYYYYYY890")
-    results = self.dmp.patch_apply(patches, "ABCDEFGHIJKLMNOPQRSTUVWXYZ--------------------1234567890")
+    results = self.dmp.patch_apply(patches, "ABCDEFGHIJKLMNOPQRSTUVWXYZ--------------------1234567890")[:2]
     self.assertEquals(("ABCDEFGHIJKLMNOPQRSTUVWXYZ--------------------1234567YYYYYYYYYY890", [False, True]), results)
     self.dmp.Match_Threshold = 0.5
     self.dmp.Match_Distance = 1000
@@ -840,7 +997,7 @@ class PatchTest(DiffMatchPatchTest):
     # No side effects.
     patches = self.dmp.patch_make("", "test")
     patchstr = self.dmp.patch_toText(patches)
-    results = self.dmp.patch_apply(patches, "")
+    results = self.dmp.patch_apply(patches, "")[:2]
     self.assertEquals(patchstr, self.dmp.patch_toText(patches))
 
     # No side effects with major delete.
@@ -856,14 +1013,147 @@ class PatchTest(DiffMatchPatchTest):
 
     # Near edge exact match.
     patches = self.dmp.patch_make("XY", "XtestY")
-    results = self.dmp.patch_apply(patches, "XY")
+    results = self.dmp.patch_apply(patches, "XY")[:2]
     self.assertEquals(("XtestY", [True]), results)
 
     # Edge partial match.
     patches = self.dmp.patch_make("y", "y123")
-    results = self.dmp.patch_apply(patches, "x")
+    results = self.dmp.patch_apply(patches, "x")[:2]
     self.assertEquals(("x123", [True]), results)
 
+  def replayCommands(self, text, commands):
+    for command in commands:
+      if command[0] == 'insert':
+        text = text[:command[1]] + command[3] + text[command[2]:]
+      else:
+        text = text[:command[1]] + text[command[2]:]
+    return text
+
+  def testPatchApplyCommands(self):
+    # Sublime commands are minimal and use offsets of the unpadded text.
+    patches = self.dmp.patch_make("The quick brown fox jumps over the lazy dog.", "That quick brown fox jumped over a lazy dog.")
+    text, results, commands = self.dmp.patch_apply(patches, "The quick red rabbit jumps over the tired tiger.")
+    self.assertEquals("That quick red rabbit jumped over a tired tiger.", text)
+    self.assertEquals(4, self.dmp.sublime_null_padding_len)
+    self.assertEquals(self.dmp.sublime_patch_commands, commands)
+    self.assertEquals([('erase', 2, 3), ('insert', 2, 2, 'at'), ('erase', 26, 27), ('insert', 26, 26, 'ed'),
+                       ('erase', 34, 37), ('insert', 34, 34, 'a')], commands)
+
+    # A perfect match replaces only the changed characters, not the context.
+    patches = self.dmp.patch_make("abc fox xyz", "abc dog xyz")
+    self.assertEquals([('insert', 4, 7, 'dog')], self.dmp.patch_apply(patches, "abc fox xyz")[2])
+    patches = self.dmp.patch_make("abcdef", "abef")
+    self.assertEquals([('erase', 2, 4)], self.dmp.patch_apply(patches, "abcdef")[2])
+
+    # Commands replay the patch on the original text.
+    rnd = random.Random(24)
+    for _ in xrange(200):
+      base = "".join(rnd.choice("ab \n") for _ in xrange(rnd.randint(0, 100)))
+      changed = list(base)
+      for _ in xrange(rnd.randint(1, 4)):
+        start = rnd.randint(0, len(changed))
+        changed[start:start + rnd.randint(0, 5)] = rnd.choice(["", "x", "yy\n", "ab"])
+      before = base[:len(base) // 2] + "q" + base[len(base) // 2:]
+      buf = dmp_module.string_buffer(before)
+      results, commands = self.dmp.patch_applyInPlace(self.dmp.patch_make(base, "".join(changed)), buf)
+      self.assertEquals(buf.text, self.replayCommands(before, commands))
+
+  def testPatchApplyCommandsSurrogates(self):
+    # A surrogate pair is never split, and a narrow build counts it as one character.
+    smile, wink = u"\U0001f600", u"\U0001f609"
+    if len(smile) == 1:
+      smile, wink = u"\ud83d\ude00", u"\ud83d\ude09"
+    patches = self.dmp.patch_make(u"a" + smile + u"b" + smile, u"a" + smile + u"b" + wink)
+    narrow = dmp_module.NARROW_BUILD
+    try:
+      dmp_module.NARROW_BUILD = True
+      self.assertEquals([('insert', 3, 4, wink)],
+                        self.dmp.patch_apply(patches, u"a" + smile + u"b" + smile)[2])
+      dmp_module.NARROW_BUILD = False
+      self.assertEquals([('insert', 4, 6, wink)],
+                        self.dmp.patch_apply(patches, u"a" + smile + u"b" + smile)[2])
+    finally:
+      dmp_module.NARROW_BUILD = narrow
+
+  def testPatchApplyCommandsCountForward(self):
+    # A narrow build counts code points from the previous command, not from the start of the text.
+    smile = u"\U0001f600"
+    if len(smile) == 1:
+      smile = u"\ud83d\ude00"
+    base = u"".join(u"line %d %s\n" % (i, smile) for i in xrange(500))
+    changed = base
+    for i in xrange(50, 500, 50):
+      changed = changed.replace(u"\nline %d " % i, u"\nLINE %d%s " % (i, smile))
+
+    class CountingBuffer(dmp_module.string_buffer):
+      sliced = 0
+
+      def slice(self, start, end):
+        self.sliced += max(0, end - start)
+        return dmp_module.string_buffer.slice(self, start, end)
+
+    def characters(text):
+      chars = []
+      for char in text:
+        if chars and self.dmp.isLowSurrogate(char) and self.dmp.isHighSurrogate(chars[-1]):
+          chars[-1] += char
+        else:
+          chars.append(char)
+      return chars
+
+    patches = self.dmp.patch_make(base, changed)
+    narrow = dmp_module.NARROW_BUILD
+    try:
+      dmp_module.NARROW_BUILD = False
+      wide = CountingBuffer(base)
+      self.dmp.patch_applyInPlace(patches, wide)
+      dmp_module.NARROW_BUILD = True
+      buf = CountingBuffer(base)
+      results, commands = self.dmp.patch_applyInPlace(patches, buf)
+    finally:
+      dmp_module.NARROW_BUILD = narrow
+    self.assertEquals(changed, buf.text)
+    self.assertEquals(9, len(commands))
+    view = characters(base)
+    for command in commands:
+      view[command[1]:command[2]] = characters(command[3]) if command[0] == 'insert' else []
+    self.assertEquals(changed, u"".join(view))
+    # Each command reads only the text since the previous one: all commands together read the text once.
+    self.assertTrue(buf.sliced - wide.sliced <= len(base))
+
+  def testPatchAppliedPatches(self):
+    # Replacements are recorded as exact unpadded patches, trimmed to what changed.
+    patches = self.dmp.patch_make("The quick brown fox jumps over the lazy dog.", "That quick brown fox jumped over a lazy dog.")
+    self.dmp.patch_apply(patches, "The quick red rabbit jumps over the tired tiger.")
+    self.assertEquals(6, len(self.dmp.sublime_applied_patches))
+    self.assertEquals("@@ -1,7 +1,6 @@\n Th\n-e\n  qui\n@@ -1,6 +1,8 @@\n Th\n+at\n  qui\n",
+                      self.dmp.patch_toText(self.dmp.sublime_applied_patches[:2]))
+    # Undoing them in reverse order restores the text exactly.
+    undo = self.dmp.patch_invert(self.dmp.sublime_applied_patches)
+    self.dmp.Match_Threshold = 0.0
+    self.assertEquals(("The quick red rabbit jumps over the tired tiger.", [True] * 6),
+                      self.dmp.patch_apply(undo, "That quick red rabbit jumped over a tired tiger.")[:2])
+    self.dmp.patch_applyInPlace([], dmp_module.string_buffer(""))
+    self.assertEquals([], self.dmp.sublime_applied_patches)
+
+
+native_required = unittest.skipIf(dmp_module._dmp_native is None, "_dmp_native is not built")
+
+
+@native_required
+class NativeDiffTest(DiffTest):
+  native = dmp_module._dmp_native
+
+
+@native_required
+class NativeMatchTest(MatchTest):
+  native = dmp_module._dmp_native
+
+
+@native_required
+class NativePatchTest(PatchTest):
+  native = dmp_module._dmp_native
+
 
 if __name__ == "__main__":
   unittest.main()
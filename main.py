@@ -3,15 +3,17 @@
 Модуль отвечающий за основную sublime специфичную функциональность приложения (!).
 Является логической оберткой над core модулем.
 """
-from itertools import takewhile, izip
 from twisted.protocols.amp import UnknownRemoteError
 from history import TimeMachine
+from tracker import ChangeTracker, FULL
+from scheduler import PENDING
+import edits
 import init
 # noinspection PyUnresolvedReferences
 import sublime
 import logging
 # noinspection PyUnresolvedReferences
-from misc import ApplicationSpecificAdapter, all_text_view
+from misc import ApplicationSpecificAdapter
 import misc
 
 logger = logging.getLogger(__name__)
@@ -20,6 +22,9 @@ __author__ = 'snowy'
 
 from core.core import *
 
+BULK_REPLACE_RATIO = 0.5
+"""Если патч заменяет больше этой доли буфера, view меняется одной заменой вместо множества мелких"""
+
 
 class SublimeAwareApplication(Application):
     def __init__(self, _reactor, view, name=''):
@@ -34,6 +39,9 @@ class SublimeAwareApplication(Application):
         ':type view: sublime.View'
         self.locator = SublimeAwareAlgorithm(self.history_line, self.view, self, clientProtocol=self.clientProtocol,
                                              name=name)
+        self.locator.executor = self.executor
+        self.tracker = ChangeTracker(view.size(), misc.view_selection(view), change_count=view.change_count())
+        ':type tracker: tracker.ChangeTracker'
 
     def init_first_text(self, client_proto):
         d = super(SublimeAwareApplication, self).init_first_text(client_proto)
@@ -52,6 +60,8 @@ class SublimeAwareApplication(Application):
         self.view.erase(edit, sublime.Region(0, self.view.size()))
         self.view.insert(edit, 0, response['text'])
         self.view.end_edit(edit)
+        self.tracker.reset(self.view.size(), misc.view_selection(self.view), self.view.change_count())
+        self.locator.view_access.mark_synced()
         return _ret
 
 
@@ -78,6 +88,8 @@ class SublimeAwareAlgorithm(DiffMatchPatchAlgorithm):
                                                     name=name)
         self.view = view
         ':type view: sublime.View'
+        self.view_access = misc.ViewAccess(view)
+        ':type view_access: misc.ViewAccess'
         self.dmp.view = view
         self.ownerApplication = ownerApplication
         ":type ownerApplication: SublimeAwareApplication"
@@ -86,7 +98,7 @@ class SublimeAwareAlgorithm(DiffMatchPatchAlgorithm):
         self.recovering = False
 
     @ApplyPatchCommand.responder
-    def remote_applyPatch(self, patch, timestamp):
+    def remote_applyPatch(self, patch, timestamp, revision):
         """
         Применить патч в любом случае. Если патч подходит не идеально, то выполняется вначале RECOVERY.
         :param patch: force-патч от координатора
@@ -94,20 +106,80 @@ class SublimeAwareAlgorithm(DiffMatchPatchAlgorithm):
         :return: :raise ViewIsReadOnlyException: патч не может быть применен из-за read_only флага. Ситуация корректно
         не обрабатывается
         """
+        return self._modify_view(super(SublimeAwareAlgorithm, self).remote_applyPatch, patch, timestamp, revision)
+
+    @ApplyBinaryPatchCommand.responder
+    def remote_applyBinaryPatch(self, patch, timestamp, revision):
+        """
+        То же, что remote_applyPatch, для патча в формате PATCH_FORMAT_BINARY
+        :param patch: list [libs.dmp.diff_match_patch.patch_obj]
+        :param timestamp: время патча
+        """
+        return self._modify_view(self.remote_applyPatchObjects, patch, timestamp, revision)
+
+    @ApplyChunkedPatchCommand.responder
+    def remote_applyChunkedPatch(self, transfer_id, patch_format, timestamp, revision):
+        """
+        То же, что remote_applyPatch, для патча, переданного по частям PatchChunkCommand
+        """
+        patch_objects = self.take_chunked_patch(transfer_id, patch_format)
+        return self._modify_view(self.remote_applyPatchObjects, patch_objects, timestamp, revision)
+
+    def _modify_view(self, apply_patch, patch, timestamp, revision):
+        """
+        Применить патч к модели и внести те же изменения в view
+        :param apply_patch: метод, применяющий патч к модели и возвращающий (respond, commands)
+        """
+        if self.executor is not None and self.executor.busy(self):
+            # модель еще не знает о локальной правке, дифф которой считается в процессе пула
+            return self.executor.serialize(self, self._apply_to_view, apply_patch, patch, timestamp, revision)
+        return self._apply_to_view(apply_patch, patch, timestamp, revision)
+
+    def _apply_to_view(self, apply_patch, patch, timestamp, revision):
         if self.view.is_read_only():
             raise ViewIsReadOnlyException('View(id={0}) is read only. Cannot be modified'.format(self.view.id()))
-        before = misc.all_text_view(self.view)
-        respond, commands = super(SublimeAwareAlgorithm, self).remote_applyPatch(patch, timestamp)
-        assert before == misc.all_text_view(self.view)
-        self.logger.debug('starting view modifications:\n<before.view>%s</before.view>', all_text_view(self.view))
+        change_count = self.view.change_count()
+        # view совпадает с моделью; команды повторяют изменения модели, поэтому совпадение сохранится
+        synced = self.view_access.unchanged_since_sync()
+        respond, commands = apply_patch(patch, timestamp, revision)
+        # модель меняется без view
+        assert change_count == self.view.change_count()
+        # правки по убыванию позиций не сдвигают друг друга: view не читается между ними
+        batched = edits.batch(commands)
+        if len(batched) > 1 and edits.rewritten(batched) > BULK_REPLACE_RATIO * self.view.size():
+            batched = [edits.collapse(batched, self.view_access.region)]
+        self.logger.debug('starting view modifications: %d commands in %d edits', len(commands), len(batched))
+        tracker = self.ownerApplication.tracker
+        tracker.suspend()
         edit = self.view.begin_edit()
         try:
-            for sublime_command in commands:
+            for sublime_command in batched:
                 self.process_sublime_command(edit, sublime_command)
             return respond
         finally:
             self.view.end_edit(edit)
-            self.logger.debug('view modifications are ended:\n<after.view>%s</after.view>', all_text_view(self.view))
+            tracker.resume(self.view.size(), misc.view_selection(self.view), self.view.change_count())
+            # пока считается дифф локальной правки, модель отстает от view
+            if synced and not (self.executor is not None and self.executor.busy(self)) and self.check_view():
+                self.view_access.mark_synced()
+            self.logger.debug('view modifications are ended')
+
+    def check_view(self):
+        """
+        Проверить, что view совпадает с моделью текста. Сравниваются размеры, а при отладке - контрольные суммы,
+        без копий буфера
+        :return: bool
+        """
+        # view.size() - в символах, а длина модели на узкой сборке python - в единицах UTF-16
+        length = self.text_model.code_points(len(self.text_model))
+        if self.view.size() != length:
+            self.logger.warning('view (%d) and model (%d) sizes differ', self.view.size(), length)
+            return False
+        if self.logger.isEnabledFor(logging.DEBUG) and \
+                self.view_access.fingerprint() != (length, self.text_model.checksum()):
+            self.logger.warning('view and model texts differ')
+            return False
+        return True
 
     def _unknown_coordinators_error_case(self, failure):
         failure.trap(UnknownRemoteError)
@@ -120,88 +192,164 @@ class SublimeAwareAlgorithm(DiffMatchPatchAlgorithm):
         :param patch_objects: конфликтный патч от координатора
         :param timestamp: время патча
         :return: команды для sublime, которые изменяют view согласно измененной модели
+        :raise history.RecoveryFailedException: патч не подходит ни к одной точке истории
         """
         self.recovering = True
-        rollforward_commands, rollback_commands, d1d3 = super(SublimeAwareAlgorithm, self).start_recovery(patch_objects,
-                                                                                                          timestamp)
-        self.currentText = d1d3
-        self.local_onTextChanged(misc.all_text_view(self.view))
-        self.recovering = False
+        try:
+            rollforward_commands, rollback_commands, d1d3 = \
+                super(SublimeAwareAlgorithm, self).start_recovery(patch_objects, timestamp)
+            self.currentText = d1d3
+            # откаченные локальные изменения, накатанные поверх патча, отправляются заново;
+            # после команд view будет содержать именно этот текст
+            self.local_onTextChanged(self.time_machine.model_text.text)
+        finally:
+            self.recovering = False
         rollback_commands.extend(rollforward_commands)
         return rollback_commands
 
+    def unsynced_local_text(self):
+        if self.view_access.unchanged_since_sync():
+            return None
+        return misc.all_text_view(self.view)
+
+    def on_resynced(self, text):
+        """
+        Заменить текст view текстом координатора. Заменяется только отличающаяся середина текста (без общих начала
+        и конца), одной правкой
+        """
+        size = self.view.size()
+        # позиции view - в символах, позиции text на узкой сборке python - в единицах UTF-16
+        prefix, text_prefix = self.view_access.common_prefix(text)
+        if prefix == size and text_prefix == len(text):
+            self.view_access.mark_synced()
+            return
+        suffix, text_suffix = self.view_access.common_suffix(text, size - prefix, len(text) - text_prefix)
+        tracker = self.ownerApplication.tracker
+        tracker.suspend()
+        edit = self.view.begin_edit()
+        try:
+            self.view.replace(edit, sublime.Region(prefix, size - suffix), text[text_prefix:len(text) - text_suffix])
+        finally:
+            self.view.end_edit(edit)
+            tracker.resume(self.view.size(), misc.view_selection(self.view), self.view.change_count())
+            self.view_access.mark_synced()
+
+    def apply_postponed_patch(self, patch_objects, timestamp, revision):
+        return self._modify_view(self.remote_applyPatchObjects, patch_objects, timestamp, revision)
+
     def process_sublime_command(self, edit, command):
         """
-        Внести изменения в view
+        Внести изменения в view. Команды dmp уже минимальны и в позициях view: читать view не нужно
         :param edit: sublime.Edit
-        :param command: команды, приготовленные dmp во время патчинга
+        :param command: команда, приготовленная dmp во время патчинга (diff_match_patch.patch_sublimeCommand)
+        и сведенная в пакет edits.batch
         :raise NotThatTypeOfCommandError: неверный тип команды
         """
-        null_padding_len = self.dmp.sublime_null_padding_len
-        assert null_padding_len >= 0
-
         command_type = command[0]
-        sublime_start = command[1]
-        sublime_stop = command[2]
+        region = sublime.Region(command[1], command[2])
 
         if command_type == 'insert':
             text = command[3]
-            real_left_padding = 0
-            for char in text[:len(text) / 2]:
-                if char in u'\x01\x02\x03\x04':
-                    real_left_padding += 1
-
-            real_right_padding = 0
-            for char in text[len(text) / 2:]:
-                # todo: review, what if this characters would be inserted in original text?
-                if char in u'\x01\x02\x03\x04':
-                    real_right_padding += 1
-
-            # отрезаем u'\x01\x02\x03\x04' из text
-            insertion_text = text[real_left_padding:-real_right_padding] \
-                if real_right_padding != 0 else text[real_left_padding:]
-            a = sublime_start - null_padding_len + real_left_padding
-            b = sublime_stop - null_padding_len - real_right_padding
-
-            def common_prefix_f(b1, b2):
-                return [i[0] for i in takewhile(lambda x: len(set(x)) == 1, izip(b1, b2))]
-
-            was = self.view.substr(sublime.Region(a, b))
-            common_prefix = common_prefix_f(was, insertion_text)
-            region = sublime.Region(a + len(common_prefix), b)
-            trimed_insertion = insertion_text[len(common_prefix):]
             if region.a == region.b:
-                self.logger.debug(
-                    'insert(%d), "%s"--->"%s"', region.a, self.view.substr(region), trimed_insertion)
-                self.view.insert(edit, region.a, trimed_insertion)
+                self.logger.debug('insert(%d), ""--->"%s"', region.a, text)
+                self.view.insert(edit, region.a, text)
             else:
-                self.logger.debug(
-                    'replace(%d,%d), "%s"--->"%s"', region.a, region.b, self.view.substr(region), trimed_insertion)
-                self.view.replace(edit, region, trimed_insertion)
+                self.logger.debug('replace(%d,%d)--->"%s"', region.a, region.b, text)
+                self.view.replace(edit, region, text)
 
         elif command_type == 'erase':
             assert len(command) < 4
-            region = sublime.Region(sublime_start, sublime_stop)
-            self.logger.debug('erase(%d,%d), "%s"--->""', region.a, region.b, self.view.substr(region))
+            self.logger.debug('erase(%d,%d)', region.a, region.b)
             self.view.erase(edit, region)
 
         else:
             raise NotThatTypeOfCommandError()
 
 
-def run_every_second(view_id):
+def sync_changes(app):
+    """
+    Отправить накопленные ChangeTracker'ом изменения view. Читается и диффается только измененная область,
+    полный буфер берется лишь когда область неизвестна
+    :param app: SublimeAwareApplication
+    :return: defer.Deferred с результатом команды ApplyPatchCommand
+    """
+    if app.algorithm.clientProtocol is None:
+        # изменения остаются в трекере до подключения к координатору
+        return ApplyPatchCommand.no_work_is_done_response
+    executor = app.algorithm.executor
+    if executor is not None and executor.busy(app.algorithm):
+        # область изменений считается по модели, а модель ждет дифф предыдущей правки
+        return ApplyPatchCommand.no_work_is_done_response
+    change = app.tracker.consume()
+    if change is None:
+        return ApplyPatchCommand.no_work_is_done_response
+    view_access = app.algorithm.view_access
+    if change == FULL:
+        if view_access.unchanged_since_sync():
+            # буфер не менялся с тех пор, как совпадал с моделью: полный дифф ничего не найдет
+            return ApplyPatchCommand.no_work_is_done_response
+        return _sync_full(app)
+    # трекер считает позиции view в символах, а модель - в позициях строки (на узкой сборке python их больше)
+    model = app.algorithm.text_model
+    start, end, new_end = change
+    delta = new_end - end
+    start, end = app.algorithm.expand_region(model.position(start), model.position(end))
+    view_start, view_end = model.code_points(start), model.code_points(end) + delta
+    if not _context_matches(app, start, end, view_start, view_end):
+        # выделение не объясняет правку (ее сделал плагин или макрос в другом месте буфера)
+        app.algorithm.logger.debug('view was changed outside of the tracked region, full diff')
+        return _sync_full(app)
+    return app.algorithm.local_onRegionChanged(start, end, view_access.region(view_start, view_end))
+
+
+def _sync_full(app):
+    text = misc.all_text_view(app.view)
+    # модель получит этот текст, даже если дифф считается в процессе пула
+    app.algorithm.view_access.mark_synced()
+    return app.algorithm.local_onTextChanged(text)
+
+
+def _context_matches(app, start, end, view_start, view_end):
+    """
+    Совпадает ли текст вокруг области изменений в view и в модели. Если правка была вне области, текст
+    за ее границами сдвинут или изменен, и дифф области испортил бы модель
+    :param start: int начало области в позициях модели
+    :param end: int конец области в позициях модели
+    :param view_start: int начало области в символах view
+    :param view_end: int конец измененной области в символах view
+    :return: bool
+    """
+    model = app.algorithm.text_model
+    view_access = app.algorithm.view_access
+    margin = app.algorithm.dmp.Match_MaxBits
+    before = view_access.region(max(0, view_start - margin), view_start)
+    after = view_access.region(view_end, min(app.view.size(), view_end + margin))
+    return model.slice(max(0, start - len(before)), start) == before and \
+        model.slice(end, end + len(after)) == after
+
+
+def sync_view(view_id):
     """
-    Функция, которая сканирует и начинает синхронизацию каждую секунду
-    :return: функция, которая сканирует конкретную view
+    Функция синхронизации view для scheduler.SyncScheduler
+    :return: функция, которая сканирует конкретную view и отправляет ее изменения
     """
 
     def closure():
         if view_id == 'coordinator':
-            return
+            return False
         app = init.registry[view_id].application
+        if not app.tracker.poll(app.view.change_count()):
+            # view не менялась: тик ничего не читает и не диффает
+            return False
         if app.algorithm.recovering:
             logger.warning('%s is recovering and cannot be scanned for new changes. This must not happen!', app.name)
-            return
-        app.algorithm.local_onTextChanged(misc.all_text_view(app.view))
+            return PENDING
+        if app.algorithm.resyncing:
+            # изменения останутся в трекере до окончания загрузки текста координатора
+            return PENDING
+        if sync_changes(app) is ApplyPatchCommand.no_work_is_done_response:
+            # изменений не нашлось, либо они ждут подключения к координатору или диффа предыдущей правки
+            return PENDING if app.tracker.has_changes else False
+        return True
 
     return closure
\ No newline at end of file
@@ -1,8 +1,14 @@
+# coding=utf-8
 import logging
 import sublime
 
+from core.text import checksum
+from libs.dmp.diff_match_patch import diff_match_patch
+
 __author__ = 'snowy'
 
+_dmp = diff_match_patch()
+
 
 class ApplicationSpecificAdapter(logging.LoggerAdapter):
     def process(self, msg, kwargs):
@@ -20,6 +26,100 @@ def erase_view(view):
 def all_text_view(view):
     return view.substr(sublime.Region(0, view.size()))
 
+
+def view_selection(view):
+    return [(region.begin(), region.end()) for region in view.sel()]
+
+
+class ViewAccess(object):
+    CHUNK_SIZE = 65536
+    """По сколько символов читать view, когда нужен весь буфер"""
+
+    def __init__(self, view):
+        """
+        Чтение view по областям вместо копий всего буфера. Изменился ли буфер, определяется по view.change_count()
+        :param view: sublime.View
+        """
+        self.view = view
+        # (change_count, size, checksum) последней посчитанной контрольной суммы
+        self._fingerprint = None
+        # change_count, при котором буфер точно совпадал с моделью текста
+        self.synced_count = None
+
+    def region(self, start, end):
+        return self.view.substr(sublime.Region(start, end))
+
+    def chunks(self, start=0, end=None):
+        """
+        Текст view[start:end] кусками по CHUNK_SIZE
+        """
+        end = self.view.size() if end is None else end
+        for offset in xrange(start, end, self.CHUNK_SIZE):
+            yield self.region(offset, min(end, offset + self.CHUNK_SIZE))
+
+    def fingerprint(self):
+        """
+        :return: tuple (размер, контрольная сумма core.text.checksum) буфера. Буфер читается кусками и только
+        если изменился с прошлого раза
+        """
+        count = self.view.change_count()
+        if self._fingerprint is None or self._fingerprint[0] != count:
+            self._fingerprint = (count, self.view.size(), checksum(self.chunks()))
+        return self._fingerprint[1:]
+
+    def mark_synced(self):
+        """
+        Буфер сейчас совпадает с моделью текста
+        """
+        self.synced_count = self.view.change_count()
+
+    def unchanged_since_sync(self):
+        return self.synced_count is not None and self.synced_count == self.view.change_count()
+
+    def common_prefix(self, text):
+        """
+        Общее начало view и text. Читается только совпадающее начало буфера (с точностью до куска)
+        :return: tuple (длина в символах view, длина в позициях text): на узкой сборке python символ вне BMP -
+        один символ view, но две позиции строки
+        """
+        size = self.view.size()
+        offset = position = 0
+        while offset < size and position < len(text):
+            end = min(size, offset + self.CHUNK_SIZE)
+            chunk = self.region(offset, end)
+            expected = text[position:position + len(chunk)]
+            if chunk != expected:
+                common = _dmp.diff_commonPrefix(chunk, expected)
+                if common and _dmp.isHighSurrogate(chunk[common - 1]):
+                    # суррогатная пара не разрезается
+                    common -= 1
+                return offset + _dmp.codePointLength(chunk[:common]), position + common
+            offset = end
+            position += len(chunk)
+        return offset, position
+
+    def common_suffix(self, text, view_limit, text_limit):
+        """
+        Общий конец view и text, не длиннее view_limit символов view и text_limit позиций text.
+        Читается только совпадающий конец буфера
+        :return: tuple (длина в символах view, длина в позициях text)
+        """
+        size = self.view.size()
+        matched = position = 0
+        while matched < view_limit and position < text_limit:
+            length = min(self.CHUNK_SIZE, view_limit - matched)
+            chunk = self.region(size - matched - length, size - matched)
+            available = min(len(chunk), text_limit - position)
+            expected = text[len(text) - position - available:len(text) - position]
+            if chunk != expected:
+                common = _dmp.diff_commonSuffix(chunk, expected)
+                if common and _dmp.isLowSurrogate(chunk[-common]):
+                    common -= 1
+                return matched + _dmp.codePointLength(chunk[len(chunk) - common:]), position + common
+            matched += length
+            position += len(chunk)
+        return matched, position
+
 loading_anim = [
     "[=      ]",
     "[ =     ]",
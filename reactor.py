@@ -1,3 +1,4 @@
+# coding=utf-8
 import logging
 
 __author__ = 'snowy'
@@ -22,13 +23,15 @@ except ReactorAlreadyInstalledError:
 
 from twisted.internet import reactor
 
-try:
-    # noinspection PyUnresolvedReferences
-    reactor.interleave(callInSublimeLoop, installSignalHandlers=False)
-except ReactorAlreadyRunning:
-    reactorAlreadyInstalled = True
-except ReactorNotRestartable:
-    reactorAlreadyInstalled = True
+if not reactorAlreadyInstalled:
+    # чужой реактор (например, trial в тестах) уже запущен своим хозяином, interleave есть только у нашего
+    try:
+        # noinspection PyUnresolvedReferences
+        reactor.interleave(callInSublimeLoop, installSignalHandlers=False)
+    except ReactorAlreadyRunning:
+        reactorAlreadyInstalled = True
+    except ReactorNotRestartable:
+        reactorAlreadyInstalled = True
 
 if reactorAlreadyInstalled:
     log.msg('twisted reactor already installed', logLevel=logging.DEBUG)
@@ -0,0 +1,202 @@
+# coding=utf-8
+"""
+Поиск точки истории, к которой подходит конфликтный патч координатора.
+Изменения коммита описываются списком (start, end, delta) в координатах текста до коммита
+(см. core.oplog.patch_changes). Идя от новых коммитов к старым, изменения сворачиваются в одно множество:
+чем текст на глубине d отличается от текущего. Куски патча, которые это множество не задевает, лежат в текущем
+тексте без изменений, только сдвинутые, поэтому проверить глубину можно без отката текста.
+"""
+from core.oplog import patch_changes
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+_dmp = diff_match_patch()
+
+
+class _Cursor(object):
+    def __init__(self, changes):
+        """
+        Перевод позиций текста после изменений changes в позиции текста до них.
+        Позиции должны запрашиваться в неубывающем порядке
+        :param changes: list of (start, end, delta)
+        """
+        self.changes = changes
+        self.index = 0
+        self.shift = 0
+
+    def back(self, pos, is_end):
+        """
+        :param is_end: позиция - конец интервала. Позиция внутри измененного куска переводится в его конец,
+        а начало интервала - в начало куска
+        """
+        while self.index < len(self.changes):
+            start, end, delta = self.changes[self.index]
+            if pos <= start + self.shift:
+                break
+            if pos < end + self.shift + delta:
+                return end if is_end else start
+            self.shift += delta
+            self.index += 1
+        return pos - self.shift
+
+
+def compose(older, newer):
+    """
+    Свернуть изменения
+    :param older: list of (start, end, delta) изменения коммита: текст d -> текст d-1
+    :param newer: list of (start, end, delta) изменения текст d-1 -> текущий текст
+    :return: list of (start, end, delta) изменения текст d -> текущий текст, отсортированные и непересекающиеся
+    """
+    cursor = _Cursor(older)
+    mapped = []
+    for start, end, delta in newer:
+        mapped.append((cursor.back(start, False), cursor.back(end, True), delta))
+    composed = []
+    for start, end, delta in sorted(older + mapped):
+        if composed and start <= composed[-1][1]:
+            # пересекающиеся и соприкасающиеся куски сливаются
+            previous_start, previous_end, previous_delta = composed[-1]
+            composed[-1] = (previous_start, max(previous_end, end), previous_delta + delta)
+        else:
+            composed.append((start, end, delta))
+    return composed
+
+
+def locate(changes, start, length):
+    """
+    Где в текущем тексте лежит кусок [start, start + length) старого текста
+    :param changes: list of (start, end, delta) изменения старый текст -> текущий текст
+    :return: int позиция в текущем тексте или None, если кусок изменен
+    """
+    shift = 0
+    for change_start, change_end, delta in changes:
+        if change_end <= start:
+            shift += delta
+        elif change_start >= start + length:
+            break
+        else:
+            return None
+    return start + shift
+
+
+def invert(changes):
+    """
+    :param changes: list of (start, end, delta) изменения текст a -> текст b
+    :return: list of (start, end, delta) изменения текст b -> текст a в координатах текста b
+    """
+    inverted = []
+    shift = 0
+    for start, end, delta in changes:
+        inverted.append((start + shift, end + shift + delta, -delta))
+        shift += delta
+    return inverted
+
+
+def advance(changes, over):
+    """
+    Перенести изменения через другие изменения того же текста, которые их не задевают
+    :param changes: list of (start, end, delta)
+    :param over: list of (start, end, delta) изменения, после которых применяются changes
+    :return: list of (start, end, delta) changes в координатах текста после over
+    """
+    advanced = []
+    index = 0
+    shift = 0
+    for start, end, delta in changes:
+        while index < len(over) and over[index][1] <= start:
+            shift += over[index][2]
+            index += 1
+        advanced.append((start + shift, end + shift, delta))
+    return advanced
+
+
+def hunk_ranges(patch_objects):
+    """
+    :return: list of (start, end) куски патча вместе с контекстом в координатах текста, на котором сделан патч
+    """
+    ranges = []
+    delta = 0
+    for patch in patch_objects:
+        ranges.append((patch.start1 - delta, patch.start1 - delta + patch.length1))
+        delta += patch.length2 - patch.length1
+    return ranges
+
+
+def intersects(ranges, changes):
+    """
+    Задевают ли изменения текст кусков ranges. Вставка на границе куска его не задевает
+    :param ranges: list of (start, end)
+    :param changes: list of (start, end, delta) в тех же координатах
+    """
+    return any(start < range_end and range_start < end
+               for range_start, range_end in ranges for start, end, _ in changes)
+
+
+def back(changes, ranges):
+    """
+    Куски текста после изменений changes в координатах текста до них
+    :param ranges: list of (start, end) отсортированные непересекающиеся куски
+    """
+    cursor = _Cursor(changes)
+    return [(cursor.back(start, False), cursor.back(end, True)) for start, end in ranges]
+
+
+class PatchLocator(object):
+    def __init__(self, patch_objects):
+        """
+        Ищет глубину истории, на тексте которой сделан патч
+        :param patch_objects: list [libs.dmp.diff_match_patch.patch_obj] конфликтный патч
+        """
+        self.patch_objects = patch_objects
+        # (позиция в тексте, на котором сделан патч, текст куска до патча). Позиция куска в патче - в тексте
+        # с уже примененными предыдущими кусками, поэтому из нее вычитается их изменение длины
+        self.hunks = []
+        delta = 0
+        for patch in patch_objects:
+            self.hunks.append((patch.start1 - delta, _dmp.diff_text1(patch.diffs)))
+            delta += patch.length2 - patch.length1
+        # текст на текущей глубине -> текущий текст
+        self.changes = []
+        self.depth = 0
+
+    def descend(self, forward_patch):
+        """
+        Опуститься на один коммит глубже
+        :param forward_patch: list [libs.dmp.diff_match_patch.patch_obj] прямой патч этого коммита
+        """
+        self.changes = compose(patch_changes(forward_patch), self.changes)
+        self.depth += 1
+
+    def shifts(self, model):
+        """
+        Подходит ли патч к тексту на текущей глубине, если судить по куску текущего текста, не задетому коммитами
+        выше этой глубины
+        :param model: модель текущего текста (core.text)
+        :return: list [int] сдвиг каждого куска патча в текущем тексте или None, если патч не подходит
+        или его куски задеты коммитами
+        """
+        shifts = []
+        for start, text1 in self.hunks:
+            position = locate(self.changes, start, len(text1))
+            if position is None or model.slice(position, position + len(text1)) != text1:
+                return None
+            shifts.append(position - start)
+        return shifts
+
+    def rebased(self, shifts):
+        """
+        :return: копия патча, сдвинутая в координаты текущего текста. Сдвиг куска не зависит от того, в каких
+        координатах считать его позицию, поэтому добавляется к позиции куска в патче
+        """
+        patches = _dmp.patch_deepCopy(self.patch_objects)
+        for patch, shift in zip(patches, shifts):
+            patch.start1 += shift
+            patch.start2 += shift
+        return patches
+
+    def fits(self, model):
+        """
+        Подходит ли патч к тексту model идеально (куски на своих местах)
+        """
+        return all(model.slice(start, start + len(text1)) == text1 for start, text1 in self.hunks)
@@ -0,0 +1,161 @@
+# coding=utf-8
+"""
+Один планировщик синхронизации на все shared view вместо LoopingCall с фиксированной секундой на каждую.
+Сразу после правок view опрашивается часто, в простое интервал растет экспоненциально. За один тик
+синхронизируются только те view, что успевают в общий бюджет времени, остальные идут первыми в следующем тике.
+Модуль не зависит от sublime: view представлена функцией синхронизации.
+"""
+import logging
+
+__author__ = 'snowy'
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+"""Результат функции синхронизации: изменения есть, но отправить их пока нельзя (идет загрузка, дифф в пуле)"""
+
+
+class LatencyStats(object):
+    """
+    Задержка от правки view до отправки изменений, секунды
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.last = latency
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __repr__(self):
+        return 'LatencyStats(count={0}, mean={1}, max={2}, last={3})'.format(self.count, self.mean, self.max,
+                                                                             self.last)
+
+
+class _Entry(object):
+    def __init__(self, sync, interval, due):
+        self.sync = sync
+        self.interval = interval
+        self.due = due
+        # момент первой неотправленной правки (None - все отправлено)
+        self.pending_since = None
+        self.stats = LatencyStats()
+
+
+class SyncScheduler(object):
+    def __init__(self, reactor, min_interval=0.05, max_interval=1.0, backoff=2.0, budget=0.05, timer=None):
+        """
+        :param reactor: twisted reactor (callLater и seconds)
+        :param min_interval: float интервал опроса view сразу после правки, секунды
+        :param max_interval: float предельный интервал опроса простаивающей view
+        :param backoff: float во сколько раз растет интервал после каждого пустого опроса
+        :param budget: float сколько времени за тик можно потратить на синхронизацию всех view
+        :param timer: функция текущего времени для подсчета бюджета (по умолчанию reactor.seconds)
+        """
+        self.reactor = reactor
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.budget = budget
+        self.timer = timer or reactor.seconds
+        self.entries = {}
+        """:type entries: dict view_id → _Entry"""
+        self._call = None
+
+    def __contains__(self, view_id):
+        return view_id in self.entries
+
+    def add(self, view_id, sync):
+        """
+        Начать синхронизацию view. Повторное добавление ничего не меняет.
+        :param sync: функция без аргументов: True - изменения отправлены, PENDING - изменения ждут отправки,
+        False - изменений нет
+        """
+        if view_id not in self.entries:
+            self.entries[view_id] = _Entry(sync, self.min_interval, self.reactor.seconds())
+            self._reschedule()
+
+    def remove(self, view_id):
+        if self.entries.pop(view_id, None) is not None:
+            self._reschedule()
+
+    def wake(self, view_id):
+        """
+        View изменилась: опросить ее в ближайший короткий интервал
+        """
+        entry = self.entries.get(view_id)
+        if entry is None:
+            return
+        now = self.reactor.seconds()
+        if entry.pending_since is None:
+            entry.pending_since = now
+        entry.interval = self.min_interval
+        if entry.due > now + self.min_interval:
+            entry.due = now + self.min_interval
+            self._reschedule()
+
+    def latency(self, view_id):
+        """
+        :return: LatencyStats задержек отправки правок view
+        """
+        return self.entries[view_id].stats
+
+    def _reschedule(self, pause=0.0):
+        """
+        :param pause: float не раньше чем через сколько секунд делать следующий тик
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if not self.entries:
+            return
+        due = min(entry.due for entry in self.entries.itervalues())
+        self._call = self.reactor.callLater(max(pause, due - self.reactor.seconds()), self._tick)
+
+    def _tick(self):
+        self._call = None
+        now = self.reactor.seconds()
+        started = self.timer()
+        due = sorted((entry.due, view_id) for view_id, entry in self.entries.iteritems() if entry.due <= now)
+        pause = 0.0
+        for _, view_id in due:
+            if self.timer() - started >= self.budget:
+                # не уложились: оставшиеся view сохраняют свой срок и будут первыми в следующем тике,
+                # а до него редактор получает передышку
+                pause = self.min_interval
+                break
+            entry = self.entries.get(view_id)
+            if entry is None:
+                # view убрали во время синхронизации другой view
+                continue
+            try:
+                result = entry.sync()
+            except Exception:
+                logger.exception('sync of view %s failed', view_id)
+                result = False
+            self._update(entry, result)
+        self._reschedule(pause)
+
+    def _update(self, entry, result):
+        now = self.reactor.seconds()
+        if result:
+            if entry.pending_since is None:
+                # правку заметил сам опрос, а не событие редактора
+                entry.pending_since = now
+            if result != PENDING:
+                entry.stats.add(now - entry.pending_since)
+                entry.pending_since = None
+            entry.interval = self.min_interval
+        else:
+            entry.pending_since = None
+            entry.interval = min(entry.interval * self.backoff, self.max_interval)
+        entry.due = now + entry.interval
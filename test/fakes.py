@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Заменители API sublime для тестов модулей плагина (main, misc, init) вне редактора.
+FakeView считает позиции в символах, как sublime: суррогатная пара узкой сборки python - один символ.
+"""
+import sys
+import types
+
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def __repr__(self):
+        return 'Region({0}, {1})'.format(self.a, self.b)
+
+
+def install():
+    """
+    Подставить модули sublime и sublime_plugin, если тесты идут не в редакторе. Вызывается до импорта модулей плагина
+    """
+    # модуль reactor плагина ставит реактор для sublime, только если никакой еще не установлен: тесты идут
+    # на реакторе trial
+    import twisted.internet.reactor
+    if 'sublime' not in sys.modules:
+        sublime = types.ModuleType('sublime')
+        sublime.Region = Region
+        sublime.View = FakeView
+        sublime.Edit = object
+        for name in ('status_message', 'error_message', 'message_dialog', 'run_command'):
+            setattr(sublime, name, lambda *args, **kwargs: None)
+        sublime.set_timeout = lambda function, delay: function()
+        sys.modules['sublime'] = sublime
+    if 'sublime_plugin' not in sys.modules:
+        sublime_plugin = types.ModuleType('sublime_plugin')
+        for name in ('ApplicationCommand', 'WindowCommand', 'TextCommand', 'EventListener'):
+            setattr(sublime_plugin, name, type(name, (object,), {}))
+        sys.modules['sublime_plugin'] = sublime_plugin
+
+
+def characters(text):
+    """
+    :return: list символов text, суррогатная пара - один элемент
+    """
+    result = []
+    for char in text:
+        if result and diff_match_patch.isLowSurrogate(char) and diff_match_patch.isHighSurrogate(result[-1]):
+            result[-1] += char
+        else:
+            result.append(char)
+    return result
+
+
+class FakeView(object):
+    def __init__(self, text=u'', view_id=1):
+        self._id = view_id
+        self._chars = characters(text)
+        self._change_count = 0
+        self.selection = [(0, 0)]
+        self.read_only = False
+        # (method, begin, end) каждой правки
+        self.edits = []
+        self.edits_open = 0
+
+    @property
+    def text(self):
+        return u''.join(self._chars)
+
+    def id(self):
+        return self._id
+
+    def file_name(self):
+        return None
+
+    def size(self):
+        return len(self._chars)
+
+    def change_count(self):
+        return self._change_count
+
+    def is_read_only(self):
+        return self.read_only
+
+    def substr(self, region):
+        return u''.join(self._chars[region.begin():region.end()])
+
+    def sel(self):
+        return [Region(begin, end) for begin, end in self.selection]
+
+    def begin_edit(self):
+        self.edits_open += 1
+        return object()
+
+    def end_edit(self, edit):
+        self.edits_open -= 1
+
+    def _replace(self, method, begin, end, text):
+        assert self.edits_open, 'view is changed outside of an edit'
+        assert 0 <= begin <= end <= len(self._chars)
+        self._chars[begin:end] = characters(text)
+        self._change_count += 1
+        self.edits.append((method, begin, end))
+
+    def insert(self, edit, point, text):
+        self._replace('insert', point, point, text)
+        return len(characters(text))
+
+    def erase(self, edit, region):
+        self._replace('erase', region.begin(), region.end(), u'')
+
+    def replace(self, edit, region, text):
+        self._replace('replace', region.begin(), region.end(), text)
+
+    def type(self, begin, end, text):
+        """
+        Правка пользователя: выделение [begin, end) заменено на text, курсор встает после него
+        """
+        self.selection = [(begin, end)]
+        edit = self.begin_edit()
+        self.replace(edit, Region(begin, end), text)
+        self.end_edit(edit)
+        cursor = begin + len(characters(text))
+        self.selection = [(cursor, cursor)]
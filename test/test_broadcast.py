@@ -0,0 +1,129 @@
+# coding=utf-8
+"""
+Тесты на группу рассылки координатора
+"""
+from twisted.internet.error import ConnectionDone
+from twisted.protocols.amp import parseString, COMMAND, ASK
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from core.broadcast import serialize_command
+from core.command import ApplyPatchCommand, ResyncCommand
+from core.core import CoordinatorDiffMatchPatchAlgorithm, MultipleConnectionServerFactory
+from core.documents import DocumentRegistry
+from history import HistoryLine
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+
+class BroadcastGroupTest(unittest.TestCase):
+    def setUp(self):
+        self.documents = DocumentRegistry(
+            lambda document_id, text, revision: CoordinatorDiffMatchPatchAlgorithm(HistoryLine(None), text))
+        self.factory = MultipleConnectionServerFactory(self.documents)
+        self.protos = []
+        for _ in xrange(3):
+            proto = self.factory.buildProtocol(None)
+            proto.makeConnection(StringTransport())
+            proto.locator.open_document(None)
+            self.protos.append(proto)
+
+    def test_closed_connection_leaves_group(self):
+        group = self.protos[0].locator.group
+        self.assertEqual(len(group), 3)
+        self.assertEqual(set(group.others(self.protos[0])), set(self.protos[1:]))
+        self.protos[1].connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(len(group), 2)
+        self.assertNotIn(self.protos[1], group)
+        self.assertEqual(list(group.others(self.protos[0])), [self.protos[2]])
+
+    def test_serialized_command_has_no_ask(self):
+        data = serialize_command(ApplyPatchCommand, self.protos[0], patch='@@ -1 +1 @@', timestamp=1.5, revision=7)
+        box, = parseString(data)
+        self.assertEqual(box[COMMAND], ApplyPatchCommand.commandName)
+        self.assertNotIn(ASK, box)
+        self.assertEqual(box['revision'], '7')
+
+
+class PeerQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(100))
+        self.documents = DocumentRegistry(
+            lambda document_id, text, revision: CoordinatorDiffMatchPatchAlgorithm(HistoryLine(None), self.base))
+        self.factory = MultipleConnectionServerFactory(self.documents)
+        self.writer, self.reader = self.connect(), self.connect()
+        self.algorithm = self.writer.locator.decorated_locator
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        self.successResultOf(proto.locator.get_text(None))
+        proto.transport.clear()
+        return proto
+
+    def edit(self, proto, old, new):
+        text = self.algorithm.currentText
+        return proto.locator.try_apply_patch(self.dmp.patch_toText(self.dmp.patch_make(text, text.replace(old, new))),
+                                             1.0, None, None)
+
+    def received(self, proto):
+        boxes = parseString(proto.transport.value())
+        proto.transport.clear()
+        return boxes
+
+    def test_patches_for_paused_peer_are_squashed(self):
+        self.reader.locator.queue.pauseProducing()
+        for i in xrange(3):
+            self.successResultOf(self.edit(self.writer, u'line %d of' % (i * 10), u'LINE %d of' % i))
+        self.assertEqual(self.received(self.reader), [])
+        self.assertEqual(len(self.reader.locator.queue), 3)
+
+        self.reader.locator.queue.resumeProducing()
+        box, = self.received(self.reader)
+        self.assertEqual(box['revision'], '3')
+        text, results, _ = self.dmp.patch_apply(self.dmp.patch_fromText(box['patch'].decode('utf-8')), self.base)
+        self.assertNotIn(False, results)
+        self.assertEqual(text, self.algorithm.currentText)
+
+    def test_multi_hunk_patches_for_paused_peer_are_squashed(self):
+        self.reader.locator.queue.pauseProducing()
+        # правка несколькими курсорами: патч из многих кусков, каждый укорачивает текст
+        self.successResultOf(self.edit(self.writer, u'0 of the document', u'0'))
+        # правка внутри области первого патча
+        self.successResultOf(self.edit(self.writer, u'line 60\n', u'line 60 of 100\n'))
+        self.reader.locator.queue.resumeProducing()
+        box, = self.received(self.reader)
+        text, results, _ = self.dmp.patch_apply(self.dmp.patch_fromText(box['patch'].decode('utf-8')), self.base)
+        self.assertNotIn(False, results)
+        self.assertEqual(text, self.algorithm.currentText)
+
+    def test_answer_does_not_overtake_queued_patches(self):
+        self.reader.locator.queue.pauseProducing()
+        self.successResultOf(self.edit(self.writer, u'line 10 of', u'LINE 10 of'))
+        answer = self.edit(self.reader, u'line 50 of', u'LINE 50 of')
+        self.assertNoResult(answer)
+
+        self.reader.locator.queue.resumeProducing()
+        self.assertEqual(self.successResultOf(answer), {'succeed': True, 'revision': 2})
+        box, = self.received(self.reader)
+        self.assertEqual(box['revision'], '1')
+
+    def test_lagging_peer_is_dropped_to_resync(self):
+        queue = self.reader.locator.queue
+        queue.max_size = 100
+        queue.pauseProducing()
+        for i in xrange(10):
+            self.successResultOf(self.edit(self.writer, u'line %d of' % i, u'LINE %d of the document line' % i))
+        self.assertTrue(queue.dropped)
+        self.assertEqual(len(queue), 0)
+        box, = self.received(self.reader)
+        self.assertEqual(box[COMMAND], ResyncCommand.commandName)
+
+        # патчи не нужны, пока пир не начнет загружать текст
+        self.successResultOf(self.edit(self.writer, u'line 20 of', u'LINE 20 of'))
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(self.successResultOf(self.reader.locator.get_text(None))['text'], self.algorithm.currentText)
+        self.assertFalse(queue.dropped)
@@ -0,0 +1,29 @@
+# coding=utf-8
+"""
+Тесты на бинарный формат патчей
+"""
+from twisted.trial import unittest
+
+from core.codec import encode_patches, decode_patches, PatchDecodeError
+from libs.dmp.diff_match_patch import diff_match_patch
+import test.base.constants as constants
+
+__author__ = 'snowy'
+
+
+class CodecTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+
+    def test_round_trip(self):
+        patches = self.dmp.patch_make(constants.initialText, constants.textVer4)
+        decoded = decode_patches(encode_patches(patches))
+        self.assertEqual(self.dmp.patch_toText(decoded), self.dmp.patch_toText(patches))
+
+    def test_smaller_than_text_format_for_cyrillic(self):
+        patches = self.dmp.patch_make(constants.initialText, constants.textVer4)
+        self.assertTrue(len(encode_patches(patches)) * 2 < len(self.dmp.patch_toText(patches)))
+
+    def test_truncated_data(self):
+        data = encode_patches(self.dmp.patch_make(constants.initialText, constants.textVer2))
+        self.assertRaises(PatchDecodeError, decode_patches, data[:-3])
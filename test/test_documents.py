@@ -0,0 +1,96 @@
+# coding=utf-8
+"""
+Тесты на документы координатора
+"""
+import os
+
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from core.core import CoordinatorApplication, MultipleConnectionServerFactory
+from core.exceptions import WrongDocumentException
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+
+class CoordinatorDocumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.dmp = diff_match_patch()
+        self.coordinator = CoordinatorApplication(self.clock, initial_text=u'default\n',
+                                                  storage_directory=self.mktemp(), idle_timeout=30)
+        self.factory = MultipleConnectionServerFactory(self.coordinator.documents)
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        return proto
+
+    def edit(self, proto, document, text, next_text):
+        return self.successResultOf(proto.locator.try_apply_patch(
+            self.dmp.patch_toText(self.dmp.patch_make(text, next_text)), 1.0, None, document))
+
+    def get_text(self, proto, document):
+        return self.successResultOf(proto.locator.get_text(document))
+
+    def test_commands_are_routed_by_document(self):
+        first, second, default = self.connect(), self.connect(), self.connect()
+        self.assertEqual(self.get_text(first, u'a.txt')['text'], u'')
+        self.assertEqual(self.get_text(second, u'b.txt')['text'], u'')
+        self.assertEqual(self.edit(first, u'a.txt', u'', u'alpha\n')['revision'], 1)
+        self.assertEqual(self.edit(second, u'b.txt', u'', u'beta\n')['revision'], 1)
+        self.assertEqual(self.get_text(default, None)['text'], u'default\n')
+        self.assertEqual(self.get_text(first, u'a.txt')['text'], u'alpha\n')
+        self.assertEqual(self.get_text(second, u'b.txt')['text'], u'beta\n')
+        self.assertRaises(WrongDocumentException, first.locator.get_text, u'b.txt')
+
+    def test_idle_document_is_evicted_to_disk(self):
+        proto = self.connect()
+        self.get_text(proto, u'a.txt')
+        self.edit(proto, u'a.txt', u'', u'alpha\n')
+        documents = self.coordinator.documents
+        self.clock.advance(60)
+        # у документа есть участник
+        self.assertEqual(documents.evict_idle(), [])
+        proto.connectionLost(Failure(ConnectionDone()))
+        self.clock.advance(10)
+        self.assertEqual(documents.evict_idle(), [])
+        self.clock.advance(30)
+        self.assertEqual(documents.evict_idle(), [u'a.txt'])
+        self.assertNotIn(u'a.txt', documents)
+        # документ по умолчанию не выгружается
+        self.assertIn(u'', documents)
+
+        proto = self.connect()
+        self.assertEqual(self.get_text(proto, u'a.txt'), {'text': u'alpha\n', 'revision': 1})
+        self.assertEqual(self.edit(proto, u'a.txt', u'alpha\n', u'alpha beta\n')['revision'], 2)
+
+    def test_documents_of_previous_session_are_not_loaded(self):
+        storage = self.mktemp()
+        previous = CoordinatorApplication(self.clock, initial_text=u'yesterday text', storage_directory=storage)
+        previous.documents.open(u'a.txt', u'alpha\n')
+        self.clock.advance(previous.documents.idle_timeout + 1)
+        self.assertEqual(previous.documents.evict_idle(), [u'a.txt'])
+
+        coordinator = CoordinatorApplication(self.clock, initial_text=u'today text', storage_directory=storage)
+        self.assertEqual(coordinator.locator.local_text, u'today text')
+        self.assertEqual(coordinator.documents.open(u'a.txt').algorithm.local_text, u'')
+        previous.documents.close()
+        self.assertFalse(os.path.exists(previous.documents.store.directory))
+
+    def test_owner_text_replaces_document_without_participants(self):
+        documents = self.coordinator.documents
+        self.coordinator.open_document(u'a.txt', u'alpha\n')
+        self.clock.advance(60)
+        self.assertEqual(documents.evict_idle(), [u'a.txt'])
+        # владелец снова открывает документ своим текстом, а не выгруженным
+        self.assertEqual(self.coordinator.open_document(u'a.txt', u'alpha beta\n').local_text, u'alpha beta\n')
+        self.assertEqual(self.coordinator.open_document(u'a.txt', u'alpha gamma\n').local_text, u'alpha gamma\n')
+
+        proto = self.connect()
+        self.get_text(proto, u'a.txt')
+        self.assertEqual(self.coordinator.open_document(u'a.txt', u'other\n').local_text, u'alpha gamma\n')
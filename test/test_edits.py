@@ -0,0 +1,88 @@
+# coding=utf-8
+"""
+Тесты на сведение последовательных команд dmp в пакет правок view
+"""
+import random
+
+from twisted.trial import unittest
+
+from edits import batch, collapse, rewritten
+from libs.dmp.diff_match_patch import diff_match_patch, string_buffer
+
+__author__ = 'snowy'
+
+
+def replay(text, commands):
+    for command in commands:
+        inserted = command[3] if command[0] == 'insert' else u''
+        assert 0 <= command[1] <= command[2] <= len(text)
+        text = text[:command[1]] + inserted + text[command[2]:]
+    return text
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(2525)
+
+    def random_text(self, length):
+        return u''.join(self.random.choice(u'ab \nж') for _ in xrange(length))
+
+    def random_commands(self, text):
+        commands = []
+        for _ in xrange(self.random.randint(1, 8)):
+            start = self.random.randint(0, len(text))
+            end = self.random.randint(start, min(len(text), start + 6))
+            inserted = self.random_text(self.random.choice([0, 1, 3]))
+            if start == end and not inserted:
+                continue
+            command = ('insert', start, end, inserted) if inserted else ('erase', start, end)
+            commands.append(command)
+            text = replay(text, [command])
+        return commands, text
+
+    def assertDescending(self, batched):
+        # соприкасающиеся правки сливаются, поэтому между соседними всегда есть нетронутый текст
+        for later, earlier in zip(batched[1:], batched):
+            self.assertTrue(later[2] < earlier[1])
+
+    def test_batch_replays_sequential_commands(self):
+        for _ in xrange(500):
+            text = self.random_text(self.random.randint(0, 40))
+            commands, expected = self.random_commands(text)
+            batched = batch(commands)
+            self.assertDescending(batched)
+            self.assertEqual(replay(text, batched), expected)
+
+    def test_touching_commands_are_merged(self):
+        # вставка, затем удаление ее конца и вставка сразу за ней
+        commands = [('insert', 2, 2, u'xyz'), ('erase', 4, 5), ('insert', 4, 4, u'w'), ('erase', 0, 1)]
+        self.assertEqual(batch(commands), [('insert', 2, 2, u'xyw'), ('erase', 0, 1)])
+        self.assertEqual(batch([('insert', 1, 1, u'x'), ('erase', 1, 2)]), [])
+
+    def test_collapse(self):
+        for _ in xrange(200):
+            text = self.random_text(self.random.randint(1, 40))
+            commands, expected = self.random_commands(text)
+            batched = batch(commands)
+            if not batched:
+                continue
+            reads = []
+
+            def read(start, end):
+                reads.append((start, end))
+                return text[start:end]
+
+            command = collapse(batched, read)
+            self.assertEqual(replay(text, [command]), expected)
+            self.assertEqual(len(reads), 1)
+            self.assertTrue(command[2] - command[1] >= rewritten(batched))
+
+    def test_batch_of_applied_patch(self):
+        dmp = diff_match_patch()
+        base = u''.join(u'line %d of the document\n' % i for i in xrange(50))
+        changed = base.replace(u'line 1', u'LINE 1').replace(u'document', u'text')
+        buf = string_buffer(base)
+        _, commands = dmp.patch_applyInPlace(dmp.patch_make(base, changed), buf)
+        batched = batch(commands)
+        self.assertDescending(batched)
+        self.assertEqual(replay(base, batched), buf.text)
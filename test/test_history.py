@@ -0,0 +1,115 @@
+# coding=utf-8
+"""
+Тесты на сжатие истории
+"""
+import random
+
+from twisted.trial import unittest
+
+from core.core import DiffMatchPatchAlgorithm
+from core.text import RopeText
+from history import HistoryLine, HistoryEntry, RetentionPolicy, TimeMachine
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+
+class HistoryCompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(4242)
+        self.dmp = diff_match_patch()
+        self.text = u''.join(u'line %d of the document\n' % i for i in xrange(100))
+        self.model = RopeText(self.text)
+        self.texts = [self.text]
+
+    def edit(self, history_line, timestamp):
+        start = self.random.randint(0, len(self.text))
+        end = min(len(self.text), start + self.random.randint(0, 10))
+        next_text = self.text[:start] + u'edit %d' % timestamp + self.text[end:]
+        forward = HistoryEntry(self.dmp.patch_make(self.text, next_text), timestamp, True)
+        backward = HistoryEntry(self.dmp.patch_make(next_text, self.text), timestamp, True)
+        history_line.commit_with_rollback(forward, backward, self.model)
+        self.model.text = self.text = next_text
+        self.texts.append(next_text)
+
+    def roll_back(self, history_line, count):
+        model = self.model.copy()
+        for entry in history_line.rollback_history[len(history_line) - count:][::-1]:
+            result, _ = self.dmp.patch_applyInPlace(entry.patch, model)
+            self.assertNotIn(False, result)
+        return model.text
+
+    def test_history_is_bounded_by_count(self):
+        history_line = HistoryLine(None, RetentionPolicy(max_entries=20, max_bytes=None))
+        for timestamp in xrange(100):
+            self.edit(history_line, timestamp)
+            # свернутый коммит и не больше max_entries + 1 обычных
+            self.assertTrue(len(history_line) <= 22)
+        self.assertIsNotNone(history_line.checkpoint)
+        self.assertEqual(history_line.size, sum(history_line.sizes))
+        # любая сохраненная точка достижима откатом
+        for count in xrange(len(history_line)):
+            self.assertEqual(self.roll_back(history_line, count), self.texts[-1 - count])
+        self.assertEqual(self.roll_back(history_line, len(history_line)), history_line.checkpoint.text)
+
+    def test_history_is_bounded_by_bytes(self):
+        history_line = HistoryLine(None, RetentionPolicy(max_entries=None, max_bytes=500))
+        for timestamp in xrange(100):
+            self.edit(history_line, timestamp)
+        self.assertTrue(history_line.size - history_line.sizes[0] <= 500)
+        self.assertEqual(self.roll_back(history_line, len(history_line)), history_line.checkpoint.text)
+
+    def test_history_is_bounded_by_age(self):
+        history_line = HistoryLine(None, RetentionPolicy(max_entries=None, max_bytes=None, max_age=10))
+        for timestamp in xrange(100):
+            self.edit(history_line, timestamp)
+        # время коммитов в тесте - далекое прошлое, поэтому свернуто все, кроме последнего
+        self.assertEqual(len(history_line), 2)
+
+    def test_recovery_rolls_back_to_checkpoint(self):
+        history_line = HistoryLine(None, RetentionPolicy(max_entries=10, max_bytes=None))
+        algorithm = DiffMatchPatchAlgorithm(history_line, initialText=self.text)
+        for timestamp in xrange(30):
+            self.edit(history_line, timestamp)
+        checkpoint = history_line.checkpoint.text
+        time_machine = TimeMachine(history_line, algorithm)
+        time_machine.model_text = self.model.copy()
+        pop_stack = []
+        while len(history_line):
+            to_be_rolled_back, _ = time_machine._pop_one_commit(pop_stack)
+            time_machine._rollback(to_be_rolled_back.patch)
+        self.assertEqual(time_machine.model_text.text, checkpoint)
+        self.assertIsNone(history_line.checkpoint)
+
+
+class HistoryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(777)
+        self.history_line = HistoryLine(None, RetentionPolicy(max_entries=None, max_bytes=None))
+
+    def commit(self, timestamp):
+        entry = HistoryEntry([], timestamp, False)
+        self.history_line.commit_with_rollback(entry, entry)
+
+    def assertQueries(self):
+        entries = list(self.history_line)
+        for _ in xrange(20):
+            start = self.random.uniform(-5, 105)
+            end = start + self.random.uniform(0, 30)
+            self.assertEqual(self.history_line.get_all_since(start),
+                             sorted([entry for entry in entries if entry.timestamp > start],
+                                    key=lambda entry: entry.timestamp))
+            self.assertEqual(sorted(self.history_line.between(start, end)),
+                             sorted([entry for entry in entries if start < entry.timestamp <= end]))
+        self.assertEqual(list(self.history_line.last(7)), entries[-7:])
+
+    def test_queries_match_linear_scan(self):
+        for timestamp in xrange(100):
+            # чужие часы могут отставать
+            self.commit(timestamp + self.random.choice([0, 0, 0, -3.5, 2.25]))
+        self.assertQueries()
+        for _ in xrange(30):
+            self.history_line.pop()
+        self.assertQueries()
+        self.history_line._drop(20)
+        self.assertQueries()
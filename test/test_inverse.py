@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Тесты на обратные патчи истории, которые строятся без диффа текстов
+"""
+import random
+
+from twisted.trial import unittest
+
+from core.core import DiffMatchPatchAlgorithm
+from core.inverse import InversePatch
+from history import HistoryLine
+from libs.dmp.diff_match_patch import diff_match_patch, string_buffer
+from test.test_outbound import FakeCoordinatorProtocol
+
+__author__ = 'snowy'
+
+
+class InversePatchTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1919)
+        self.dmp = diff_match_patch()
+        self.strict_dmp = diff_match_patch()
+        self.strict_dmp.Match_Threshold = 0.0
+
+    def random_text(self, length):
+        return u''.join(self.random.choice(u'ab \n') for _ in xrange(length))
+
+    def random_edit(self, text):
+        for _ in xrange(self.random.randint(1, 5)):
+            start = self.random.randint(0, len(text))
+            end = min(len(text), start + self.random.choice([0, 1, 5, 50]))
+            text = text[:start] + self.random_text(self.random.choice([0, 1, 5, 80])) + text[end:]
+        return text
+
+    def assertRollsBack(self, inverse, patched, expected):
+        result = self.strict_dmp.patch_apply(inverse, patched)
+        self.assertNotIn(False, result[1])
+        self.assertEqual(result[0], expected)
+
+    def test_inverse_of_made_patch(self):
+        for _ in xrange(300):
+            before = self.random_text(self.random.randint(0, 300))
+            patches = self.dmp.patch_make(before, self.random_edit(before))
+            self.assertRollsBack(InversePatch(patches), self.dmp.patch_apply(patches, before)[0], before)
+
+    def test_inverse_of_applied_patch(self):
+        for _ in xrange(300):
+            base = self.random_text(self.random.randint(50, 300))
+            # патч сделан на другой версии текста и применяется не в те места, что указаны в нем
+            patches = self.dmp.patch_make(base, self.random_edit(base))
+            before = self.random_edit(base)
+            patched = string_buffer(before)
+            self.dmp.patch_applyInPlace(patches, patched)
+            self.assertRollsBack(InversePatch(self.dmp.sublime_applied_patches), patched.text, before)
+
+    def test_inverse_keeps_hunks_of_shifted_patch(self):
+        before = u'some text of the document'
+        patches = self.dmp.patch_make(before, before.replace(u'text', u'words'))
+        inverse = InversePatch(patches)
+        for patch in patches:
+            patch.start1 += 100
+            patch.start2 += 100
+        self.assertRollsBack(inverse, before.replace(u'text', u'words'), before)
+        self.assertEqual(inverse.size, sum(len(data) for patch in patches for _, data in patch.diffs))
+
+
+class HistoryInverseTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(100))
+        self.algorithm = DiffMatchPatchAlgorithm(HistoryLine(None), initialText=self.base,
+                                                 clientProtocol=FakeCoordinatorProtocol())
+        self.algorithm.revision = None
+
+    def test_commits_are_rolled_back_by_inverse_patches(self):
+        texts = [self.base]
+        self.algorithm.local_onTextChanged(self.base.replace(u'line 10 of', u'line ten of'))
+        texts.append(self.algorithm.currentText)
+        remote = self.dmp.patch_make(texts[-1], texts[-1].replace(u'line 50 of', u'line fifty of'))
+        self.algorithm.remote_applyPatchObjects(remote, 1.0)
+        texts.append(self.algorithm.currentText)
+        self.algorithm.local_onRegionChanged(0, 4, u'LINE')
+        texts.append(self.algorithm.currentText)
+
+        history_line = self.algorithm.history
+        self.assertTrue(all(isinstance(entry.patch, InversePatch) for entry in history_line.rollback_history))
+        model = self.algorithm.text_model.copy()
+        for entry, expected in zip(reversed(history_line.rollback_history), reversed(texts[:-1])):
+            result, _ = history_line.strict_dmp.patch_applyInPlace(entry.patch, model)
+            self.assertNotIn(False, result)
+            self.assertEqual(model.text, expected)
@@ -0,0 +1,265 @@
+# coding=utf-8
+"""
+Тесты на синхронизацию view с моделью текста (main) на поддельном view
+"""
+import sys
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from test import fakes
+
+fakes.install()
+
+from core import text
+from libs.dmp.diff_match_patch import diff_match_patch
+from test.test_outbound import FakeCoordinatorProtocol
+import init
+import main
+import misc
+
+__author__ = 'snowy'
+
+SMILE = u'\ud83d\ude00'
+"""Символ вне BMP так, как его хранит узкая сборка python: суррогатная пара"""
+
+
+def narrow_build(test):
+    """
+    Вести себя как узкая сборка python до конца теста: позиции строк - единицы UTF-16
+    """
+    for module in (sys.modules[diff_match_patch.__module__], text, main, misc):
+        if hasattr(module, 'NARROW_BUILD'):
+            test.patch(module, 'NARROW_BUILD', True)
+
+
+class ViewTestCase(unittest.TestCase):
+    base = u''.join(u'line %d of the document\n' % i for i in xrange(100))
+
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.proto = FakeCoordinatorProtocol()
+
+    def share(self, text):
+        """
+        View с текстом text, совпадающим с моделью координатора ревизии 0
+        """
+        self.view = fakes.FakeView(text)
+        self.app = main.SublimeAwareApplication(Clock(), self.view, name='test')
+        self.algorithm = self.app.algorithm
+        self.algorithm.currentText = text
+        self.algorithm.revision = 0
+        self.algorithm.clientProtocol = self.proto
+        self.app.tracker.reset(self.view.size(), misc.view_selection(self.view), self.view.change_count())
+        self.algorithm.view_access.mark_synced()
+
+    def type(self, begin, end, replacement):
+        """
+        Правка пользователя вместе с событиями редактора, которые получает трекер
+        """
+        self.app.tracker.selection_modified([(begin, end)])
+        self.view.type(begin, end, replacement)
+        self.app.tracker.modified(self.view.size(), misc.view_selection(self.view), self.view.change_count())
+
+    def assertSent(self, before, after):
+        arguments, _ = self.proto.requests[-1]
+        patched, results, _ = self.dmp.patch_apply(self.dmp.patch_fromText(arguments['patch']), before)
+        self.assertNotIn(False, results)
+        self.assertEqual(patched, after)
+
+
+class SyncChangesTest(ViewTestCase):
+    def test_region_change_is_synced(self):
+        self.share(self.base)
+        self.type(30, 34, u'LINE')
+        self.type(34, 34, u'!')
+        main.sync_changes(self.app)
+        self.assertEqual(self.algorithm.currentText, self.view.text)
+        self.assertSent(self.base, self.view.text)
+
+    def test_region_after_astral_characters(self):
+        narrow_build(self)
+        base = self.base.replace(u'of the', SMILE + u' of the')
+        self.share(base)
+        self.assertTrue(self.view.size() < len(base))
+        # позиции view - в символах: перед правкой больше десятка суррогатных пар
+        position = self.view.text.index(u'line 50')
+        offset = len(fakes.characters(self.view.text[:position]))
+        self.type(offset, offset + 4, u'LINE')
+        main.sync_changes(self.app)
+        # патч не проверяется через patch_toText: на широкой сборке utf-8 склеивает половинки пары в один символ
+        self.assertEqual(self.algorithm.currentText, base.replace(u'line 50', u'LINE 50'))
+        self.assertTrue(self.algorithm.check_view())
+
+    def test_edit_outside_of_selection_is_synced_in_full(self):
+        self.share(self.base)
+        cursor = self.base.index(u'line 50')
+        self.app.tracker.selection_modified([(cursor, cursor)])
+        # плагин вставляет текст выше курсора, курсор сдвигается вместе с текстом
+        edit = self.view.begin_edit()
+        self.view.insert(edit, 10, u'plugin text')
+        self.view.end_edit(edit)
+        self.view.selection = [(cursor + 11, cursor + 11)]
+        self.app.tracker.modified(self.view.size(), misc.view_selection(self.view), self.view.change_count())
+        main.sync_changes(self.app)
+        self.assertEqual(self.algorithm.currentText, self.view.text)
+        self.assertSent(self.base, self.view.text)
+
+
+class ResyncTest(ViewTestCase):
+    def assertSynced(self, text):
+        self.assertEqual(self.view.text, text)
+        self.assertFalse(self.app.tracker.suspended)
+        self.assertTrue(self.algorithm.view_access.unchanged_since_sync())
+
+    def test_identical_text_is_not_edited(self):
+        self.share(self.base)
+        self.algorithm.on_resynced(self.base)
+        self.assertEqual(self.view.edits, [])
+        self.assertSynced(self.base)
+
+    def test_only_changed_middle_is_replaced(self):
+        self.share(self.base)
+        text = self.base.replace(u'line 50 of', u'LINE 50 (remote) of')
+        self.algorithm.on_resynced(text)
+        start = self.base.index(u'line 50 of')
+        self.assertEqual(self.view.edits, [('replace', start, start + len(u'line 50'))])
+        self.assertSynced(text)
+
+    def test_different_text_is_replaced_in_full(self):
+        self.share(self.base)
+        self.algorithm.on_resynced(u'another text')
+        self.assertEqual(self.view.edits, [('replace', 0, len(self.base))])
+        self.assertSynced(u'another text')
+
+    def test_local_edit_is_overwritten(self):
+        self.share(self.base)
+        self.type(0, 4, u'LINE')
+        self.algorithm.on_resynced(self.base)
+        self.assertEqual(self.view.edits[-1], ('replace', 0, 4))
+        self.assertSynced(self.base)
+        # координаты правки после замены текста недостоверны: трекер просит полный дифф, но view уже совпадает
+        # с моделью, и дифф не считается
+        self.assertTrue(self.app.tracker.full)
+        self.assertIs(main.sync_changes(self.app), main.ApplyPatchCommand.no_work_is_done_response)
+        self.assertEqual(self.proto.requests, [])
+
+    def test_astral_characters_are_counted_as_one_view_character(self):
+        narrow_build(self)
+        base = self.base.replace(u'of the', SMILE + u' of the')
+        self.share(base)
+        text = base.replace(u'line 50 ', u'LINE 50 (remote) ')
+        self.algorithm.on_resynced(text)
+        start = len(fakes.characters(base[:base.index(u'line 50 ')]))
+        self.assertEqual(self.view.edits, [('replace', start, start + len(u'line 50'))])
+        self.assertSynced(text)
+
+    def test_surrogate_pair_is_not_split(self):
+        narrow_build(self)
+        # символы вне BMP с общей первой половиной суррогатной пары
+        self.share(u'a' + SMILE + u'b')
+        self.algorithm.on_resynced(u'a\ud83d\ude01b')
+        self.assertEqual(self.view.edits, [('replace', 1, 2)])
+        self.assertSynced(u'a\ud83d\ude01b')
+
+
+class CheckViewTest(ViewTestCase):
+    def test_astral_characters_are_counted_as_one_view_character(self):
+        narrow_build(self)
+        self.share(self.base.replace(u'of the', SMILE + u' of the'))
+        self.assertTrue(self.algorithm.check_view())
+
+    def test_different_sizes_are_reported(self):
+        self.share(self.base)
+        self.view.type(0, 0, u'typed')
+        self.assertFalse(self.algorithm.check_view())
+
+
+class ProcessSublimeCommandTest(ViewTestCase):
+    def process(self, command):
+        edit = self.view.begin_edit()
+        try:
+            self.algorithm.process_sublime_command(edit, command)
+        finally:
+            self.view.end_edit(edit)
+
+    def test_commands_are_applied_to_view(self):
+        self.share(u'a' + SMILE + u'bcd')
+        self.process(('insert', 2, 2, u'xy'))
+        self.assertEqual(self.view.text, u'a' + SMILE + u'xybcd')
+        self.process(('insert', 0, 2, u'A'))
+        self.assertEqual(self.view.text, u'Axybcd')
+        self.process(('erase', 1, 3))
+        self.assertEqual(self.view.text, u'Abcd')
+        self.assertEqual([method for method, _, _ in self.view.edits], ['insert', 'replace', 'erase'])
+
+    def test_unknown_command_is_rejected(self):
+        self.share(self.base)
+        self.assertRaises(main.NotThatTypeOfCommandError, self.process, ('move', 0, 1))
+        self.assertEqual(self.view.edits, [])
+
+
+class RemotePatchTest(ViewTestCase):
+    def apply_remote(self, text):
+        patch = self.dmp.patch_make(self.algorithm.currentText, text)
+        self.algorithm.remote_applyBinaryPatch(patch, 1.0, self.algorithm.revision + 1)
+
+    def test_large_patch_is_collapsed_into_one_edit(self):
+        remote = self.base.replace(u'line 1', u'LINE 1')
+        for ratio, edits in ((1.0, 11), (0.01, 1)):
+            self.patch(main, 'BULK_REPLACE_RATIO', ratio)
+            self.share(self.base)
+            self.apply_remote(remote)
+            self.assertEqual(len(self.view.edits), edits)
+            self.assertEqual(self.view.text, remote)
+            self.assertEqual(self.algorithm.currentText, remote)
+            self.assertTrue(self.algorithm.view_access.unchanged_since_sync())
+
+    def test_remote_edits_are_not_tracked_as_local(self):
+        self.share(self.base)
+        self.apply_remote(self.base.replace(u'line 50 of', u'LINE 50 of'))
+        self.assertFalse(self.app.tracker.suspended)
+        self.assertFalse(self.app.tracker.poll(self.view.change_count()))
+        # правка пользователя после патча отслеживается в координатах нового текста
+        before = self.view.text
+        self.type(0, 4, u'LINE')
+        main.sync_changes(self.app)
+        self.assertEqual(self.algorithm.currentText, self.view.text)
+        self.assertSent(before, self.view.text)
+
+    def test_full_sync_of_synced_view_is_skipped(self):
+        self.share(self.base)
+        self.apply_remote(self.base.replace(u'line 50 of', u'LINE 50 of'))
+        self.patch(self.algorithm, 'local_onTextChanged', lambda text: self.fail('full diff is not needed'))
+        self.app.tracker.full = True
+        self.assertIs(main.sync_changes(self.app), main.ApplyPatchCommand.no_work_is_done_response)
+        self.assertEqual(self.proto.requests, [])
+
+    def test_view_changed_without_events_is_synced_in_full(self):
+        self.share(self.base)
+        edit = self.view.begin_edit()
+        self.view.insert(edit, 10, u'macro text')
+        self.view.end_edit(edit)
+        self.assertTrue(self.app.tracker.poll(self.view.change_count()))
+        main.sync_changes(self.app)
+        self.assertEqual(self.algorithm.currentText, self.view.text)
+        self.assertSent(self.base, self.view.text)
+
+
+class SyncViewTest(ViewTestCase):
+    def setUp(self):
+        super(SyncViewTest, self).setUp()
+        self.share(self.base)
+        self.patch(init, 'registry', {self.view.id(): init.RegistryEntry(self.app, None)})
+        self.sync = main.sync_view(self.view.id())
+
+    def test_unchanged_view_is_not_read(self):
+        self.patch(self.view, 'substr', lambda region: self.fail('view is read'))
+        self.assertFalse(self.sync())
+        self.assertEqual(self.proto.requests, [])
+
+    def test_changed_view_is_synced(self):
+        self.type(0, 4, u'LINE')
+        self.assertTrue(self.sync())
+        self.assertSent(self.base, self.view.text)
+        self.assertFalse(self.sync())
@@ -0,0 +1,63 @@
+# coding=utf-8
+"""
+Тесты на журнал операций координатора и перенос патчей
+"""
+from twisted.trial import unittest
+
+from core.oplog import OperationLog, rebase
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+
+class OperationLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.dmp.Match_Threshold = 0.0
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(50))
+
+    def test_revisions_are_monotonic(self):
+        log = OperationLog(max_operations=2)
+        self.assertEqual([log.append('a', []), log.append('b', []), log.append('a', [])], [1, 2, 3])
+        self.assertEqual([operation.revision for operation in log.since(1)], [2, 3])
+        self.assertEqual(log.since(3), [])
+        # операция 1 уже вытеснена
+        self.assertIsNone(log.since(0))
+
+    def test_concurrent_patches_are_rebased(self):
+        log = OperationLog()
+        first = self.base.replace(u'line 5 of', u'LINE FIVE of')
+        second = self.base.replace(u'line 40 of', u'line forty of')
+        log.append('a', self.dmp.patch_make(self.base, first))
+        text, results, commands = self.dmp.patch_apply(self.dmp.patch_make(self.base, second), first)
+        self.assertIn(False, results)
+
+        patches = rebase(self.dmp.patch_make(self.base, second), log.since(0))
+        text, results, commands = self.dmp.patch_apply(patches, first)
+        self.assertNotIn(False, results)
+        self.assertEqual(text, first.replace(u'line 40 of', u'line forty of'))
+
+    def test_conflicting_patch_is_not_applicable(self):
+        log = OperationLog()
+        first = self.base.replace(u'line 5 of', u'line five of')
+        second = self.base.replace(u'line 5 of', u'LINE FIVE of')
+        log.append('a', self.dmp.patch_make(self.base, first))
+        patches = rebase(self.dmp.patch_make(self.base, second), log.since(0))
+        text, results, commands = self.dmp.patch_apply(patches, first)
+        self.assertIn(False, results)
+
+    def test_patches_of_several_hunks_are_rebased(self):
+        log = OperationLog()
+        # удаление блока строк и вставка ниже: позиция второго куска - в тексте уже без блока
+        first = self.base.replace(u''.join(u'line %d of the document\n' % i for i in xrange(5, 15)), u'')
+        first = first.replace(u'line 40 of', u'line 40 (moved here) of')
+        log.append('a', self.dmp.patch_make(self.base, first))
+        # правка между позицией вставки в тексте без блока и ее позицией в исходном тексте
+        second = self.base.replace(u'line 2 of', u'line two of').replace(u'line 32 of', u'line thirty two of')
+        self.assertEqual(len(self.dmp.patch_make(self.base, second)), 2)
+
+        patches = rebase(self.dmp.patch_make(self.base, second), log.since(0))
+        text, results, commands = self.dmp.patch_apply(patches, first)
+        self.assertNotIn(False, results)
+        self.assertEqual(text, first.replace(u'line 2 of', u'line two of').replace(u'line 32 of',
+                                                                                   u'line thirty two of'))
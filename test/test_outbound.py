@@ -0,0 +1,190 @@
+# coding=utf-8
+"""
+Тесты на пачки локальных патчей
+"""
+from random import Random
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from core.core import DiffMatchPatchAlgorithm
+from core.inverse import InversePatch
+from history import HistoryLine
+from libs.dmp import diff_task
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+
+class FakeCoordinatorProtocol(object):
+    def __init__(self):
+        self.requests = []
+
+    def callRemote(self, command, **arguments):
+        result = defer.Deferred()
+        self.requests.append((arguments, result))
+        return result
+
+    def answer(self, revision):
+        arguments, result = self.requests.pop(0)
+        result.callback({'succeed': True, 'revision': revision})
+        return arguments
+
+
+class OutboundBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.dmp.Match_Threshold = 0.0
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(200))
+        self.clock = Clock()
+        self.proto = FakeCoordinatorProtocol()
+        self.algorithm = DiffMatchPatchAlgorithm(HistoryLine(None), initialText=self.base,
+                                                 clientProtocol=self.proto)
+        self.algorithm.clock = self.clock
+        self.algorithm.revision = 0
+
+    def edit(self, old, new):
+        return self.algorithm.local_onTextChanged(self.algorithm.currentText.replace(old, new))
+
+    def assertPatchGives(self, arguments, text, expected):
+        patched, results, _ = self.dmp.patch_apply(self.dmp.patch_fromText(arguments['patch']), text)
+        self.assertNotIn(False, results)
+        self.assertEqual(patched, expected)
+
+    def test_edits_are_coalesced_while_requests_are_in_flight(self):
+        self.algorithm.max_in_flight = 1
+        first = self.edit(u'line 3 of', u'line three of')
+        self.assertEqual(len(self.proto.requests), 1)
+        after_first = self.algorithm.currentText
+        results = [self.edit(u'line 50 of', u'line fifty of'), self.edit(u'line 150 of', u'line 150 off'),
+                   self.edit(u'line 51 of', u'')]
+        self.assertEqual(len(self.proto.requests), 1)
+
+        self.proto.answer(1)
+        self.assertEqual(self.successResultOf(first), {'succeed': True, 'revision': 1})
+        # остальные правки ушли одним патчем
+        self.assertEqual(len(self.proto.requests), 1)
+        arguments = self.proto.answer(2)
+        self.assertEqual(arguments['base_revision'], 0)
+        self.assertPatchGives(arguments, after_first, self.algorithm.currentText)
+        for result in results:
+            self.assertEqual(self.successResultOf(result)['revision'], 2)
+        self.assertEqual(len(self.algorithm.pending_operations), 0)
+        self.assertEqual(self.algorithm.revision, 2)
+
+    def test_batch_is_sent_by_size_or_time(self):
+        self.edit(u'line 3 of', u'line three of')
+        self.edit(u'line 4 of', u'line four of')
+        # одна пачка ждет ответа, следующая копит патчи
+        self.assertEqual(len(self.proto.requests), 1)
+        self.clock.advance(self.algorithm.flush_delay)
+        self.assertEqual(len(self.proto.requests), 2)
+        # свободных мест нет
+        self.edit(u'line 5 of', u'line five of')
+        self.clock.advance(self.algorithm.flush_delay)
+        self.assertEqual(len(self.proto.requests), 2)
+
+        self.proto.answer(1)
+        self.assertEqual(len(self.proto.requests), 2)
+        self.edit(u'line 6 of', u'x' * self.algorithm.flush_size)
+        self.assertEqual(len(self.proto.requests), 2)
+        self.proto.answer(2)
+        self.edit(u'line 7 of', u'x' * self.algorithm.flush_size)
+        self.assertEqual(len(self.proto.requests), 2)
+
+    def test_remote_patch_closes_batch(self):
+        self.algorithm.max_in_flight = 1
+        self.edit(u'line 3 of', u'line three of')
+        self.edit(u'line 50 of', u'line fifty of')
+        before_remote = self.algorithm.currentText
+        # патч координатора сделан на тексте ревизии 0, без наших патчей
+        remote = self.dmp.patch_make(self.base, self.base.replace(u'line 100 of', u'line hundred of'))
+        self.algorithm.remote_applyPatchObjects(remote, 1.0, 1)
+        self.edit(u'line 150 of', u'line one fifty of')
+
+        self.proto.answer(2)
+        arguments = self.proto.answer(3)
+        # патч пачки сделан на тексте до патча координатора
+        self.assertEqual(arguments['base_revision'], 0)
+        self.assertPatchGives(arguments, self.base.replace(u'line 3 of', u'line three of'), before_remote)
+        arguments = self.proto.answer(4)
+        self.assertEqual(arguments['base_revision'], 1)
+        self.assertEqual(self.algorithm.currentText, self.base.replace(u'line 3 of', u'line three of')
+                         .replace(u'line 50 of', u'line fifty of').replace(u'line 100 of', u'line hundred of')
+                         .replace(u'line 150 of', u'line one fifty of'))
+
+    def test_multi_hunk_edits_are_coalesced(self):
+        self.algorithm.max_in_flight = 1
+        self.edit(u'line 3 of', u'line three of')
+        after_first = self.algorithm.currentText
+        # правка несколькими курсорами: патч из многих кусков, каждый укорачивает текст
+        self.algorithm.local_onTextChanged(self.algorithm.currentText.replace(u'0 of the document', u'0'))
+        # правка внутри области пачки не расширяет ее
+        self.edit(u'line 120\n', u'line 120 of 200\n')
+        self.proto.answer(1)
+        arguments = self.proto.answer(2)
+        self.assertPatchGives(arguments, after_first, self.algorithm.currentText)
+
+    def test_large_paste_is_diffed_within_time_budget(self):
+        self.algorithm.diff_timeout = 0.01
+        random = Random(1)
+        pasted = u''.join(random.choice(u'abcdef \n') for _ in xrange(50000))
+        before = self.algorithm.currentText
+        after = before[:1000] + pasted + before[2000:]
+        diff = diff_task(self.algorithm.dmp, before, after, timeout=self.algorithm.diff_timeout)
+        diff.step()
+        self.assertFalse(diff.optimal)
+        # бюджет превышается не больше чем на один шаг работы
+        self.assertApproximates(diff.used_seconds, self.algorithm.diff_timeout, 0.05)
+        patches = self.algorithm.make_patches(before, after)
+        # бюджет не распространяется на остальные диффы, например в patch_apply
+        self.assertEqual(self.algorithm.dmp.Diff_Timeout, diff_match_patch().Diff_Timeout)
+        for patch_objects, text, expected in ((patches, before, after), (InversePatch(patches), after, before)):
+            patched, results, _ = self.dmp.patch_apply(patch_objects, text)
+            self.assertNotIn(False, results)
+            self.assertEqual(patched, expected)
+
+
+class EditorAlgorithm(DiffMatchPatchAlgorithm):
+    """
+    Алгоритм с текстом редактора, который пользователь меняет независимо от модели
+    """
+    editor_text = None
+
+    def unsynced_local_text(self):
+        return self.editor_text if self.editor_text != self.currentText else None
+
+    def on_resynced(self, text):
+        self.editor_text = text
+
+
+class ResyncTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(200))
+        self.proto = FakeCoordinatorProtocol()
+        self.algorithm = EditorAlgorithm(HistoryLine(None), initialText=self.base, clientProtocol=self.proto)
+        self.algorithm.revision = 0
+        self.algorithm.editor_text = self.base
+
+    def test_edits_made_during_resync_are_kept(self):
+        self.algorithm.resync()
+        arguments, download = self.proto.requests.pop(0)
+        self.assertEqual(self.proto.requests, [])
+        # пользователь печатает, пока загружается текст координатора
+        self.algorithm.editor_text = self.base.replace(u'line 3 of', u'line three of')
+        coordinator_text = self.base.replace(u'line 100 of', u'line hundred of')
+        download.callback({'transfer_id': u'resync', 'chunk': coordinator_text, 'length': len(coordinator_text),
+                           'revision': 5})
+
+        expected = coordinator_text.replace(u'line 3 of', u'line three of')
+        self.assertEqual(self.algorithm.editor_text, expected)
+        self.assertEqual(self.algorithm.currentText, expected)
+        # правки отправлены координатору патчем к его тексту
+        arguments = self.proto.answer(6)
+        self.assertEqual(arguments['base_revision'], 5)
+        patched, results, _ = self.dmp.patch_apply(self.dmp.patch_fromText(arguments['patch']), coordinator_text)
+        self.assertNotIn(False, results)
+        self.assertEqual(patched, expected)
+        self.assertEqual(self.algorithm.revision, 6)
@@ -0,0 +1,154 @@
+# coding=utf-8
+"""
+Тесты на поиск точки истории для конфликтного патча
+"""
+import random
+
+from twisted.trial import unittest
+
+from core.core import DiffMatchPatchAlgorithm
+from history import HistoryLine, HistoryEntry, RetentionPolicy, RecoveryFailedException, RecoveryBudget, \
+    RecoveryBudgetExceededException
+from libs.dmp.diff_match_patch import diff_match_patch
+from recovery import compose, locate
+from core.oplog import patch_changes
+from core.text import RopeText
+
+__author__ = 'snowy'
+
+
+class ComposeTest(unittest.TestCase):
+    def test_untouched_pieces_are_located(self):
+        rnd = random.Random(31337)
+        dmp = diff_match_patch()
+        texts = [u''.join(rnd.choice(u'abcdef \n') for _ in xrange(400))]
+        for _ in xrange(15):
+            text = texts[-1]
+            start = rnd.randint(0, len(text))
+            end = min(len(text), start + rnd.randint(0, 15))
+            texts.append(text[:start] + u'x' * rnd.randint(0, 15) + text[end:])
+        current = texts[-1]
+        changes = []
+        for depth in xrange(1, len(texts)):
+            older = texts[-1 - depth]
+            changes = compose(patch_changes(dmp.patch_make(older, texts[-depth])), changes)
+            for _ in xrange(50):
+                start = rnd.randint(0, len(older) - 10)
+                position = locate(changes, start, 10)
+                if position is not None:
+                    self.assertEqual(current[position:position + 10], older[start:start + 10])
+
+
+    def test_pieces_untouched_by_multi_hunk_commits_are_located(self):
+        rnd = random.Random(4242)
+        dmp = diff_match_patch()
+        texts = [u''.join(rnd.choice(u'abcdef \n') for _ in xrange(600))]
+        for _ in xrange(10):
+            text = texts[-1]
+            # несколько далеких правок: патч коммита из нескольких кусков, первый меняет длину текста
+            for start in sorted(rnd.sample(xrange(0, len(text) - 20), 3), reverse=True):
+                end = start + rnd.randint(0, 15)
+                text = text[:start] + u'x' * rnd.randint(0, 30) + text[end:]
+            texts.append(text)
+        current = texts[-1]
+        changes = []
+        located = 0
+        for depth in xrange(1, len(texts)):
+            older = texts[-1 - depth]
+            changes = compose(patch_changes(dmp.patch_make(older, texts[-depth])), changes)
+            for _ in xrange(50):
+                start = rnd.randint(0, len(older) - 10)
+                position = locate(changes, start, 10)
+                if position is not None:
+                    located += 1
+                    self.assertEqual(current[position:position + 10], older[start:start + 10])
+        self.assertTrue(located > 0)
+
+
+class TimeMachineRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(60))
+        self.algorithm = DiffMatchPatchAlgorithm(HistoryLine(None, RetentionPolicy()), initialText=self.base)
+        self.time_machine = self.algorithm.time_machine
+
+    def local_edit(self, old, new, timestamp):
+        text = self.algorithm.currentText
+        next_text = text.replace(old, new)
+        self.algorithm.history.commit_with_rollback(
+            HistoryEntry(self.dmp.patch_make(text, next_text), timestamp, True),
+            HistoryEntry(self.dmp.patch_make(next_text, text), timestamp, True))
+        self.algorithm.currentText = next_text
+
+    def test_only_conflicting_commits_are_rolled_back(self):
+        self.local_edit(u'line 3 of', u'line three of', 1)
+        self.local_edit(u'line 50 of', u'line fifty of', 2)
+        self.local_edit(u'line 51 of', u'line fifty one of', 3)
+        remote = self.base.replace(u'line 3 of', u'LINE 3 of')
+        patch = self.dmp.patch_make(self.base, remote)
+        rollforward, rollback, d1d3 = self.time_machine.start_recovery(patch, 4)
+        kept = remote.replace(u'line 50 of', u'line fifty of').replace(u'line 51 of', u'line fifty one of')
+        self.assertEqual(d1d3, kept)
+        self.assertEqual([entry.timestamp for entry in self.algorithm.history], [2, 3])
+        self.assertIn(u'fifty one', self.time_machine.model_text.text)
+        # сдвинутые коммиты по-прежнему откатываются строго
+        model = RopeText(d1d3)
+        for entry in reversed(self.algorithm.history.rollback_history):
+            result, _ = self.time_machine.strict_dmp.patch_applyInPlace(list(entry.patch), model)
+            self.assertNotIn(False, result)
+        self.assertEqual(model.text, remote)
+
+    def test_commit_overlapping_rolled_back_one_is_rolled_back_too(self):
+        self.local_edit(u'line 3 of', u'line three of', 1)
+        self.local_edit(u'three of the', u'three of a', 2)
+        self.local_edit(u'line 50 of', u'line fifty of', 3)
+        remote = self.base.replace(u'line 3 of', u'LINE 3 of')
+        patch = self.dmp.patch_make(self.base, remote)
+        rollforward, rollback, d1d3 = self.time_machine.start_recovery(patch, 4)
+        self.assertEqual(d1d3, remote.replace(u'line 50 of', u'line fifty of'))
+        self.assertEqual([entry.timestamp for entry in self.algorithm.history], [3])
+
+    def test_patch_is_rebased_without_rollback(self):
+        self.algorithm.revision = 1
+        self.local_edit(u'line 3 of', u'line three of', 1)
+        remote = self.base.replace(u'line 50 of', u'LINE 50 of')
+        patch = self.dmp.patch_make(self.base, remote)
+        rollforward, rollback, d1d3 = self.time_machine.start_recovery(patch, 2)
+        self.assertEqual(rollback, [])
+        self.assertEqual(d1d3, remote.replace(u'line 3 of', u'line three of'))
+        self.assertEqual(len(self.algorithm.history), 1)
+
+    def test_patch_without_fitting_point_fails(self):
+        self.local_edit(u'line 3 of', u'line three of', 1)
+        patch = self.dmp.patch_make(self.base, self.base.replace(u'line 3 of the', u'line 3 of a'))
+        patch[0].diffs[0] = (patch[0].diffs[0][0], u'unknown context')
+        self.assertRaises(RecoveryFailedException, self.time_machine.start_recovery, patch, 2)
+
+    def test_recovery_stops_when_budget_is_exceeded(self):
+        self.time_machine.budget = RecoveryBudget(milliseconds=None, commits=1)
+        self.local_edit(u'line 3 of', u'line three of', 1)
+        self.local_edit(u'line 50 of', u'line fifty of', 2)
+        self.local_edit(u'line 51 of', u'line fifty one of', 3)
+        remote = self.base.replace(u'line 3 of', u'LINE 3 of').replace(u'line 51 of', u'LINE 51 of')
+        patch = self.dmp.patch_make(self.base, remote)
+        self.assertRaises(RecoveryBudgetExceededException, self.time_machine.start_recovery, patch, 4)
+
+    def test_multi_hunk_patch_is_recovered(self):
+        self.local_edit(u'line 3 of', u'line three of', 1)
+        self.local_edit(u'line 50 of', u'line fifty of', 2)
+        # первый кусок меняет длину текста, поэтому позиция второго - в тексте с первым куском
+        remote = self.base.replace(u'line 3 of', u'LINE 3 (remote) of').replace(u'line 40 of', u'LINE 40 of')
+        patch = self.dmp.patch_make(self.base, remote)
+        self.assertEqual(len(patch), 2)
+        rollforward, rollback, d1d3 = self.time_machine.start_recovery(patch, 3)
+        self.assertEqual(d1d3, remote.replace(u'line 50 of', u'line fifty of'))
+        self.assertEqual(len(self.algorithm.history), 1)
+
+    def test_multi_hunk_patch_is_rebased_without_rollback(self):
+        self.algorithm.revision = 1
+        self.local_edit(u'line 3 of', u'line three of', 1)
+        remote = self.base.replace(u'line 10 of', u'LINE 10 (remote) of').replace(u'line 40 of', u'LINE 40 of')
+        patch = self.dmp.patch_make(self.base, remote)
+        rollforward, rollback, d1d3 = self.time_machine.start_recovery(patch, 2)
+        self.assertEqual(rollback, [])
+        self.assertEqual(d1d3, remote.replace(u'line 3 of', u'line three of'))
@@ -0,0 +1,100 @@
+# coding=utf-8
+"""
+Тесты на планировщик синхронизации view
+"""
+from twisted.internet import task
+from twisted.trial import unittest
+
+from scheduler import SyncScheduler, PENDING
+
+__author__ = 'snowy'
+
+
+class FakeView(object):
+    def __init__(self, clock, cost=0.0):
+        self.clock = clock
+        self.cost = cost
+        self.result = False
+        self.calls = []
+
+    def sync(self):
+        self.calls.append(self.clock.seconds())
+        self.clock.busy += self.cost
+        return self.result
+
+
+class SyncSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.busy = 0.0
+        # интервалы - степени двойки, чтобы время часов складывалось без ошибок округления
+        self.scheduler = SyncScheduler(self.clock, min_interval=0.0625, max_interval=1.0, backoff=2.0, budget=0.1,
+                                       timer=lambda: self.clock.busy)
+
+    def add(self, view_id, cost=0.0):
+        view = FakeView(self.clock, cost)
+        self.scheduler.add(view_id, view.sync)
+        return view
+
+    def tick(self, count=1):
+        for _ in xrange(count):
+            call, = self.clock.getDelayedCalls()
+            self.clock.advance(call.getTime() - self.clock.seconds())
+
+    def test_idle_view_backs_off(self):
+        view = self.add(1)
+        self.tick(10)
+        intervals = [b - a for a, b in zip(view.calls, view.calls[1:])]
+        self.assertEqual(intervals[:4], [0.125, 0.25, 0.5, 1.0])
+        self.assertEqual(set(intervals[3:]), {1.0})
+
+    def test_edit_wakes_idle_view(self):
+        view = self.add(1)
+        self.tick(10)
+        self.clock.advance(0.5)
+        view.result = True
+        self.scheduler.wake(1)
+        woken = self.clock.seconds()
+        self.tick()
+        self.assertEqual(view.calls[-1], woken + 0.0625)
+        stats = self.scheduler.latency(1)
+        self.assertEqual((stats.count, stats.last), (1, 0.0625))
+
+    def test_active_view_is_polled_often(self):
+        view = self.add(1)
+        view.result = PENDING
+        self.tick(17)
+        self.assertEqual(view.calls[-1], 1.0)
+        self.assertEqual(self.scheduler.latency(1).count, 0)
+        view.result = True
+        self.tick()
+        # задержка считается от первого опроса, заметившего изменения
+        self.assertEqual(self.scheduler.latency(1).last, 1.0625)
+
+    def test_budget_is_shared_between_views(self):
+        views = [self.add(view_id, cost=0.06) for view_id in xrange(4)]
+        self.tick()
+        self.assertEqual([len(view.calls) for view in views], [1, 1, 0, 0])
+        self.tick()
+        self.assertEqual(self.clock.seconds(), 0.0625)
+        # отложенные view идут первыми
+        self.assertEqual([len(view.calls) for view in views], [1, 1, 1, 1])
+
+    def test_removed_view_is_not_polled(self):
+        view = self.add(1)
+        self.tick()
+        self.scheduler.remove(1)
+        self.clock.pump([1.0] * 5)
+        self.assertEqual(len(view.calls), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failed_sync_does_not_stop_scheduler(self):
+        calls = []
+
+        def sync():
+            calls.append(self.clock.seconds())
+            raise ValueError()
+
+        self.scheduler.add(1, sync)
+        self.tick(3)
+        self.assertEqual(len(calls), 3)
@@ -0,0 +1,95 @@
+# coding=utf-8
+"""
+Тесты на модели текста
+"""
+import random
+import sys
+
+from twisted.trial import unittest
+
+from core import text as text_module
+from core.text import RopeText, FlatText, checksum
+from libs.dmp.diff_match_patch import diff_match_patch
+
+__author__ = 'snowy'
+
+
+class RopeTextTest(unittest.TestCase):
+    def setUp(self):
+        self.chunk_size = RopeText.CHUNK_SIZE
+        RopeText.CHUNK_SIZE = 8
+        self.random = random.Random(13256)
+
+    def tearDown(self):
+        RopeText.CHUNK_SIZE = self.chunk_size
+
+    def random_text(self, length):
+        return u''.join(self.random.choice(u'abc \nгде') for _ in xrange(length))
+
+    def test_random_edits(self):
+        text = self.random_text(100)
+        rope = RopeText(text)
+        for _ in xrange(500):
+            start = self.random.randint(0, len(text))
+            end = self.random.randint(start, min(len(text), start + 20))
+            data = self.random_text(self.random.randint(0, 20))
+            text = text[:start] + data + text[end:]
+            rope.replace(start, end, data)
+            self.assertEqual(len(rope), len(text))
+            a = self.random.randint(0, len(text))
+            b = self.random.randint(a, len(text))
+            self.assertEqual(rope.slice(a, b), text[a:b])
+        self.assertEqual(rope.text, text)
+
+    def test_copy_is_independent(self):
+        rope = RopeText(u'Hamlet: Do you see yonder cloud?')
+        copy = rope.copy()
+        copy.replace(0, 6, u'Гамлет')
+        self.assertEqual(rope.text, u'Hamlet: Do you see yonder cloud?')
+        self.assertEqual(copy.text, u'Гамлет: Do you see yonder cloud?')
+
+    def test_patch_apply_in_place(self):
+        dmp = diff_match_patch()
+        text1 = self.random_text(300)
+        text2 = text1[:50] + u'вставка' + text1[60:200] + text1[230:]
+        patches = dmp.patch_make(text1, text2)
+        for model in (RopeText(text1), FlatText(text1)):
+            results, _ = dmp.patch_applyInPlace(patches, model)
+            self.assertNotIn(False, results)
+            self.assertEqual(model.text, text2)
+
+    def test_checksum_does_not_depend_on_chunks(self):
+        text = self.random_text(300)
+        rope = RopeText(text)
+        rope.replace(10, 20, self.random_text(30))
+        text = rope.text
+        expected = checksum([text])
+        self.assertEqual(rope.checksum(), expected)
+        self.assertEqual(FlatText(text).checksum(), expected)
+        self.assertEqual(checksum([text[:7], u'', text[7:100], text[100:]]), expected)
+        self.assertNotEqual(checksum([text + u' ']), expected)
+
+    def test_code_point_positions(self):
+        # узкая сборка python: символ вне BMP - суррогатная пара, sublime считает его одним символом
+        for module in (sys.modules[diff_match_patch.__module__], text_module):
+            self.patch(module, 'NARROW_BUILD', True)
+        smile = u'\ud83d\ude00'
+        text = u''.join(self.random.choice([u'a', u'б', u'\n', smile]) for _ in xrange(60))
+        rope = RopeText(text)
+        for _ in xrange(100):
+            start = self.random.randint(0, len(text))
+            if diff_match_patch.isLowSurrogate(text[start:start + 1]):
+                start -= 1
+            end = min(len(text), start + self.random.randint(0, 4))
+            if diff_match_patch.isLowSurrogate(text[end:end + 1]):
+                end += 1
+            data = self.random.choice([u'', u'x', smile, smile + u'y'])
+            text = text[:start] + data + text[end:]
+            rope.replace(start, end, data)
+        # позиция строки -> символы и обратно; позиции внутри пары не бывает
+        positions = [pos for pos in xrange(len(text) + 1) if not diff_match_patch.isLowSurrogate(text[pos:pos + 1])]
+        for model in (rope, FlatText(text)):
+            for code_points, pos in enumerate(positions):
+                self.assertEqual(model.code_points(pos), code_points)
+                self.assertEqual(model.position(code_points), pos)
+
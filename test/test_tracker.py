@@ -0,0 +1,77 @@
+# coding=utf-8
+"""
+Тесты на вычисление области изменений ChangeTracker'ом
+"""
+from twisted.trial import unittest
+
+from tracker import ChangeTracker, FULL
+
+__author__ = 'snowy'
+
+
+class ChangeTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.text = u'Hamlet: Do you see yonder cloud?'
+        self.tracker = ChangeTracker(len(self.text), [(5, 5)])
+
+    def edit(self, start, end, replacement, cursor):
+        self.tracker.selection_modified([(start, end)])
+        self.text = self.text[:start] + replacement + self.text[end:]
+        self.tracker.modified(len(self.text), [(cursor, cursor)])
+
+    def assertCovers(self, model):
+        start, end, new_end = self.tracker.consume()
+        self.assertEqual(model[:start] + self.text[start:new_end] + model[end:], self.text)
+
+    def test_typing(self):
+        model = self.text
+        self.edit(7, 7, u'!', 8)
+        self.edit(8, 8, u'!', 9)
+        self.assertCovers(model)
+
+    def test_backspace_and_delete(self):
+        model = self.text
+        self.edit(10, 11, u'', 10)
+        self.edit(20, 21, u'', 20)
+        self.assertCovers(model)
+
+    def test_paste_over_selection(self):
+        model = self.text
+        self.edit(3, 12, u'очень длинная вставка', 3 + len(u'очень длинная вставка'))
+        self.assertCovers(model)
+
+    def test_nothing_changed(self):
+        self.assertIsNone(self.tracker.consume())
+
+    def test_multiple_cursors_fall_back_to_full(self):
+        self.tracker.modified(len(self.text) + 2, [(1, 1), (9, 9)])
+        self.assertEqual(self.tracker.consume(), FULL)
+
+    def test_pending_changes_are_full_after_resume(self):
+        self.edit(7, 7, u'!', 8)
+        self.tracker.suspend()
+        self.tracker.modified(0, [(0, 0)])
+        self.tracker.resume(len(self.text), [(8, 8)])
+        self.assertEqual(self.tracker.consume(), FULL)
+        self.assertIsNone(self.tracker.consume())
+
+    def test_poll_of_unchanged_view(self):
+        self.tracker.reset(len(self.text), [(5, 5)], change_count=3)
+        self.assertFalse(self.tracker.poll(3))
+        self.tracker.modified(len(self.text) + 1, [(6, 6)], change_count=4)
+        self.assertTrue(self.tracker.poll(4))
+        self.tracker.consume()
+        self.assertFalse(self.tracker.poll(4))
+
+    def test_poll_of_edit_without_event_is_full(self):
+        self.tracker.reset(len(self.text), [(5, 5)], change_count=3)
+        self.assertTrue(self.tracker.poll(5))
+        self.assertEqual(self.tracker.consume(), FULL)
+        self.assertFalse(self.tracker.poll(5))
+
+    def test_poll_ignores_external_edits(self):
+        self.tracker.reset(len(self.text), [(5, 5)], change_count=3)
+        self.tracker.suspend()
+        self.assertFalse(self.tracker.poll(4))
+        self.tracker.resume(len(self.text) + 10, [(5, 5)], change_count=4)
+        self.assertFalse(self.tracker.poll(4))
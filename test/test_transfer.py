@@ -0,0 +1,27 @@
+# coding=utf-8
+"""
+Тесты на передачу текста по частям
+"""
+from twisted.protocols.amp import MAX_VALUE_LENGTH
+from twisted.trial import unittest
+
+from core.core import DiffMatchPatchAlgorithm
+from history import HistoryLine
+
+__author__ = 'snowy'
+
+
+class TextChunkTest(unittest.TestCase):
+    def test_chunks_of_astral_text_fit_amp_value(self):
+        # символ вне BMP - 4 байта UTF-8
+        text = u'\U0001f600' * 40000
+        algorithm = DiffMatchPatchAlgorithm(HistoryLine(None), initialText=text)
+        transfer_id, offset, chunks = None, 0, []
+        while offset < len(text):
+            response = algorithm.remote_getTextChunk(transfer_id, offset)
+            transfer_id, chunk = response['transfer_id'], response['chunk']
+            self.assertTrue(len(chunk.encode('utf-8')) <= MAX_VALUE_LENGTH)
+            chunks.append(chunk)
+            offset += len(chunk)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(u''.join(chunks), text)
@@ -0,0 +1,195 @@
+# coding=utf-8
+"""
+Тесты на выполнение диффов и патчей вне потока реактора
+"""
+from twisted.internet import defer, reactor
+from twisted.internet.task import Clock, Cooperator
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from core import workers
+from core.core import CoordinatorApplication, DiffMatchPatchAlgorithm, MultipleConnectionServerFactory
+from core.exceptions import JobFailedException, PatchIsNotApplicableException
+from core.workers import Executor, apply_patches_job, dmp_settings, make_patches_job
+from history import HistoryLine
+from libs.dmp.diff_match_patch import diff_match_patch, diff_task
+from test.test_outbound import FakeCoordinatorProtocol
+
+__author__ = 'snowy'
+
+
+class ManualExecutor(Executor):
+    """
+    Работы выполняются только по команде теста
+    """
+
+    def __init__(self):
+        super(ManualExecutor, self).__init__(None)
+        self.inline_size = 1000
+        self.jobs = []
+
+    def run(self, size, function, *args):
+        if size < self.inline_size:
+            return super(ManualExecutor, self).run(size, function, *args)
+        result = defer.Deferred()
+        self.jobs.append((result, function, args))
+        return result
+
+    def finish(self):
+        result, function, args = self.jobs.pop(0)
+        result.callback(function(*args))
+
+
+class ExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.executor = Executor(reactor, processes=1)
+
+    def test_work_of_a_key_waits_for_previous_work(self):
+        calls = []
+        first = defer.Deferred()
+        self.executor.serialize('a', lambda: first)
+        second = self.executor.serialize('a', calls.append, 'a')
+        other = self.executor.serialize('b', calls.append, 'b')
+        self.assertEqual(calls, ['b'])
+        self.successResultOf(other)
+        self.assertTrue(self.executor.busy('a'))
+        self.assertFalse(self.executor.busy('b'))
+        self.assertTrue(self.executor.offloads('a', 0))
+
+        first.callback(None)
+        self.assertEqual(calls, ['b', 'a'])
+        self.successResultOf(second)
+        self.assertFalse(self.executor.busy('a'))
+
+    def test_small_work_is_done_inline(self):
+        before, after = u'some text', u'some other text'
+        patches, optimal = self.successResultOf(
+            self.executor.run(len(before), make_patches_job, dmp_settings(self.dmp), before, after, 0))
+        self.assertTrue(optimal)
+        self.assertEqual(self.dmp.patch_apply(patches, before)[0], after)
+
+    def test_large_work_is_done_in_process(self):
+        self.executor.inline_size = 0
+        before = u''.join(u'line %d\n' % i for i in xrange(1000))
+        after = before.replace(u'line 500', u'LINE 500')
+        patches = self.dmp.patch_make(before, after)
+
+        def _applied(result):
+            patched, results, backward = result
+            self.assertEqual(patched, after)
+            self.assertEqual(results, [True])
+            self.assertEqual(self.dmp.patch_apply(backward, after)[0], before)
+
+        return self.executor.run(1, apply_patches_job, dmp_settings(self.dmp), patches, before).addCallback(_applied)
+
+    def test_failed_job_is_reported(self):
+        self.executor.inline_size = 0
+        # патч без текста падает в процессе пула
+        patches = self.dmp.patch_make(u'some text', u'some other text')
+        return self.assertFailure(self.executor.run(1, apply_patches_job, dmp_settings(self.dmp), patches, None),
+                                  JobFailedException)
+
+    def test_unpicklable_job_is_reported(self):
+        self.executor.inline_size = 0
+        return self.assertFailure(self.executor.run(1, lambda: None), JobFailedException)
+
+    def test_pool_is_not_started_inside_editor(self):
+        self.patch(workers, '_pool', None)
+        self.patch(workers, '_pool_available', True)
+        self.patch(workers.sys, 'executable', '/opt/sublime_text/plugin_host')
+        clock = Clock()
+        self.executor = Executor(clock)
+        self.executor.inline_size = 0
+        before = u''.join(u'line %d of the document\n' % i for i in xrange(2000))
+        after = before.replace(u'line 1000 of', u'LINE 1000 (pasted) of')
+        # по одному срезу на итерацию реактора
+        self.executor.cooperator = Cooperator(terminationPredicateFactory=lambda: lambda: True,
+                                              scheduler=lambda work: clock.callLater(1, work))
+        self.patch(diff_task, 'slice_seconds', 0)
+        # дифф считается срезами в потоке реактора: между срезами реактор обрабатывает остальные события
+        result = self.executor.run(1, make_patches_job, dmp_settings(self.dmp), before, after, 0)
+        iterations = 0
+        while not result.called:
+            clock.advance(1)
+            iterations += 1
+        self.assertTrue(iterations > 1)
+        patches, optimal = self.successResultOf(result)
+        self.assertTrue(optimal)
+        expected, _ = make_patches_job(dmp_settings(self.dmp), before, after, 0)
+        self.assertEqual(self.dmp.patch_toText(patches), self.dmp.patch_toText(expected))
+        self.assertIsNone(workers.get_pool())
+
+
+class CoordinatorOffloadTest(unittest.TestCase):
+    def setUp(self):
+        self.dmp = diff_match_patch()
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(100))
+        self.coordinator = CoordinatorApplication(Clock(), initial_text=self.base)
+        self.algorithm = self.coordinator.locator
+        self.executor = self.algorithm.executor = ManualExecutor()
+        self.factory = MultipleConnectionServerFactory(self.coordinator.documents)
+        self.writer, self.other = self.connect(), self.connect()
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        self.successResultOf(proto.locator.get_text(None))
+        return proto
+
+    def edit(self, proto, old, new, base_revision=0):
+        patch = self.dmp.patch_make(self.base, self.base.replace(old, new))
+        return proto.locator.try_apply_patch(self.dmp.patch_toText(patch), 1.0, base_revision, None)
+
+    def test_document_patches_wait_for_offloaded_patch(self):
+        large = self.edit(self.writer, u'line 10 of', u'x' * 2000)
+        small = self.edit(self.other, u'line 90 of', u'LINE 90 of')
+        self.assertNoResult(large)
+        self.assertNoResult(small)
+        self.assertEqual(self.algorithm.currentText, self.base)
+        self.assertEqual(len(self.executor.jobs), 1)
+
+        self.executor.finish()
+        self.assertEqual(self.successResultOf(large), {'succeed': True, 'revision': 1})
+        # маленький патч перенесен через большой и применен сразу
+        self.assertEqual(self.successResultOf(small), {'succeed': True, 'revision': 2})
+        self.assertEqual(self.algorithm.currentText,
+                         self.base.replace(u'line 10 of', u'x' * 2000).replace(u'line 90 of', u'LINE 90 of'))
+        self.assertFalse(self.executor.busy(self.algorithm))
+
+    def test_not_applicable_offloaded_patch_is_rejected(self):
+        patch = self.dmp.patch_make(u'another text', u'another text' + u'x' * 2000)
+        result = self.writer.locator.try_apply_patch(self.dmp.patch_toText(patch), 1.0, 0, None)
+        self.executor.finish()
+        self.failureResultOf(result, PatchIsNotApplicableException)
+        self.assertEqual(self.algorithm.currentText, self.base)
+        self.assertEqual(self.algorithm.revision, 0)
+
+
+class LocalOffloadTest(unittest.TestCase):
+    def setUp(self):
+        self.base = u''.join(u'line %d of the document\n' % i for i in xrange(100))
+        self.proto = FakeCoordinatorProtocol()
+        self.algorithm = DiffMatchPatchAlgorithm(HistoryLine(None), initialText=self.base, clientProtocol=self.proto)
+        self.algorithm.revision = 0
+        self.executor = self.algorithm.executor = ManualExecutor()
+
+    def test_local_changes_wait_for_offloaded_diff(self):
+        first_text = self.base.replace(u'line 10 of', u'line ten of')
+        first = self.algorithm.local_onTextChanged(first_text)
+        second_text = first_text.replace(u'line 20 of', u'line twenty of')
+        second = self.algorithm.local_onTextChanged(second_text)
+        self.assertEqual(self.algorithm.currentText, self.base)
+        self.assertEqual(self.proto.requests, [])
+
+        self.executor.finish()
+        self.assertEqual(self.algorithm.currentText, first_text)
+        # дифф второй правки считается уже от текста первой
+        self.assertEqual(self.executor.jobs[0][2][1], first_text)
+        self.executor.finish()
+        self.assertEqual(self.algorithm.currentText, second_text)
+        self.assertEqual(len(self.algorithm.pending_operations), 2)
+        self.proto.answer(1)
+        self.proto.answer(2)
+        self.assertEqual(self.successResultOf(first), {'succeed': True, 'revision': 1})
+        self.assertEqual(self.successResultOf(second), {'succeed': True, 'revision': 2})
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Отслеживание локальных изменений view по событиям редактора (on_modified / on_selection_modified).
+Вместо того чтобы раз в секунду сравнивать весь буфер с моделью, трекер накапливает одну "грязную" область,
+в пределах которой view отличается от модели текста. Синхронизация затем читает и диффает только эту область.
+Модуль не зависит от sublime: на вход подаются размеры буфера, выделения в виде пар (begin, end)
+и счетчик правок view.change_count().
+"""
+
+__author__ = 'snowy'
+
+FULL = 'full'
+"""Результат ChangeTracker.consume(), когда область изменений неизвестна и нужен полный дифф"""
+
+
+class ChangeTracker(object):
+    def __init__(self, size=0, selection=(), full_check_every=30, change_count=None):
+        """
+        Трекер изменений одного view.
+        :param size: int размер буфера, совпадающего с моделью текста
+        :param selection: list of (begin, end) выделение на момент синхронизации
+        :param full_check_every: int через сколько инкрементальных синхронизаций делать контрольный полный дифф
+        (страховка от правок, область которых не удалось вычислить по выделению). 0 - никогда
+        :param change_count: int view.change_count() на момент синхронизации (None - неизвестен)
+        """
+        self.full_check_every = full_check_every
+        self.size = size
+        self.selection = list(selection)
+        # счетчик правок view, до которого учтены все правки
+        self.change_count = change_count
+        # (lo, hi, delta): view[lo:hi] заменил model[lo:hi - delta], все остальное совпадает
+        self.dirty = None
+        self.full = False
+        self.suspended = False
+        self._captures = 0
+
+    def reset(self, size, selection=(), change_count=None):
+        """
+        Буфер снова совпадает с моделью (после синхронизации, первичной загрузки текста и т.п.)
+        :param size: int размер буфера
+        :param selection: list of (begin, end)
+        :param change_count: int view.change_count()
+        """
+        self.size = size
+        self.selection = list(selection)
+        self.change_count = change_count
+        self.dirty = None
+        self.full = False
+
+    @property
+    def has_changes(self):
+        return self.full or self.dirty is not None
+
+    def suspend(self):
+        """
+        Не учитывать события, пока view меняется не пользователем (например, применяется удаленный патч)
+        """
+        self.suspended = True
+
+    def resume(self, size, selection=(), change_count=None):
+        """
+        Вернуться к отслеживанию после suspend.
+        Если к моменту suspend были несинхронизированные правки, их координаты больше не достоверны,
+        поэтому следующая синхронизация будет полной.
+        :param size: int размер буфера после внешних изменений
+        :param selection: list of (begin, end)
+        :param change_count: int view.change_count() после внешних изменений
+        """
+        pending = self.has_changes
+        self.suspended = False
+        self.reset(size, selection, change_count)
+        self.full = pending
+
+    def selection_modified(self, selection):
+        if not self.suspended:
+            self.selection = list(selection)
+
+    def modified(self, size, selection, change_count=None):
+        """
+        Событие изменения буфера. Область правки вычисляется по выделению до и после правки:
+        правка всегда происходит в месте выделения (курсора), а разница размеров буфера дает ее длину.
+        :param size: int новый размер буфера
+        :param selection: list of (begin, end) выделение после правки
+        :param change_count: int view.change_count() после правки
+        """
+        if self.suspended:
+            return
+        self.change_count = change_count
+        selection = list(selection)
+        delta = size - self.size
+        if len(selection) != 1 or len(self.selection) != 1:
+            # несколько курсоров: область правки не определяется однозначно
+            self.full = True
+        else:
+            (prev_begin, prev_end), (begin, end) = self.selection[0], selection[0]
+            lo = min(prev_begin, begin)
+            hi_old = max(prev_end, end - delta)
+            if lo < 0 or hi_old > self.size or hi_old + delta < lo:
+                self.full = True
+            else:
+                self._merge(lo, hi_old, delta)
+        self.size = size
+        self.selection = selection
+
+    def _merge(self, lo, hi_old, delta):
+        """
+        Объединить правку [lo, hi_old) -> [lo, hi_old + delta) с уже накопленной областью
+        """
+        if self.dirty is None:
+            self.dirty = (lo, hi_old + delta, delta)
+            return
+        dirty_lo, dirty_hi, dirty_delta = self.dirty
+        new_lo = min(dirty_lo, lo)
+        new_hi = max(dirty_hi, hi_old) + delta
+        self.dirty = (new_lo, new_hi, dirty_delta + delta)
+
+    def poll(self, change_count=None):
+        """
+        Проверка перед синхронизацией, дешевая настолько, что ее можно делать на каждом тике: без чтения буфера.
+        Если счетчик правок view ушел вперед без событий modified, область правок неизвестна и нужен полный дифф
+        :param change_count: int текущий view.change_count() (None - не проверять)
+        :return: bool есть ли что синхронизировать
+        """
+        if change_count is not None and change_count != self.change_count and not self.suspended:
+            if self.change_count is not None:
+                self.full = True
+            self.change_count = change_count
+        return self.has_changes
+
+    def consume(self):
+        """
+        Забрать накопленные изменения и начать отслеживание заново.
+        :return: None если изменений нет, FULL если нужен полный дифф, иначе (start, end, new_end):
+        model[start:end] заменен на view[start:new_end]
+        """
+        if self.full:
+            ret = FULL
+        elif self.dirty is None:
+            return None
+        else:
+            self._captures += 1
+            if self.full_check_every and self._captures % self.full_check_every == 0:
+                ret = FULL
+            else:
+                lo, hi, delta = self.dirty
+                ret = (lo, hi - delta, hi)
+        self.dirty = None
+        self.full = False
+        return ret